@@ -0,0 +1,333 @@
+"""Нагрузочный стенд сетевого ядра чата без GUI.
+
+Запускает N пиров ``ChatNetwork`` в отдельных процессах на multicast через
+loopback (трафик стенда не уходит в локальную сеть), ждёт сходимости
+присутствия, гоняет групповые и личные сообщения с заданной частотой
+и сохраняет результат в JSON:
+
+    python bench.py --peers 20 --duration 30 --group-rate 5 --private-rate 1 -o before.json
+    python bench.py --peers 20 --duration 30 --group-rate 5 --private-rate 1 --compare before.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from translator_pool import current_rss
+
+
+BENCH_PREFIX = "bench"  # начало текста тестового сообщения
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _drain(network, stats, username):
+    """Разбор событий пира: задержка по метке времени внутри текста сообщения"""
+    while True:
+        try:
+            event_type, data = network.events.get_nowait()
+        except queue.Empty:
+            return
+        if event_type == 'group_message':
+            sender, kind = data.get('username'), 'group'
+        elif event_type == 'private_message':
+            sender, kind = data.get('from'), 'private'
+        else:
+            continue
+        parts = data.get('message', '').split(" ")
+        if len(parts) < 3 or parts[0] != BENCH_PREFIX or sender == username:
+            continue
+        stats[kind + '_received'] += 1
+        stats[kind + '_latencies'].append(time.time() - float(parts[1]))
+
+
+def _peer_main(index, options, start_barrier, results):
+    """Процесс одного пира: присутствие, нагрузка, отчёт"""
+    from network import ChatNetwork
+
+    username = f"peer-{index}"
+    network = ChatNetwork(
+        username,
+        multicast_group=options['group'],
+        multicast_port=options['port'],
+        tcp_port=options['tcp_base'] + index,
+        heartbeat_interval=options['heartbeat'],
+        user_timeout=options['heartbeat'] * 4,
+        outbox_path=':memory:',
+        interface=options['interface'],
+        # Все пиры шлют с одного адреса: лимиты по IP (пакеты и личные
+        # соединения) делили бы одну корзину на весь стенд
+        packet_rate=None,
+        private_rate=None,
+        receive_buffer=options['receive_buffer'],
+    )
+    network.setup_sockets()
+    # Все пиры стартуют одновременно, иначе сходимость первых включала бы
+    # время запуска процессов остальных
+    start_barrier.wait()
+    started = time.monotonic()
+    network.start()
+
+    stats = {'group_received': 0, 'private_received': 0,
+             'group_latencies': [], 'private_latencies': []}
+
+    # Сходимость присутствия: все остальные пиры видны в индексе
+    converged = None
+    deadline = started + options['converge_timeout']
+    while time.monotonic() < deadline:
+        _drain(network, stats, username)
+        if converged is None and network.presence.online_count() >= options['peers'] - 1:
+            converged = time.monotonic() - started
+        # Пользователи из дайджеста известны без TCP-адреса: для личных
+        # сообщений дожидаемся heartbeat каждого пира
+        if converged is not None and len(network.peer_addresses) >= options['peers'] - 1:
+            break
+        time.sleep(0.01)
+
+    start_barrier.wait()
+
+    # Нагрузка: сообщения по расписанию, без накопления отставания
+    padding = "x" * options['size']
+    group_interval = 1.0 / options['group_rate'] if options['group_rate'] else None
+    private_interval = 1.0 / options['private_rate'] if options['private_rate'] else None
+    others = [f"peer-{i}" for i in range(options['peers']) if i != index]
+    sent = {'group': 0, 'private': 0}
+    cpu_before = time.process_time()  # user + system, работает и на Windows
+
+    now = time.monotonic()
+    stop_at = now + options['duration']
+    next_group = now + random.uniform(0, group_interval or 0)
+    next_private = now + random.uniform(0, private_interval or 0)
+    while True:
+        now = time.monotonic()
+        if now >= stop_at:
+            break
+        if group_interval and now >= next_group:
+            network.send_group_message(f"{BENCH_PREFIX} {time.time():.6f} {sent['group']} {padding}")
+            sent['group'] += 1
+            next_group += group_interval
+        if private_interval and others and now >= next_private:
+            network.send_private_message(
+                random.choice(others), f"{BENCH_PREFIX} {time.time():.6f} {sent['private']} {padding}")
+            sent['private'] += 1
+            next_private += private_interval
+        _drain(network, stats, username)
+        time.sleep(0.001)
+
+    # Ждём опоздавшие сообщения и повторы
+    drain_until = time.monotonic() + options['drain']
+    while time.monotonic() < drain_until:
+        _drain(network, stats, username)
+        time.sleep(0.01)
+
+    cpu = time.process_time() - cpu_before
+    results.put({
+        'peer': username,
+        'presence_converged_s': converged,
+        'sent': sent,
+        'group_received': stats['group_received'],
+        'private_received': stats['private_received'],
+        'group_latencies': stats['group_latencies'],
+        'private_latencies': stats['private_latencies'],
+        'duplicates': network.receiver.duplicates,
+        'rate_limited': network.message_limiter.total_suppressed if network.message_limiter else 0,
+        'kernel_drops': network.udp_drops(),
+        'lost_reported': network.receiver.lost,
+        'cpu_s': cpu,
+        'cpu_percent': 100.0 * cpu / options['duration'],
+        'rss_bytes': current_rss(),
+    })
+    network.stop()
+
+
+def run_benchmark(options):
+    context = multiprocessing.get_context('spawn')
+    start_barrier = context.Barrier(options['peers'])
+    results = context.Queue()
+
+    processes = [context.Process(target=_peer_main, args=(i, options, start_barrier, results),
+                                 daemon=True)
+                 for i in range(options['peers'])]
+    for process in processes:
+        process.start()
+
+    timeout = options['converge_timeout'] + options['duration'] + options['drain'] + 30
+    reports = []
+    try:
+        for _ in processes:
+            reports.append(results.get(timeout=timeout))
+    except queue.Empty:
+        print(f"Ответили только {len(reports)} пиров из {options['peers']}")
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+    return summarize(options, reports)
+
+
+def summarize(options, reports):
+    peers = options['peers']
+    sent_group = sum(report['sent']['group'] for report in reports)
+    sent_private = sum(report['sent']['private'] for report in reports)
+    received_group = sum(report['group_received'] for report in reports)
+    received_private = sum(report['private_received'] for report in reports)
+    group_latencies = [value for report in reports for value in report['group_latencies']]
+    private_latencies = [value for report in reports for value in report['private_latencies']]
+    converged = [report['presence_converged_s'] for report in reports]
+
+    # Групповое сообщение должны получить все пиры, кроме отправителя
+    expected_group = sent_group * (peers - 1)
+
+    def milliseconds(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'meta': {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'commit': _git_commit(),
+            'python': sys.version.split()[0],
+            'options': options,
+        },
+        'peers_reported': len(reports),
+        'presence': {
+            'converged_peers': sum(1 for value in converged if value is not None),
+            'p50_s': percentile([value for value in converged if value is not None], 0.5),
+            'max_s': max((value for value in converged if value is not None), default=None),
+        },
+        'group': {
+            'sent': sent_group,
+            'delivered': received_group,
+            'delivered_per_s': received_group / options['duration'],
+            'loss_rate': 1 - received_group / expected_group if expected_group else 0.0,
+            'latency_p50_ms': milliseconds(percentile(group_latencies, 0.5)),
+            'latency_p99_ms': milliseconds(percentile(group_latencies, 0.99)),
+            'duplicates_dropped': sum(report['duplicates'] for report in reports),
+            'lost_reported': sum(report['lost_reported'] for report in reports),
+            'rate_limited': sum(report['rate_limited'] for report in reports),
+            'kernel_drops': sum(report['kernel_drops'] or 0 for report in reports),
+        },
+        'private': {
+            'sent': sent_private,
+            'delivered': received_private,
+            'delivered_per_s': received_private / options['duration'],
+            'loss_rate': 1 - received_private / sent_private if sent_private else 0.0,
+            'latency_p50_ms': milliseconds(percentile(private_latencies, 0.5)),
+            'latency_p99_ms': milliseconds(percentile(private_latencies, 0.99)),
+        },
+        'resources': {
+            'cpu_percent_mean': sum(report['cpu_percent'] for report in reports) / len(reports)
+            if reports else None,
+            'cpu_percent_max': max((report['cpu_percent'] for report in reports), default=None),
+            'rss_bytes_max': max((report['rss_bytes'] or 0 for report in reports), default=None),
+            'per_peer': {report['peer']: {'cpu_percent': round(report['cpu_percent'], 2),
+                                          'rss_bytes': report['rss_bytes']}
+                         for report in reports},
+        },
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# Метрики для сравнения прогонов: (раздел, ключ, чем больше - тем лучше)
+COMPARED_METRICS = [
+    ('presence', 'max_s', False),
+    ('group', 'delivered_per_s', True),
+    ('group', 'loss_rate', False),
+    ('group', 'latency_p50_ms', False),
+    ('group', 'latency_p99_ms', False),
+    ('group', 'kernel_drops', False),
+    ('private', 'delivered_per_s', True),
+    ('private', 'loss_rate', False),
+    ('private', 'latency_p50_ms', False),
+    ('private', 'latency_p99_ms', False),
+    ('resources', 'cpu_percent_mean', False),
+    ('resources', 'rss_bytes_max', False),
+]
+
+
+def compare(baseline, current):
+    """Таблица изменений ключевых метрик относительно прошлого прогона"""
+    print(f"{'метрика':<28}{'было':>14}{'стало':>14}{'изменение':>12}")
+    for section, key, higher_is_better in COMPARED_METRICS:
+        before = baseline.get(section, {}).get(key)
+        after = current.get(section, {}).get(key)
+        change = ""
+        if before and after is not None:
+            delta = (after - before) / before * 100
+            worse = delta < 0 if higher_is_better else delta > 0
+            change = f"{delta:+.1f}%" + (" !" if worse and abs(delta) >= 10 else "")
+        print(f"{section + '.' + key:<28}{_format(before):>14}{_format(after):>14}{change:>12}")
+
+
+def _format(value):
+    if value is None:
+        return "-"
+    return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд сетевого ядра чата")
+    parser.add_argument('--peers', type=int, default=10, help="число пиров-процессов")
+    parser.add_argument('--duration', type=float, default=10, help="секунд нагрузки")
+    parser.add_argument('--group-rate', type=float, default=2,
+                        help="групповых сообщений в секунду от каждого пира")
+    parser.add_argument('--private-rate', type=float, default=0.5,
+                        help="личных сообщений в секунду от каждого пира")
+    parser.add_argument('--size', type=int, default=64, help="байт полезной нагрузки в сообщении")
+    parser.add_argument('--group', default='239.255.77.77', help="multicast-группа стенда")
+    parser.add_argument('--port', type=int, default=15007, help="multicast-порт стенда")
+    parser.add_argument('--interface', default='127.0.0.1',
+                        help="IP интерфейса для multicast; по умолчанию loopback, чтобы не шуметь в сети")
+    parser.add_argument('--tcp-base', type=int, default=16000,
+                        help="TCP-порт первого пира, остальные идут подряд")
+    parser.add_argument('--heartbeat', type=float, default=2, help="интервал heartbeat пиров")
+    parser.add_argument('--converge-timeout', type=float, default=30,
+                        help="сколько ждать сходимости присутствия")
+    parser.add_argument('--drain', type=float, default=3,
+                        help="секунд ожидания опоздавших сообщений после нагрузки")
+    parser.add_argument('--receive-buffer', type=int, default=None,
+                        help="SO_RCVBUF приёмного сокета пира, байт")
+    parser.add_argument('-o', '--output', help="куда сохранить результат в JSON")
+    parser.add_argument('--compare', metavar='JSON', help="сравнить с сохранённым прогоном")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    options = {
+        'peers': args.peers, 'duration': args.duration, 'group_rate': args.group_rate,
+        'private_rate': args.private_rate, 'size': args.size, 'group': args.group,
+        'port': args.port, 'interface': args.interface, 'tcp_base': args.tcp_base, 'heartbeat': args.heartbeat,
+        'converge_timeout': args.converge_timeout, 'drain': args.drain,
+        'receive_buffer': args.receive_buffer,
+    }
+    result = run_benchmark(options)
+    print(json.dumps({key: value for key, value in result.items() if key != 'resources'},
+                     indent=2, ensure_ascii=False))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(result, output, indent=2, ensure_ascii=False)
+        print(f"Результат сохранён в {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            compare(json.load(baseline_file), result)
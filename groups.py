@@ -0,0 +1,86 @@
+import hashlib
+import os
+import socket
+import sys
+
+
+DEFAULT_GROUPS_PATH = os.path.join(os.path.expanduser('~'), '.localchat', 'groups.txt')
+
+# 239.192.0.0/14 - multicast в пределах организации (RFC 2365): за пределы
+# офисной сети такие пакеты не уходят
+GROUP_PREFIX = '239.192'
+GROUP_PORT_RANGE = 1000  # порты групп: multicast_port + 1 .. multicast_port + 1000
+MAX_NAME_LENGTH = 64
+
+
+def valid_name(name):
+    """Имя группы годится: строка без управляющих символов и пробелов по краям.
+
+    Имя приходит и в чужих приглашениях, а попадает в построчные
+    ``groups.txt`` и ``conversations.txt`` истории.
+    """
+    return (isinstance(name, str) and 0 < len(name) <= MAX_NAME_LENGTH
+            and name.isprintable() and name == name.strip())
+
+
+def channel_address(name, base_port):
+    """Multicast-адрес и порт группового чата по его имени.
+
+    У всех клиентов одно имя даёт один и тот же адрес, поэтому договариваться
+    о нём не нужно. Отдельный порт нужен там, где сокет нельзя привязать
+    к адресу группы (Windows): тогда группы разделяются хотя бы портом.
+    """
+    digest = hashlib.sha1(name.encode('utf-8')).digest()
+    address = f"{GROUP_PREFIX}.{digest[0]}.{digest[1] or 1}"
+    port = base_port + 1 + int.from_bytes(digest[2:4], 'big') % GROUP_PORT_RANGE
+    return address, port
+
+
+def open_channel_socket(address, port, interface='0.0.0.0'):
+    """Приёмный сокет одной группы с подпиской IP_ADD_MEMBERSHIP.
+
+    На Linux сокет привязывается к адресу группы и отключается
+    IP_MULTICAST_ALL: ядро отдаёт ему только пакеты этой группы, а пакеты
+    групп, в которые пользователь не вступал, отбрасываются ещё сетевой
+    картой и ядром. ``interface`` - IP интерфейса для подписки, по
+    умолчанию его выбирает ядро.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if sys.platform.startswith('linux'):
+            sock.bind((address, port))
+            sock.setsockopt(socket.IPPROTO_IP, getattr(socket, 'IP_MULTICAST_ALL', 49), 0)
+        else:
+            sock.bind(('', port))
+        mreq = socket.inet_aton(address) + socket.inet_aton(interface)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def drop_membership(sock, address, interface='0.0.0.0'):
+    """Выход из группы: IP_DROP_MEMBERSHIP, сокет закрывает вызывающий"""
+    mreq = socket.inet_aton(address) + socket.inet_aton(interface)
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, mreq)
+    except OSError:
+        pass  # сокет уже закрыт или интерфейс пропал - подписки всё равно нет
+
+
+def load_groups(path=DEFAULT_GROUPS_PATH):
+    """Группы, в которых пользователь состоял при прошлом запуске"""
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as groups_file:
+        return [name for name in map(str.strip, groups_file) if valid_name(name)]
+
+
+def save_groups(names, path=DEFAULT_GROUPS_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as groups_file:
+        for name in names:
+            groups_file.write(name + '\n')
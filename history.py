@@ -0,0 +1,288 @@
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+
+import protocol
+
+
+DEFAULT_HISTORY_DIR = os.path.join(os.path.expanduser('~'), '.localchat', 'history')
+
+RECORD_HEADER = struct.Struct('!I')  # длина записи в сегменте
+INDEX_ENTRY = struct.Struct('!III')  # номер сегмента, смещение, id беседы
+WORDS_HEADER = struct.Struct('!II')  # номер записи, длина списка её слов
+WORD_RE = re.compile(r"\w+")
+
+ALL = '*'  # общая лента всех бесед, как в окне чата
+
+
+class MessageHistory:
+    """Локальная история сообщений: журнал только на дозапись.
+
+    Записи лежат в сегментах ``segment-NNNNNN.log`` (каждая - длина и пакет
+    ``protocol``) и читаются через mmap. Рядом ведётся ``index.log`` из
+    записей фиксированной длины ``(сегмент, смещение, беседа)``: при запуске
+    читается только он, а сами сообщения подгружаются по мере листания.
+    Слова каждой записи дописываются в ``words.log``: инвертированный индекс
+    для поиска собирается из него в фоновом потоке, не разбирая сообщений,
+    а записи, которых там ещё нет (история старых версий), индексируются
+    тем же потоком. Пока он не закончил, ``index_ready`` не установлен.
+    Беседа - 'group', IP собеседника или 'system'.
+    """
+
+    def __init__(self, path=DEFAULT_HISTORY_DIR, segment_size=8 * 1024 * 1024):
+        self.path = path
+        self.segment_size = segment_size
+        os.makedirs(path, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._maps = {}  # номер сегмента -> mmap
+        self._words = {}  # слово -> array номеров записей
+        self._indexed = None  # записи до этого номера уже в words.log; None - он ещё не прочитан
+        self._closed = False
+        self.index_ready = threading.Event()
+
+        # Номера записей в общей ленте и по беседам
+        self._segments = array('I')
+        self._offsets = array('I')
+        self._conversation_ids = array('I')
+        self._by_conversation = {}  # id беседы -> array номеров записей
+
+        self._conversations = []  # id -> имя
+        self._conversation_index = {}  # имя -> id
+        self._load_conversations()
+        self._load_index()
+
+        self._active_segment = self._segments[-1] if self._segments else 0
+        self._segment_file = open(self._segment_path(self._active_segment), 'ab')
+        self._index_file = open(os.path.join(path, 'index.log'), 'ab')
+        self._words_path = os.path.join(path, 'words.log')
+        self._words_file = open(self._words_path, 'ab')
+        threading.Thread(target=self._build_word_index, daemon=True,
+                         name="history-index").start()
+
+    # ------------------------------------------------------------------
+    # Загрузка
+    # ------------------------------------------------------------------
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, f'segment-{number:06d}.log')
+
+    def _load_conversations(self):
+        conversations_path = os.path.join(self.path, 'conversations.txt')
+        if os.path.exists(conversations_path):
+            with open(conversations_path, encoding='utf-8') as conversations_file:
+                for line in conversations_file:
+                    self._register_conversation(line.rstrip('\n'))
+        self._conversations_file = open(conversations_path, 'a', encoding='utf-8')
+
+    def _register_conversation(self, name):
+        conversation_id = len(self._conversations)
+        self._conversations.append(name)
+        self._conversation_index[name] = conversation_id
+        self._by_conversation[conversation_id] = array('I')
+        return conversation_id
+
+    def _load_index(self):
+        index_path = os.path.join(self.path, 'index.log')
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, 'rb') as index_file:
+            data = index_file.read()
+        # Хвост от незавершённой записи отбрасываем
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        if usable != len(data):
+            with open(index_path, 'r+b') as index_file:
+                index_file.truncate(usable)
+        for segment, offset, conversation_id in INDEX_ENTRY.iter_unpack(data[:usable]):
+            if conversation_id >= len(self._conversations):
+                continue
+            self._by_conversation[conversation_id].append(len(self._segments))
+            self._segments.append(segment)
+            self._offsets.append(offset)
+            self._conversation_ids.append(conversation_id)
+
+    # ------------------------------------------------------------------
+    # Запись
+    # ------------------------------------------------------------------
+
+    def append(self, conversation, text, tag):
+        """Дозапись сообщения; возвращает его номер в общей ленте"""
+        # conversations.txt построчный: перевод строки в имени сдвинул бы все id
+        conversation = ''.join(ch if ch.isprintable() else '?' for ch in conversation)
+        with self._lock:
+            conversation_id = self._conversation_index.get(conversation)
+            if conversation_id is None:
+                conversation_id = self._register_conversation(conversation)
+                self._conversations_file.write(conversation + '\n')
+                self._conversations_file.flush()
+
+            payload = protocol.encode({'conversation': conversation, 'time': time.time(),
+                                       'text': text, 'tag': tag})
+            offset = self._segment_file.tell()
+            if offset and offset + RECORD_HEADER.size + len(payload) > self.segment_size:
+                self._roll_segment()
+                offset = 0
+            self._segment_file.write(RECORD_HEADER.pack(len(payload)) + payload)
+            self._segment_file.flush()
+            self._index_file.write(INDEX_ENTRY.pack(self._active_segment, offset, conversation_id))
+            self._index_file.flush()
+
+            number = len(self._segments)
+            self._segments.append(self._active_segment)
+            self._offsets.append(offset)
+            self._conversation_ids.append(conversation_id)
+            self._by_conversation[conversation_id].append(number)
+            if self._indexed == number:
+                self._index_words(number, text)
+            return number
+
+    def _roll_segment(self):
+        self._segment_file.close()
+        self._active_segment += 1
+        self._segment_file = open(self._segment_path(self._active_segment), 'ab')
+
+    # ------------------------------------------------------------------
+    # Чтение
+    # ------------------------------------------------------------------
+
+    def _numbers(self, conversation):
+        if conversation == ALL:
+            return None
+        conversation_id = self._conversation_index.get(conversation)
+        return self._by_conversation[conversation_id] if conversation_id is not None else array('I')
+
+    def count(self, conversation=ALL):
+        with self._lock:
+            numbers = self._numbers(conversation)
+            return len(self._segments) if numbers is None else len(numbers)
+
+    def read(self, number):
+        """Запись по номеру: dict с ключами conversation, time, text, tag"""
+        with self._lock:
+            segment, offset = self._segments[number], self._offsets[number]
+            view = self._map(segment, offset + RECORD_HEADER.size)
+            (length,) = RECORD_HEADER.unpack_from(view, offset)
+            start = offset + RECORD_HEADER.size
+            view = self._map(segment, start + length)
+            return protocol.decode(view[start:start + length])
+
+    def _map(self, segment, needed):
+        """mmap сегмента, перестроенный, если файл дорос после отображения"""
+        current = self._maps.get(segment)
+        if current is not None and len(current) >= needed:
+            return current
+        if current is not None:
+            current.close()
+        with open(self._segment_path(segment), 'rb') as segment_file:
+            current = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[segment] = current
+        return current
+
+    def page(self, conversation=ALL, end=None, count=50):
+        """Записи беседы с позициями ``[end - count, end)``; end=None - самые новые.
+
+        Позиция - порядковый номер сообщения внутри беседы; возвращает
+        ``(позиция первой записи, [записи])`` для следующего запроса.
+        """
+        with self._lock:
+            total = self.count(conversation)
+            end = total if end is None else min(end, total)
+            start = max(0, end - count)
+            numbers = self._numbers(conversation)
+            records = [self.read(position if numbers is None else numbers[position])
+                       for position in range(start, end)]
+            return start, records
+
+    # ------------------------------------------------------------------
+    # Поиск
+    # ------------------------------------------------------------------
+
+    def _index_words(self, number, text):
+        """Слова записи - в words.log и в индекс (вызывается под блокировкой)"""
+        words = set(WORD_RE.findall(text.lower()))
+        payload = '\n'.join(words).encode('utf-8')
+        self._words_file.write(WORDS_HEADER.pack(number, len(payload)) + payload)
+        self._words_file.flush()
+        self._add_postings(number, words)
+        self._indexed = number + 1
+
+    def _add_postings(self, number, words):
+        for word in words:
+            self._words.setdefault(word, array('I')).append(number)
+
+    def _load_words(self):
+        """Индекс из words.log; возвращает число записей, которые он покрывает"""
+        with open(self._words_path, 'rb') as words_file:
+            data = words_file.read()
+        with self._lock:
+            total = len(self._segments)
+        position = indexed = 0
+        while position + WORDS_HEADER.size <= len(data):
+            number, length = WORDS_HEADER.unpack_from(data, position)
+            end = position + WORDS_HEADER.size + length
+            if number != indexed or number >= total or end > len(data):
+                break  # хвост от незавершённой записи или от обрезанного index.log
+            words = data[position + WORDS_HEADER.size:end].decode('utf-8', 'replace')
+            self._add_postings(number, words.split('\n') if words else ())
+            position, indexed = end, indexed + 1
+        if position != len(data):
+            with open(self._words_path, 'r+b') as words_file:
+                words_file.truncate(position)
+        return indexed
+
+    def _build_word_index(self):
+        """Фоновый поток: words.log, затем записи, которых в нём нет"""
+        try:
+            indexed = self._load_words()
+            with self._lock:
+                self._indexed = indexed
+            while True:
+                with self._lock:
+                    if self._closed:
+                        return
+                    if self._indexed >= len(self._segments):
+                        break
+                    self._index_words(self._indexed, self.read(self._indexed)['text'])
+        except (OSError, ValueError) as e:  # ProtocolError - тоже ValueError
+            print(f"Не удалось построить индекс поиска: {e}")
+            return
+        self.index_ready.set()
+
+    def search(self, query, conversation=ALL, limit=100):
+        """Сообщения, содержащие все слова запроса, от новых к старым.
+
+        До ``index_ready`` находятся только уже проиндексированные записи.
+        """
+        words = set(WORD_RE.findall(query.lower()))
+        if not words:
+            return []
+        with self._lock:
+            postings = sorted((self._words.get(word, array('I')) for word in words), key=len)
+            matches = set(postings[0])
+            for posting in postings[1:]:
+                matches.intersection_update(posting)
+
+            conversation_id = self._conversation_index.get(conversation)
+            results = []
+            for number in sorted(matches, reverse=True):
+                if conversation != ALL and self._conversation_ids[number] != conversation_id:
+                    continue
+                results.append(self.read(number))
+                if len(results) >= limit:
+                    break
+            return results
+
+    def close(self):
+        with self._lock:
+            for current in self._maps.values():
+                current.close()
+            self._maps.clear()
+            self._segment_file.close()
+            self._index_file.close()
+            self._words_file.close()
+            self._conversations_file.close()
+            self._closed = True
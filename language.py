@@ -0,0 +1,173 @@
+import re
+
+
+# Ссылки, почта, пути, упоминания и код в обратных кавычках языка не несут
+NOISE_RE = re.compile(
+    r"```.*?```|`[^`]*`"
+    r"|\b(?:https?|ftp)://\S+|\bwww\.\S+"
+    r"|\S+@\S+\.\w+"
+    r"|(?:[A-Za-z]:)?(?:[\\/][\w.\-]+){2,}"
+    r"|@\w+",
+    re.DOTALL,
+)
+WORD_RE = re.compile(r"[^\W\d_]+")
+CODE_CHARS = set("{}()[];=<>_/\\|&*#$+")
+
+MIN_LETTERS = 3  # меньше букв - язык не определяем
+RUSSIAN_RATIO = 0.5  # доля кириллицы: русский текст с вкраплениями английских слов
+ENGLISH_RATIO = 0.7  # доля латиницы, начиная с которой проверяем английский
+CODE_RATIO = 0.15  # доля «кодовых» символов, начиная с которой текст считается кодом
+TRIGRAM_THRESHOLD = 0.2  # доля частых английских триграмм для латиницы
+COMMON_WORD_RATIO = 0.5  # или такая доля слов из COMMON_ENGLISH_WORDS
+
+# Частые английские триграммы (с границами слов). Отличают английский
+# от латиницы другого рода: транслита, идентификаторов, немецкого
+ENGLISH_TRIGRAMS = frozenset("""
+_th the he_ _an and nd_ _to _of of_ ing ng_ _in in_ er_ _is is_ ion tio
+ati _a_ on_ re_ _it it_ es_ ed_ _wh _be _fo for or_ _ha hat tha at_ ent
+nt_ _co _re ter _wi wit ith th_ ll_ _yo you ou_ _we _ca _do _no not ot_
+_on _so _wa _ar are _bu but ut_ _ok ok_ hi_ his _hi _ne _pl _pr _se _st
+ver _ma _me _my _ge _go _kn _le _li _lo ks_ hin ink _fi _us use
+ly_ ry_ ere her _he ome _al all est _mo _up _ye _ti _pa _ri _sh
+""".split())
+
+
+# Служебные слова и словарь статусных строк ботов («build failed»,
+# «Deploy complete»): в двух-трёх коротких словах триграмм слишком мало
+COMMON_ENGLISH_WORDS = frozenset("""
+an the and or but not no yes is are was were be been has have had do does did
+to of in on at for from with by as it its this that these there here we you he
+she they my your our all any some new can will just now up down out off ok okay
+please thanks thank hello hi done ready failed fail failure error errors warning
+success successful passed pass build builds deploy deployed deployment release
+released complete completed started start stopped finished running update updated
+merged merge check checks test tests job pipeline server service restart restarted
+available unavailable broken fixed back again still today tomorrow meeting call
+""".split())
+
+
+def strip_noise(text):
+    """Удаление ссылок, путей, адресов и фрагментов кода"""
+    return NOISE_RE.sub(" ", text)
+
+
+def looks_like_code(text):
+    """Грубая проверка, что сообщение - код, лог или набор идентификаторов"""
+    stripped = text.strip()
+    if not stripped:
+        return False
+    code_chars = sum(1 for c in stripped if c in CODE_CHARS)
+    return code_chars / len(stripped) >= CODE_RATIO
+
+
+def _common_word_ratio(words):
+    return sum(1 for word in words if word.lower() in COMMON_ENGLISH_WORDS) / len(words) if words else 0.0
+
+
+def _english_score(words):
+    trigrams = total = 0
+    for word in words:
+        padded = f"_{word.lower()}_"
+        for i in range(len(padded) - 2):
+            total += 1
+            if padded[i:i + 3] in ENGLISH_TRIGRAMS:
+                trigrams += 1
+    return trigrams / total if total else 0.0
+
+
+def detect_language(text):
+    """Определение языка сообщения: 'ru', 'en' или None, если не уверены.
+
+    Сначала соотношение кириллицы и латиницы, затем для латиницы проверка
+    по частым английским триграммам или частым словам (для коротких
+    строк). Работает за один проход по тексту и не требует моделей.
+    """
+    if looks_like_code(text):
+        return None
+
+    words = WORD_RE.findall(strip_noise(text))
+    cyrillic = latin = 0
+    latin_words = []
+    for word in words:
+        word_cyrillic = sum(1 for c in word if 'Ѐ' <= c <= 'ӿ')
+        word_latin = sum(1 for c in word if 'a' <= c.lower() <= 'z')
+        cyrillic += word_cyrillic
+        latin += word_latin
+        if word_latin and not word_cyrillic:
+            latin_words.append(word)
+
+    letters = cyrillic + latin
+    if letters < MIN_LETTERS:
+        return None
+    if cyrillic / letters >= RUSSIAN_RATIO:
+        return 'ru'
+    if latin / letters >= ENGLISH_RATIO and (_english_score(latin_words) >= TRIGRAM_THRESHOLD
+                                             or _common_word_ratio(latin_words) >= COMMON_WORD_RATIO):
+        return 'en'
+    return None
+
+
+def translation_direction(text, directions):
+    """Пара (src, tgt) для перевода или None, если переводить не нужно.
+
+    ``directions`` - разрешённые пары; текст на целевом языке, код, ссылки
+    и короткие реплики без букв не переводятся.
+    """
+    src = detect_language(text)
+    if src is None:
+        return None
+    for pair in directions:
+        if pair[0] == src:
+            return pair
+    return None
+
+
+# Граница предложения: знак конца предложения и пробел, либо перевод строки
+SENTENCE_BOUNDARY_RE = re.compile(r"(?<=[.!?…])\s+|\s*\n\s*")
+SEGMENT_MAX_CHARS = 400  # ~100 токенов Marian: далеко от лимита в 512 и быстро генерируется
+
+
+def segment_text(text, max_chars=SEGMENT_MAX_CHARS):
+    """Разбиение длинного текста на сегменты по границам предложений.
+
+    Возвращает список пар ``(сегмент, разделитель_после)``; склейка
+    переводов сегментов с теми же разделителями сохраняет абзацы.
+    Соседние короткие предложения объединяются до ``max_chars``, а слишком
+    длинное предложение режется по пробелам.
+    """
+    if len(text) <= max_chars:
+        return [(text, "")]
+
+    sentences = []
+    position = 0
+    for match in SENTENCE_BOUNDARY_RE.finditer(text):
+        sentences.append((text[position:match.start()], match.group()))
+        position = match.end()
+    sentences.append((text[position:], ""))
+
+    segments = []
+    for sentence, separator in sentences:
+        for piece, piece_separator in _split_long(sentence, separator, max_chars):
+            # Склеиваем с предыдущим сегментом, если влезает и между ними не абзац
+            if segments and "\n" not in segments[-1][1]:
+                previous, previous_separator = segments[-1]
+                joined = previous + previous_separator + piece
+                if len(joined) <= max_chars:
+                    segments[-1] = (joined, piece_separator)
+                    continue
+            segments.append((piece, piece_separator))
+    return segments
+
+
+def _split_long(sentence, separator, max_chars):
+    if len(sentence) <= max_chars:
+        return [(sentence, separator)]
+    pieces = []
+    while len(sentence) > max_chars:
+        cut = sentence.rfind(" ", 0, max_chars)
+        if cut <= 0:
+            cut = max_chars
+        pieces.append((sentence[:cut], " " if sentence[cut:cut + 1] == " " else ""))
+        sentence = sentence[cut:].lstrip(" ")
+    pieces.append((sentence, separator))
+    return pieces
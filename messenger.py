@@ -1,11 +1,26 @@
 import socket
-import threading
-import time
-import json
+import queue
+import bisect
+from collections import deque
 from datetime import datetime
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
+import os
 import sys
+import time
+
+from network import ChatNetwork
+from history import MessageHistory, ALL
+import groups
+import metrics
+import outbox
+import peers
+import presence
+
+POLL_LAG = metrics.histogram('gui.poll_lag_s')  # опоздание опроса очереди сверх интервала
+EVENTS_PER_POLL = metrics.histogram('gui.events_per_poll', metrics.SIZE_BUCKETS)
+RENDER_LAG = metrics.histogram('gui.render_lag_s')  # от постановки сообщения до вставки
+FLUSH_TIME = metrics.histogram('gui.flush_s')
 
 class P2PChatGUI:
     def __init__(self, root):
@@ -14,6 +29,8 @@ class P2PChatGUI:
         self.root.geometry("800x600")
         
         self.username = socket.gethostbyname(socket.gethostname())
+        self.peer_id = peers.load_peer_id()
+        self.display_name = peers.default_display_name()
         self.running = True
         
         # Настройки для группового чата (multicast)
@@ -21,46 +38,69 @@ class P2PChatGUI:
         self.multicast_port = 5007
         self.multicast_ttl = 1
         self.tcp_port = 5008
-        self.known_users = {}  # ip -> {'last_seen': timestamp, 'status': 'online'}
+        # Адреса ретрансляторов подсети (relay.py) через запятую
+        self.relay_hosts = [host.strip() for host in os.environ.get('LOCALCHAT_RELAYS', '').split(',')
+                            if host.strip()]
         
         # Улучшенные настройки таймаутов
         self.HEARTBEAT_INTERVAL = 25  # секунд между heartbeat
         self.USER_TIMEOUT = 60  # секунд до отметки как offline
         self.CLEANUP_INTERVAL = 30  # секунд между очистками
+        self.EVENT_POLL_INTERVAL = 50  # мс между проверками очереди событий сети
+        self.IDLE_POLL_INTERVAL = 800  # мс: до стольких растёт интервал, пока событий нет
+        self.RECEIVE_BUFFER = 1024 * 1024  # SO_RCVBUF multicast-сокетов: запас на всплески
+        
+        # Настройки отображения чата
+        self.MAX_SCROLLBACK = 1000  # сообщений в окне чата, старые вытесняются
+        self.HISTORY_PAGE = 200  # сообщений, подгружаемых за одно нажатие "Ранее"
+        self.STARTUP_HISTORY = 50  # сообщений из истории, показываемых при запуске
+        
+        self.render_queue = deque()  # (строка, тег, беседа, id доставки) ожидающие отрисовки
+        self.render_queue_since = None  # когда в пустую очередь отрисовки попало сообщение
+        self.last_poll = None
+        self.poll_interval = self.EVENT_POLL_INTERVAL  # текущий интервал опроса, мс
+        self.poll_job = None  # id запланированного root.after опроса
+        metrics.gauge('gui.render_queue', lambda: len(self.render_queue))
+        
+        # Подписи состояния доставки личных сообщений
+        self.DELIVERY_LABELS = {
+            outbox.QUEUED: "в очереди",
+            outbox.SENT: "отправлено",
+            outbox.RETRY: "не доставлено, повтор через {delay:.0f} с",
+            outbox.DELIVERED: "доставлено",
+            outbox.FAILED: "не подтверждено, отправка прекращена",
+        }
+        self.rendered_lines = deque()  # число строк каждого сообщения в окне чата
+        self.shown_start = 0  # позиция в истории первого сообщения в окне чата
+        self.history = self.open_history()
+        self.listed_users = []  # отсортированные пользователи в users_listbox (без себя)
+        self.MAIN_CHAT_LABEL = "Общий чат"
+        self.joined_groups = []  # групповые чаты в groups_listbox после общего
+        
+        self.network = ChatNetwork(
+            self.username,
+            multicast_group=self.multicast_group,
+            multicast_port=self.multicast_port,
+            tcp_port=self.tcp_port,
+            multicast_ttl=self.multicast_ttl,
+            heartbeat_interval=self.HEARTBEAT_INTERVAL,
+            user_timeout=self.USER_TIMEOUT,
+            cleanup_interval=self.CLEANUP_INTERVAL,
+            receive_buffer=self.RECEIVE_BUFFER,
+            peer_id=self.peer_id,
+            display_name=self.display_name,
+            relay_hosts=self.relay_hosts,
+        )
         
         self.setup_sockets()
         self.create_widgets()
+        self.load_recent_history()
         self.start_listeners()
         
-        # Запуск heartbeat
-        self.start_heartbeat()
-        
     def setup_sockets(self):
         """Инициализация сокетов с улучшенной обработкой ошибок"""
         try:
-            # Multicast сокет для группового чата
-            self.multicast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
-            self.multicast_socket.settimeout(0.5)  # Таймаут для неблокирующей работы
-            
-            # UDP сокет для приема multicast
-            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.udp_socket.bind(('', self.multicast_port))
-            self.udp_socket.settimeout(0.5)  # Таймаут для неблокирующей работы
-            
-            # Подписка на multicast группу
-            group = socket.inet_aton(self.multicast_group)
-            mreq = group + socket.inet_aton('0.0.0.0')
-            self.udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-            
-            # TCP сокет для личных сообщений
-            self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.tcp_socket.settimeout(0.5)  # Таймаут для accept
-            self.tcp_socket.bind(('0.0.0.0', self.tcp_port))
-            self.tcp_socket.listen(5)
-            
+            self.network.setup_sockets()
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось инициализировать сокеты: {e}")
             sys.exit(1)
@@ -81,7 +121,7 @@ class P2PChatGUI:
         info_frame = ttk.Frame(main_frame)
         info_frame.grid(row=0, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(0, 10))
         
-        ttk.Label(info_frame, text=f"Ваш IP: {self.username}", 
+        ttk.Label(info_frame, text=f"Вы: {self.display_name} ({self.username})", 
                  font=('Arial', 10, 'bold')).pack(side=tk.LEFT)
         
         ttk.Button(info_frame, text="Обновить", 
@@ -99,7 +139,7 @@ class P2PChatGUI:
         users_frame.columnconfigure(0, weight=1)
         users_frame.rowconfigure(0, weight=1)
         
-        self.users_listbox = tk.Listbox(users_frame, height=15)
+        self.users_listbox = tk.Listbox(users_frame, height=15, exportselection=False)
         self.users_listbox.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         
         scrollbar_users = ttk.Scrollbar(users_frame, orient=tk.VERTICAL, command=self.users_listbox.yview)
@@ -113,6 +153,27 @@ class P2PChatGUI:
         ttk.Button(users_buttons_frame, text="Личное сообщение",
                   command=self.send_private_from_list).pack(side=tk.LEFT, fill=tk.X, expand=True)
         
+        # Групповые чаты: у каждого свой multicast-адрес
+        groups_frame = ttk.LabelFrame(users_frame, text="Группы", padding="5")
+        groups_frame.grid(row=2, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(10, 0))
+        groups_frame.columnconfigure(0, weight=1)
+        
+        self.groups_listbox = tk.Listbox(groups_frame, height=5, exportselection=False)
+        self.groups_listbox.grid(row=0, column=0, columnspan=3, sticky=(tk.W, tk.E))
+        self.groups_listbox.insert(tk.END, self.MAIN_CHAT_LABEL)
+        self.groups_listbox.selection_set(0)
+        
+        self.group_entry = ttk.Entry(groups_frame, width=12)
+        self.group_entry.grid(row=1, column=0, sticky=(tk.W, tk.E), pady=(5, 0))
+        self.group_entry.bind('<Return>', lambda e: self.join_group())
+        ttk.Button(groups_frame, text="Вступить",
+                  command=self.join_group).grid(row=1, column=1, pady=(5, 0))
+        ttk.Button(groups_frame, text="Выйти",
+                  command=self.leave_group).grid(row=1, column=2, pady=(5, 0))
+        ttk.Button(groups_frame, text="Пригласить выбранного",
+                  command=self.invite_to_group).grid(row=2, column=0, columnspan=3,
+                                                     sticky=(tk.W, tk.E), pady=(5, 0))
+        
         # Область чата
         chat_frame = ttk.LabelFrame(content_frame, text="Чат", padding="5")
         chat_frame.grid(row=0, column=1, sticky=(tk.W, tk.E, tk.N, tk.S))
@@ -122,6 +183,20 @@ class P2PChatGUI:
         self.chat_text = scrolledtext.ScrolledText(chat_frame, height=20, width=60, state=tk.DISABLED)
         self.chat_text.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         
+        history_frame = ttk.Frame(chat_frame)
+        history_frame.grid(row=1, column=0, sticky=(tk.W, tk.E), pady=(5, 0))
+        history_frame.columnconfigure(1, weight=1)
+        
+        ttk.Button(history_frame, text="Ранее",
+                  command=self.load_older_messages).grid(row=0, column=0, sticky=tk.W)
+        
+        self.search_entry = ttk.Entry(history_frame)
+        self.search_entry.grid(row=0, column=1, sticky=(tk.W, tk.E), padx=(10, 5))
+        self.search_entry.bind('<Return>', lambda e: self.search_history())
+        
+        ttk.Button(history_frame, text="Найти",
+                  command=self.search_history).grid(row=0, column=2)
+        
         # Фрейм ввода сообщения
         input_frame = ttk.Frame(main_frame)
         input_frame.grid(row=2, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(10, 0))
@@ -156,34 +231,18 @@ class P2PChatGUI:
         # Обновление списка пользователей
         self.update_users_list()
         
-    def send_heartbeat(self):
-        """Регулярная отправка heartbeat для поддержания соединения"""
-        while self.running:
-            try:
-                self.broadcast_online()
-                time.sleep(self.HEARTBEAT_INTERVAL)
-            except Exception as e:
-                print(f"Ошибка heartbeat: {e}")
-                
-    def start_heartbeat(self):
-        """Запуск потока heartbeat"""
-        heartbeat_thread = threading.Thread(target=self.send_heartbeat)
-        heartbeat_thread.daemon = True
-        heartbeat_thread.start()
-        
     def send_private_from_list(self):
         """Отправка личного сообщения выбранному пользователю"""
         selection = self.users_listbox.curselection()
         if selection:
-            user_data = self.users_listbox.get(selection[0])
-            if "(Вы)" in user_data:
+            target_ip = self.selected_user()
+            if target_ip is None:
                 messagebox.showwarning("Предупреждение", "Нельзя отправить сообщение самому себе")
                 return
                 
-            target_ip = user_data.split(" ")[0]  # Извлекаем IP из строки
             self.message_type.set("private")
             self.message_entry.focus()
-            self.status_var.set(f"Режим личного сообщения для {target_ip}")
+            self.status_var.set(f"Режим личного сообщения для {self.network.directory.label(target_ip)}")
         
     def send_message(self):
         """Отправка сообщения"""
@@ -198,11 +257,13 @@ class P2PChatGUI:
         else:
             selection = self.users_listbox.curselection()
             if selection:
-                user_data = self.users_listbox.get(selection[0])
-                if "(Вы)" not in user_data:
-                    target_ip = user_data.split(" ")[0]
-                    self.send_private_message(target_ip, message)
-                    self.add_message_to_chat(f"Вы -> {target_ip}: {message}", "own_private")
+                target_ip = self.selected_user()
+                if target_ip is not None:
+                    message_id = self.send_private_message(target_ip, message)
+                    self.add_message_to_chat(f"Вы -> {self.network.directory.label(target_ip)}: {message}",
+                                             "own_private", target_ip,
+                                             delivery_id=message_id)
+                    self.flush_chat()
                 else:
                     messagebox.showwarning("Предупреждение", "Нельзя отправить сообщение самому себе")
                     return
@@ -211,213 +272,363 @@ class P2PChatGUI:
                 return
                 
         self.message_entry.delete(0, tk.END)
+        self.expedite_poll()
         
-    def send_group_message(self, message):
-        """Отправка сообщения в групповой чат"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        data = {
-            'type': 'group_message',
-            'username': self.username,
-            'message': message,
-            'timestamp': timestamp
-        }
+    def selected_user(self):
+        """Собеседник, выбранный в списке, по позиции; None - не выбран или это вы"""
+        selection = self.users_listbox.curselection()
+        if not selection or selection[0] == 0:
+            return None
+        return self.listed_users[selection[0] - 1]
         
+    def send_group_message(self, message):
+        """Отправка сообщения в выбранный чат: общий или групповой"""
+        self.network.send_group_message(message, self.selected_group())
+        
+    def selected_group(self):
+        """Выбранный групповой чат или None для общего"""
+        selection = self.groups_listbox.curselection()
+        if not selection or selection[0] == 0:
+            return None
+        return self.joined_groups[selection[0] - 1]
+        
+    def join_group(self, name=None):
+        """Вступление в групповой чат по имени из поля ввода"""
+        name = name or self.group_entry.get().strip()
+        if not name:
+            return
+        self.network.join_group(name)
+        self.group_entry.delete(0, tk.END)
+        
+    def leave_group(self):
+        """Выход из выбранного группового чата"""
+        group = self.selected_group()
+        if group is None:
+            self.status_var.set("Из общего чата выйти нельзя")
+            return
+        self.network.leave_group(group)
+        
+    def invite_to_group(self):
+        """Приглашение выбранного пользователя в выбранный групповой чат"""
+        group = self.selected_group()
+        target_ip = self.selected_user()
+        if group is None or target_ip is None:
+            self.status_var.set("Выберите группу и пользователя для приглашения")
+            return
+        self.network.invite(target_ip, group)
+        
+    def update_groups(self, names):
+        """Обновление списка групп после вступления или выхода"""
+        selected = self.selected_group()
+        self.joined_groups = list(names)
+        self.groups_listbox.delete(1, tk.END)
+        for name in self.joined_groups:
+            self.groups_listbox.insert(tk.END, name)
+        index = self.joined_groups.index(selected) + 1 if selected in self.joined_groups else 0
+        self.groups_listbox.selection_set(index)
         try:
-            json_data = json.dumps(data).encode('utf-8')
-            self.multicast_socket.sendto(json_data, (self.multicast_group, self.multicast_port))
-        except Exception as e:
-            self.status_var.set(f"Ошибка отправки: {e}")
+            groups.save_groups(self.joined_groups)
+        except OSError as e:
+            print(f"Не удалось сохранить список групп: {e}")
             
     def send_private_message(self, target_ip, message):
-        """Отправка личного сообщения"""
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.settimeout(5)
-                sock.connect((target_ip, self.tcp_port))
-                
-                data = {
-                    'type': 'private_message',
-                    'from': self.username,
-                    'message': message,
-                    'timestamp': datetime.now().strftime("%H:%M:%S")
-                }
-                
-                json_data = json.dumps(data).encode('utf-8')
-                sock.send(json_data)
-                self.status_var.set(f"Личное сообщение отправлено {target_ip}")
-                
-        except Exception as e:
-            self.status_var.set(f"Ошибка отправки: {e}")
-            messagebox.showerror("Ошибка", f"Не удалось отправить сообщение {target_ip}: {e}")
+        """Постановка личного сообщения в очередь (состояние придёт событиями из сети)"""
+        return self.network.send_private_message(target_ip, message)
+        
+    def broadcast_online(self):
+        """Рассылка информации о том, что пользователь онлайн, с запросом дайджеста"""
+        self.network.broadcast_online(hello=True)
             
-    def handle_private_connection(self, client_socket, address):
-        """Обработка входящих личных сообщений"""
+    def process_network_events(self):
+        """Разбор очереди событий сетевого ядра в потоке Tk"""
+        if self.last_poll is not None:
+            POLL_LAG.observe(max(0.0, time.monotonic() - self.last_poll - self.poll_interval / 1000))
+        
+        processed = 0
         try:
-            data = client_socket.recv(1024).decode('utf-8')
-            if data:
-                message_data = json.loads(data)
-                if message_data['type'] == 'private_message':
-                    self.add_message_to_chat(
-                        f"{message_data['from']} (личное): {message_data['message']}", 
-                        "private"
-                    )
-                    self.status_var.set(f"Новое личное сообщение от {message_data['from']}")
+            while True:
+                try:
+                    event_type, data = self.network.events.get_nowait()
+                except queue.Empty:
+                    break
+                processed += 1
+                try:
+                    self.handle_network_event(event_type, data)
+                except Exception as e:
+                    # Одно испорченное событие не должно останавливать опрос
+                    print(f"Ошибка обработки события {event_type}: {e}")
                     
-        except Exception as e:
-            print(f"Ошибка при обработке личного сообщения: {e}")
+            EVENTS_PER_POLL.observe(processed)
+            self.flush_chat()
         finally:
-            client_socket.close()
+            # Пока очередь пуста, опрос реже (вдвое за раз), первое же событие
+            # возвращает частый опрос: простаивающий чат не будит процесс 20 раз в секунду
+            if processed:
+                self.poll_interval = self.EVENT_POLL_INTERVAL
+            else:
+                self.poll_interval = min(self.poll_interval * 2, self.IDLE_POLL_INTERVAL)
+            self.schedule_poll()
+            
+    def schedule_poll(self):
+        """Следующий опрос очереди событий через текущий интервал"""
+        self.poll_job = None
+        if self.network.running:
+            self.last_poll = time.monotonic()
+            self.poll_job = self.root.after(self.poll_interval, self.process_network_events)
+            
+    def expedite_poll(self):
+        """Частый опрос сразу: после отправки ждём эхо и подтверждения"""
+        if self.poll_job is not None and self.poll_interval > self.EVENT_POLL_INTERVAL:
+            self.root.after_cancel(self.poll_job)
+            self.poll_interval = self.EVENT_POLL_INTERVAL
+            self.schedule_poll()
+            
+    def handle_network_event(self, event_type, data):
+        """Одно событие сетевого ядра"""
+        if event_type == 'group_message':
+            group = data.get('group')
+            # Имя берётся из справочника, без обращения к DNS
+            sender = self.network.directory.label(data['username'])
+            if group is None:
+                self.add_message_to_chat(f"{sender}: {data['message']}", "group")
+            else:
+                self.add_message_to_chat(f"[{group}] {sender}: {data['message']}",
+                                         "group", f"group:{group}")
+        elif event_type == 'private_message':
+            sender = self.network.directory.label(data['from'])
+            self.add_message_to_chat(f"{sender} (личное): {data['message']}", "private", data['from'])
+            self.status_var.set(f"Новое личное сообщение от {sender}")
+        elif event_type == 'delivery':
+            self.update_delivery(data)
+        elif event_type == 'groups':
+            self.update_groups(data)
+        elif event_type == 'group_invite':
+            # Без модального окна: поток приглашений не должен блокировать чат
+            sender = self.network.directory.label(data['from'])
+            self.add_system_message(f"{sender} приглашает вас в группу {data['group']}. "
+                                    f"Имя группы подставлено в поле, нажмите «Вступить»")
+            self.group_entry.delete(0, tk.END)
+            self.group_entry.insert(0, data['group'])
+        elif event_type == 'presence':
+            self.apply_presence_deltas(data)
+        elif event_type == 'peer':
+            self.update_user_label(data)
+        elif event_type == 'peer_moved':
+            # peer_id не защищён: адрес мог объявить кто угодно, решает пользователь
+            if messagebox.askyesno("Новый адрес",
+                                   f"{self.network.directory.label(data['new'])} объявил тот же id, "
+                                   f"что и {data['old']}. Переслать на новый адрес "
+                                   f"неотправленные сообщения ({data['pending']})?"):
+                self.network.follow_peer(data['old'], data['new'])
+        elif event_type == 'suppressed':
+            # Шумный отправитель - одна строка на сводку, а не строка на пакет
+            for sender, count in sorted(data.items()):
+                self.add_system_message(f"{sender} пишет слишком часто, скрыто сообщений: {count}")
+        elif event_type == 'system':
+            self.add_system_message(data)
+        elif event_type == 'status':
+            self.status_var.set(data)
             
-    def listen_private_messages(self):
-        """Прослушивание входящих личных сообщений с улучшенной стабильностью"""
-        while self.running:
-            try:
-                client_socket, address = self.tcp_socket.accept()
-                thread = threading.Thread(target=self.handle_private_connection, args=(client_socket, address))
-                thread.daemon = True
-                thread.start()
-            except socket.timeout:
-                continue
-            except Exception as e:
-                if self.running:  # Только если не завершаем работу
-                    print(f"Ошибка accept: {e}")
-                time.sleep(1)
-                
-    def listen_group_messages(self):
-        """Прослушивание групповых сообщений с улучшенной стабильностью"""
-        while self.running:
-            try:
-                data, address = self.udp_socket.recvfrom(1024)
-                message_data = json.loads(data.decode('utf-8'))
-                
-                if message_data['type'] == 'group_message':
-                    # Обновляем список известных пользователей
-                    if address[0] != self.username:
-                        self.update_user_status(address[0], 'online')
-                    
-                    self.add_message_to_chat(
-                        f"{message_data['username']}: {message_data['message']}", 
-                        "group"
-                    )
-                    
-                elif message_data['type'] == 'user_online':
-                    if address[0] != self.username:
-                        was_online = address[0] in self.known_users
-                        self.update_user_status(address[0], 'online')
-                        
-                        if not was_online:
-                            self.add_system_message(f"Пользователь {address[0]} в сети")
-                        
-            except socket.timeout:
-                continue
-            except Exception as e:
-                if self.running:  # Только если не завершаем работу
-                    print(f"Ошибка приема multicast: {e}")
-                    
-    def update_user_status(self, user_ip, status):
-        """Обновление статуса пользователя"""
-        current_time = time.time()
-        self.known_users[user_ip] = {
-            'last_seen': current_time,
-            'status': status
-        }
-        self.update_users_list()
         
-    def add_message_to_chat(self, message, message_type):
-        """Добавление сообщения в чат"""
-        self.chat_text.config(state=tk.NORMAL)
+    def open_history(self):
+        """Открытие локальной истории; без неё чат работает, но ничего не помнит"""
+        try:
+            return MessageHistory()
+        except OSError as e:
+            print(f"История сообщений недоступна: {e}")
+            return None
+            
+    def load_recent_history(self):
+        """Показ при запуске только последнего экрана сообщений из истории"""
+        if self.history is None:
+            return
+        self.shown_start, records = self.history.page(ALL, count=self.STARTUP_HISTORY)
+        self.insert_history_records("1.0", records)
+        self.chat_text.see(tk.END)
         
+    def insert_history_records(self, index, records):
+        """Вставка записей истории в окно чата одной операцией"""
+        insert_args = []
+        for record in records:
+            insert_args += [record['text'] + "\n", record['tag']]
+        for record in reversed(records):
+            self.rendered_lines.appendleft(record['text'].count("\n") + 1)
+        if insert_args:
+            self.chat_text.config(state=tk.NORMAL)
+            self.chat_text.insert(index, *insert_args)
+            self.chat_text.config(state=tk.DISABLED)
+        
+    def add_message_to_chat(self, message, message_type, conversation=None, delivery_id=None):
+        """Добавление сообщения в очередь отрисовки (можно вызывать из любого потока).
+
+        conversation - беседа для истории: 'group', IP собеседника или 'system'.
+        delivery_id - id личного сообщения, рядом с которым показывается состояние доставки.
+        """
+        if conversation is None:
+            conversation = "system" if message_type == "system" else "group"
+            
         # Добавляем временную метку
         timestamp = datetime.now().strftime("%H:%M:%S")
         formatted_message = f"[{timestamp}] {message}"
         
-        self.chat_text.insert(tk.END, formatted_message + "\n", message_type)
-        self.chat_text.see(tk.END)
+        if self.render_queue_since is None:
+            self.render_queue_since = time.monotonic()
+        self.render_queue.append((formatted_message, message_type, conversation, delivery_id))
+        
+    def flush_chat(self):
+        """Отрисовка накопленных сообщений одной вставкой в потоке Tk"""
+        if not self.render_queue:
+            return
+            
+        started = time.monotonic()
+        if self.render_queue_since is not None:
+            RENDER_LAG.observe(started - self.render_queue_since)
+            self.render_queue_since = None
+        batch = []
+        while self.render_queue:
+            batch.append(self.render_queue.popleft())
+            
+        # Автопрокрутка, только если пользователь не листает историю
+        at_bottom = self.chat_text.yview()[1] >= 1.0
+        
+        insert_args = []
+        for text, message_type, conversation, delivery_id in batch:
+            insert_args += [text, message_type]
+            if delivery_id is not None:
+                label = self.DELIVERY_LABELS[outbox.QUEUED]
+                insert_args += [f" ({label})", (message_type, f"delivery-{delivery_id}")]
+            insert_args += ["\n", message_type]
+            self.rendered_lines.append(text.count("\n") + 1)
+            if self.history is not None:
+                self.history.append(conversation, text, message_type)
+            
+        self.chat_text.config(state=tk.NORMAL)
+        self.chat_text.insert(tk.END, *insert_args)
+        
+        # Вытесняем самые старые сообщения сверх лимита. Пока пользователь
+        # читает подгруженную историю, окно может вырасти до четырёх лимитов
+        if at_bottom or len(self.rendered_lines) > self.MAX_SCROLLBACK * 4:
+            evicted_lines = 0
+            while len(self.rendered_lines) > self.MAX_SCROLLBACK:
+                evicted_lines += self.rendered_lines.popleft()
+                self.shown_start += 1
+            if evicted_lines:
+                self.chat_text.delete("1.0", f"{evicted_lines + 1}.0")
+                
+        if at_bottom:
+            self.chat_text.see(tk.END)
         self.chat_text.config(state=tk.DISABLED)
+        FLUSH_TIME.observe(time.monotonic() - started)
+        
+    def update_delivery(self, data):
+        """Замена подписи состояния у отправленного личного сообщения"""
+        self.flush_chat()  # сообщение могло ещё не попасть в окно
+        tag = f"delivery-{data['id']}"
+        ranges = self.chat_text.tag_ranges(tag)
+        if ranges:
+            label = self.DELIVERY_LABELS[data['state']].format(delay=data.get('delay', 0))
+            self.chat_text.config(state=tk.NORMAL)
+            self.chat_text.delete(ranges[0], ranges[1])
+            self.chat_text.insert(ranges[0], f" ({label})", ("own_private", tag))
+            self.chat_text.config(state=tk.DISABLED)
+        if data['state'] in (outbox.DELIVERED, outbox.FAILED):
+            self.chat_text.tag_delete(tag)  # финальное состояние, тег больше не нужен
+            
+    def load_older_messages(self):
+        """Подгрузка из истории страницы сообщений, предшествующих окну чата"""
+        if self.history is None or self.shown_start <= 0:
+            self.status_var.set("Более ранних сообщений нет")
+            return
+            
+        self.shown_start, records = self.history.page(ALL, end=self.shown_start, count=self.HISTORY_PAGE)
+        self.insert_history_records("1.0", records)
+        self.chat_text.see("1.0")
+        
+    def search_history(self):
+        """Поиск по всей локальной истории с выводом в отдельном окне"""
+        query = self.search_entry.get().strip()
+        if not query:
+            return
+        if self.history is None:
+            self.status_var.set("История сообщений недоступна")
+            return
+            
+        if not self.history.index_ready.is_set():
+            self.status_var.set("Индекс поиска ещё строится, попробуйте чуть позже")
+            return
+            
+        self.flush_chat()
+        results = self.history.search(query)
+        
+        window = tk.Toplevel(self.root)
+        window.title(f"Поиск: {query}")
+        results_text = scrolledtext.ScrolledText(window, height=20, width=80)
+        results_text.pack(fill=tk.BOTH, expand=True)
+        for record in reversed(results):
+            results_text.insert(tk.END, f"({record['conversation']}) {record['text']}\n")
+        if not results:
+            results_text.insert(tk.END, "Ничего не найдено\n")
+        results_text.config(state=tk.DISABLED)
+        self.status_var.set(f"Найдено сообщений: {len(results)}")
         
     def add_system_message(self, message):
         """Добавление системного сообщения"""
         self.add_message_to_chat(f"[Система] {message}", "system")
-        
-    def broadcast_online(self):
-        """Рассылка информации о том, что пользователь онлайн"""
-        data = {
-            'type': 'user_online',
-            'username': self.username
-        }
-        try:
-            json_data = json.dumps(data).encode('utf-8')
-            self.multicast_socket.sendto(json_data, (self.multicast_group, self.multicast_port))
-        except Exception as e:
-            self.status_var.set(f"Ошибка отправки онлайн-статуса: {e}")
             
     def update_users_list(self):
-        """Обновление списка пользователей"""
+        """Полное перестроение списка пользователей (только при запуске)"""
         self.users_listbox.delete(0, tk.END)
         self.users_listbox.insert(tk.END, f"{self.username} (Вы)")
         
-        current_time = time.time()
-        online_users = []
-        
-        for user_ip, user_data in self.known_users.items():
-            if current_time - user_data['last_seen'] <= self.USER_TIMEOUT:
-                online_users.append(user_ip)
-            else:
-                # Помечаем как отключившегося
-                if user_data['status'] == 'online':
-                    self.known_users[user_ip]['status'] = 'offline'
-                    self.add_system_message(f"Пользователь {user_ip} отключился")
-        
-        # Сортируем и добавляем онлайн пользователей
-        for user_ip in sorted(online_users):
-            self.users_listbox.insert(tk.END, f"{user_ip}")
+        self.listed_users = self.network.presence.online()
+        for user_ip in self.listed_users:
+            self.users_listbox.insert(tk.END, self.network.directory.label(user_ip))
             
-    def cleanup_old_users(self):
-        """Очистка старых пользователей с улучшенной логикой"""
-        while self.running:
-            time.sleep(self.CLEANUP_INTERVAL)
-            current_time = time.time()
-            users_to_remove = []
+    def apply_presence_deltas(self, deltas):
+        """Точечное обновление списка пользователей по изменениям присутствия"""
+        for kind, user_ip in deltas:
+            # Позиция 0 в списке занята строкой "(Вы)"
+            index = bisect.bisect_left(self.listed_users, user_ip)
+            is_listed = index < len(self.listed_users) and self.listed_users[index] == user_ip
             
-            for user_ip, user_data in self.known_users.items():
-                if current_time - user_data['last_seen'] > self.USER_TIMEOUT * 2:  # Удаляем через 2 таймаута
-                    users_to_remove.append(user_ip)
-                    
-            for user_ip in users_to_remove:
-                del self.known_users[user_ip]
-                self.update_users_list()
+            if kind == presence.JOIN and not is_listed:
+                self.listed_users.insert(index, user_ip)
+                self.users_listbox.insert(index + 1, self.network.directory.label(user_ip))
+                self.add_system_message(f"Пользователь {self.network.directory.label(user_ip)} в сети")
+            elif kind == presence.LEAVE and is_listed:
+                del self.listed_users[index]
+                self.users_listbox.delete(index + 1)
+                self.add_system_message(f"Пользователь {self.network.directory.label(user_ip)} отключился")
+                
+    def update_user_label(self, user_ip):
+        """Собеседник объявил имя или нашёлся в DNS: меняем только его строку"""
+        index = bisect.bisect_left(self.listed_users, user_ip)
+        if index >= len(self.listed_users) or self.listed_users[index] != user_ip:
+            return
+        selected = self.users_listbox.selection_includes(index + 1)
+        self.users_listbox.delete(index + 1)
+        self.users_listbox.insert(index + 1, self.network.directory.label(user_ip))
+        if selected:
+            self.users_listbox.selection_set(index + 1)
                 
     def start_listeners(self):
-        """Запуск потоков прослушивания"""
-        # Поток для групповых сообщений
-        group_thread = threading.Thread(target=self.listen_group_messages)
-        group_thread.daemon = True
-        group_thread.start()
-        
-        # Поток для личных сообщений
-        private_thread = threading.Thread(target=self.listen_private_messages)
-        private_thread.daemon = True
-        private_thread.start()
-        
-        # Поток для очистки старых пользователей
-        cleanup_thread = threading.Thread(target=self.cleanup_old_users)
-        cleanup_thread.daemon = True
-        cleanup_thread.start()
+        """Запуск сетевого ядра и опроса его очереди событий"""
+        self.network.start()
+        for name in groups.load_groups():
+            self.network.join_group(name)
+        self.schedule_poll()
         
     def on_closing(self):
         """Действия при закрытии окна"""
         self.running = False
-        time.sleep(0.5)  # Даем время потокам завершиться
-        
-        try:
-            self.udp_socket.close()
-            self.multicast_socket.close()
-            self.tcp_socket.close()
-        except:
-            pass
+        self.network.stop()
+        if self.history is not None:
+            self.flush_chat()
+            self.history.close()
         self.root.destroy()
 
 def main():
+    metrics.configure_from_env()
     root = tk.Tk()
     app = P2PChatGUI(root)
     
@@ -0,0 +1,298 @@
+"""Встроенные метрики: счётчики, гистограммы, датчики и профилировщик.
+
+Метрики создаются один раз на уровне модуля и обновляются на горячем пути
+без блокировок: ``inc`` и ``observe`` - пара операций над числами, под GIL
+этого достаточно для статистики. Снимок всех метрик отдаётся в JSON через
+локальный сокет (только 127.0.0.1) или периодически пишется в файл.
+
+Включается переменными окружения (``configure_from_env``):
+
+- ``LOCALCHAT_STATS_PORT`` - порт сокета статистики: ``nc 127.0.0.1 ПОРТ``
+- ``LOCALCHAT_STATS_DUMP`` - файл, куда раз в ``LOCALCHAT_STATS_DUMP_INTERVAL`` с пишется снимок
+- ``LOCALCHAT_PROFILE=1`` - выборочный профилировщик стеков всех потоков
+"""
+import bisect
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from collections import Counter as _StackCounter
+
+
+# Границы корзин гистограмм по умолчанию: от 0.1 мс до ~3.5 минут, шаг x2
+LATENCY_BUCKETS = tuple(0.0001 * 2 ** i for i in range(22))
+SIZE_BUCKETS = tuple(2 ** i for i in range(16))
+
+
+class Counter:
+    """Монотонный счётчик; ``labels`` даёт дочерний счётчик, например по типу пакета"""
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._children = {}
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def labels(self, label):
+        child = self._children.get(label)
+        if child is None:
+            child = self._children.setdefault(label, Counter(f"{self.name}.{label}"))
+        return child
+
+    def snapshot(self):
+        # Копия: сетевой поток может добавить метку, пока идёт снимок
+        children = self._children.copy()
+        if not children:
+            return self.value
+        return {'total': self.value + sum(child.value for child in children.values()),
+                **{label: child.snapshot() for label, child in children.items()}}
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами; перцентили оцениваются по границам"""
+
+    def __init__(self, name, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя - всё, что выше границ
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def time(self):
+        """Контекстный менеджер: замер длительности блока в секундах"""
+        return _Timer(self)
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                # Верхняя граница корзины, но не больше наблюдавшегося максимума
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max if self.count else None,
+        }
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Gauge:
+    """Текущее значение: задаётся ``set`` или вычисляется функцией при снимке"""
+
+    def __init__(self, name, function=None):
+        self.name = name
+        self.function = function
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception as e:
+                return f"ошибка: {e}"
+        return self.value
+
+
+class Registry:
+    """Реестр метрик процесса"""
+
+    def __init__(self):
+        self.metrics = {}
+        self.started = time.time()
+        self.profiler = None
+        self._lock = threading.Lock()
+
+    def _get(self, name, factory):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.setdefault(name, factory())
+        return metric
+
+    def counter(self, name):
+        return self._get(name, lambda: Counter(name))
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS):
+        return self._get(name, lambda: Histogram(name, buckets))
+
+    def gauge(self, name, function=None):
+        gauge = self._get(name, lambda: Gauge(name, function))
+        if function is not None:
+            gauge.function = function  # последний зарегистрированный источник
+        return gauge
+
+    def snapshot(self):
+        with self._lock:
+            items = sorted(self.metrics.items())
+        result = {
+            'pid': os.getpid(),
+            'uptime_s': round(time.time() - self.started, 1),
+            'metrics': {name: metric.snapshot() for name, metric in items},
+        }
+        if self.profiler is not None:
+            result['profile'] = self.profiler.top()
+        return result
+
+    def dump(self, path):
+        """Запись снимка в файл через временный, чтобы читатель не увидел половину"""
+        temporary = f"{path}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as output:
+            json.dump(self.snapshot(), output, indent=2, ensure_ascii=False, default=str)
+        os.replace(temporary, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Сокет статистики: на каждое подключение - снимок в JSON и закрытие"""
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(8)
+
+        def accept_loop():
+            while True:
+                connection, _ = server.accept()
+                try:
+                    payload = json.dumps(self.snapshot(), indent=2, ensure_ascii=False, default=str)
+                    connection.sendall(payload.encode('utf-8') + b"\n")
+                except OSError:
+                    pass
+                except Exception as e:
+                    # Ошибка одного снимка не должна останавливать сокет статистики
+                    print(f"Ошибка снимка статистики: {e}")
+                finally:
+                    connection.close()
+
+        threading.Thread(target=accept_loop, daemon=True, name="stats-socket").start()
+        return server
+
+    def dump_periodically(self, path, interval=10):
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(path)
+                except OSError as e:
+                    print(f"Не удалось записать статистику в {path}: {e}")
+
+        threading.Thread(target=dump_loop, daemon=True, name="stats-dump").start()
+
+    def start_profiler(self, interval=0.01):
+        if self.profiler is None:
+            self.profiler = SamplingProfiler(interval)
+            self.profiler.start()
+        return self.profiler
+
+
+class SamplingProfiler:
+    """Выборочный профилировщик: раз в ``interval`` снимает стеки всех потоков.
+
+    Накладные расходы не зависят от частоты вызовов в программе, поэтому его
+    можно держать включённым на живом клиенте. ``top`` - самые частые стеки,
+    ``write_folded`` - файл для flamegraph.pl / speedscope.
+    """
+
+    def __init__(self, interval=0.01, max_depth=30):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = _StackCounter()
+        self.total = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="profiler")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+                self.total += 1
+
+    def _samples_copy(self):
+        """Копия выборок: поток профилировщика пополняет их одновременно с чтением"""
+        return _StackCounter(dict.copy(self.samples))
+
+    def top(self, limit=20):
+        samples = self._samples_copy()
+        total = sum(samples.values())
+        return [{'stack': stack, 'share': round(count / total, 4)}
+                for stack, count in samples.most_common(limit)] if total else []
+
+    def write_folded(self, path):
+        with open(path, 'w', encoding='utf-8') as output:
+            for stack, count in self._samples_copy().items():
+                output.write(f"{stack} {count}\n")
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+gauge = REGISTRY.gauge
+
+
+def configure_from_env(default_port=None):
+    """Включение сокета, файла статистики и профилировщика по переменным окружения"""
+    port = os.environ.get('LOCALCHAT_STATS_PORT') or default_port
+    if port:
+        try:
+            REGISTRY.serve(int(port))
+        except OSError as e:
+            print(f"Сокет статистики на порту {port} не открыт: {e}")
+    dump_path = os.environ.get('LOCALCHAT_STATS_DUMP')
+    if dump_path:
+        REGISTRY.dump_periodically(dump_path, float(os.environ.get('LOCALCHAT_STATS_DUMP_INTERVAL', 10)))
+    if os.environ.get('LOCALCHAT_PROFILE') == '1':
+        REGISTRY.start_profiler()
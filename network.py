@@ -0,0 +1,981 @@
+import asyncio
+from collections import OrderedDict
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+from datetime import datetime
+
+import groups
+import metrics
+import outbox
+import peers
+import presence
+import protocol
+import ratelimit
+import reliable
+
+
+FRAME_HEADER = struct.Struct('!I')  # длина кадра, 4 байта big-endian
+MAX_FRAME_SIZE = 1024 * 1024  # защита от мусора и старых клиентов
+
+PACKETS_IN = metrics.counter('net.packets_in')  # по типу сообщения
+PACKETS_OUT = metrics.counter('net.packets_out')
+BYTES_IN = metrics.counter('net.bytes_in')  # group / private
+BYTES_OUT = metrics.counter('net.bytes_out')
+DECODE_ERRORS = metrics.counter('net.decode_errors')
+RECEIVE_ERRORS = metrics.counter('net.receive_errors')
+CONNECT_LATENCY = metrics.histogram('net.tcp_connect_s')
+CONNECT_ERRORS = metrics.counter('net.tcp_connect_errors')
+RETRANSMITS = metrics.counter('net.retransmits')
+NACKS_SENT = metrics.counter('net.nacks_sent')
+RATE_LIMITED = metrics.counter('net.rate_limited')  # packet / group / private
+
+
+def _is_ipv4(value):
+    try:
+        socket.inet_aton(value)
+    except (OSError, TypeError):
+        return False
+    return value.count('.') == 3
+
+
+def _text(value, default=None):
+    """Строковое поле пакета; иное значение или его отсутствие - ``default``"""
+    return value if isinstance(value, str) else default
+
+
+def write_frame(writer, payload):
+    """Запись одного кадра с префиксом длины"""
+    writer.write(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+async def read_frames(reader):
+    """Асинхронный генератор кадров из TCP-потока.
+
+    Старые клиенты присылают один JSON без префикса и закрывают соединение:
+    такой поток узнаётся по первому байту ``{`` и отдаётся целиком.
+    """
+    while True:
+        try:
+            header = await reader.readexactly(FRAME_HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial.startswith(b'{'):
+                yield e.partial
+            return
+
+        if header.startswith(b'{'):
+            yield header + await reader.read(MAX_FRAME_SIZE)
+            return
+
+        (length,) = FRAME_HEADER.unpack(header)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Слишком большой кадр: {length} байт")
+        yield await reader.readexactly(length)
+
+
+class PeerConnectionPool:
+    """Пул долгоживущих TCP-соединений к собеседникам.
+
+    На каждый IP держится одно соединение, по которому кадрами уходят все
+    личные сообщения. Соединения, простаивающие дольше ``idle_timeout``,
+    закрываются задачей ``evict_idle``. Кадры, пришедшие в ответ (например,
+    подтверждения), передаются в ``on_frame(ip, кадр)``. ``resolve(ip)``
+    может вернуть другой адрес ``(хост, порт)`` собеседника; по умолчанию
+    это сам ip и общий ``port``. Работает только внутри цикла asyncio.
+    """
+
+    def __init__(self, port, connect_timeout=5, idle_timeout=120, on_frame=None, resolve=None):
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.on_frame = on_frame
+        self.resolve = resolve
+        self.connections = {}  # ip -> [reader, writer, last_used]
+        self.locks = {}  # ip -> asyncio.Lock, чтобы не открывать два соединения сразу
+
+    async def send(self, target_ip, payload):
+        """Отправка кадра; при обрыве старого соединения одна повторная попытка"""
+        lock = self.locks.setdefault(target_ip, asyncio.Lock())
+        async with lock:
+            for attempt in range(2):
+                reused = target_ip in self.connections
+                writer = await self._get_connection(target_ip)
+                try:
+                    write_frame(writer, payload)
+                    await writer.drain()
+                    self.connections[target_ip][2] = time.monotonic()
+                    return
+                except (ConnectionError, OSError):
+                    self.close(target_ip)
+                    if not reused or attempt:
+                        raise
+
+    async def _get_connection(self, target_ip):
+        connection = self.connections.get(target_ip)
+        if connection is not None:
+            reader, writer, _ = connection
+            if not writer.is_closing() and not reader.at_eof():
+                return writer
+            self.close(target_ip)
+
+        host, port = self.resolve(target_ip) if self.resolve else (target_ip, self.port)
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), timeout=self.connect_timeout)
+        except (OSError, asyncio.TimeoutError):
+            CONNECT_ERRORS.inc()
+            raise
+        CONNECT_LATENCY.observe(time.perf_counter() - started)
+        self.connections[target_ip] = [reader, writer, time.monotonic()]
+        asyncio.get_running_loop().create_task(self._read_replies(target_ip, reader))
+        return writer
+
+    async def _read_replies(self, target_ip, reader):
+        try:
+            async for frame in read_frames(reader):
+                if self.on_frame is not None:
+                    self.on_frame(target_ip, frame)
+        except (ConnectionError, OSError, ValueError, asyncio.IncompleteReadError):
+            pass  # соединение закрыто, следующая отправка откроет новое
+
+    def close(self, target_ip):
+        connection = self.connections.pop(target_ip, None)
+        if connection is not None:
+            connection[1].close()
+
+    def close_all(self):
+        for target_ip in list(self.connections):
+            self.close(target_ip)
+
+    async def evict_idle(self):
+        """Периодическое закрытие простаивающих соединений"""
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            now = time.monotonic()
+            for target_ip, (_, _, last_used) in list(self.connections.items()):
+                if now - last_used > self.idle_timeout:
+                    self.close(target_ip)
+
+
+class _Channel:
+    """Multicast-канал: общий чат (name=None) или групповой чат со своим адресом.
+
+    У каждого канала своя нумерация сообщений и свой буфер повторов:
+    участники группы видят только её сообщения и не должны считать
+    пропуском номера, ушедшие в другие группы.
+    """
+
+    def __init__(self, name, address, port, retransmit_buffer_size):
+        self.name = name
+        self.address = address
+        self.port = port
+        self.socket = None
+        self.transport = None
+        self.next_seq = 0
+        self.retransmit_buffer = reliable.RetransmitBuffer(retransmit_buffer_size)
+
+
+class ChatNetwork:
+    """Сетевое ядро чата без GUI.
+
+    Multicast-приём, TCP-сервер личных сообщений, heartbeat и очистка
+    пользователей работают в одном цикле asyncio в отдельном потоке.
+    Наружу ядро отдаёт только потокобезопасную очередь событий ``events``:
+    элементы очереди - кортежи ``(тип_события, данные)``.
+    """
+
+    def __init__(self, username, multicast_group='224.1.1.1', multicast_port=5007,
+                 tcp_port=5008, multicast_ttl=1, heartbeat_interval=25,
+                 user_timeout=60, cleanup_interval=30, connection_idle_timeout=120,
+                 legacy_json=False, heartbeat_target_rate=2.0, presence_digests=True,
+                 retransmit_buffer_size=1024, outbox_path=outbox.DEFAULT_OUTBOX_PATH,
+                 ack_timeout=30, max_sends=6, receive_buffer=None, packet_rate=200, packet_burst=500,
+                 message_rate=10, message_burst=30, private_rate=10, private_burst=30,
+                 peer_id=None, display_name=None, interface=None, relay_hosts=()):
+        self.username = username
+        self.multicast_group = multicast_group
+        self.multicast_port = multicast_port
+        self.tcp_port = tcp_port
+        self.multicast_ttl = multicast_ttl
+        # IP интерфейса для multicast (например, 127.0.0.1 у стенда); None - выбирает ядро
+        self.interface = interface
+        # Групповые пакеты в JSON - для сети, где ещё остались старые клиенты
+        self.legacy_json = legacy_json
+
+        self.HEARTBEAT_INTERVAL = heartbeat_interval  # минимальный интервал heartbeat
+        self.USER_TIMEOUT = user_timeout
+        # Суммарный поток heartbeat от всей группы, пакетов в секунду: при
+        # большом числе пользователей интервал растёт, а не трафик
+        self.HEARTBEAT_TARGET_RATE = heartbeat_target_rate
+        self.HEARTBEAT_JITTER = 0.2
+        self.DIGEST_MAX_DELAY = 2.0  # секунд случайной задержки ответа дайджестом
+        self.presence_digests = presence_digests
+        self._digest_handle = None
+        self.CLEANUP_INTERVAL = cleanup_interval
+
+        self.presence = presence.PresenceIndex(user_timeout)
+        self.pool = PeerConnectionPool(tcp_port, idle_timeout=connection_idle_timeout,
+                                       on_frame=self.handle_private_reply,
+                                       resolve=self.peer_address)
+        # Адреса TCP-серверов, объявленные в heartbeat: на одном хосте может
+        # работать несколько клиентов на разных портах
+        self.peer_addresses = {}  # пользователь -> (ip, tcp-порт)
+        self.reassembler = protocol.FragmentReassembler()
+        # Постоянный id и имя: их объявляем в heartbeat, чужие - в справочнике
+        self.peer_id = peer_id
+        self.display_name = display_name
+        self.directory = peers.PeerDirectory(on_change=lambda user: self.emit('peer', user))
+
+        # Надёжная доставка групповых сообщений: номера, NACK и повторы
+        self.epoch = random.getrandbits(31)
+        self.receiver = reliable.ReliableReceiver()
+
+        # Общий чат и групповые чаты, каждый на своём multicast-адресе
+        self.retransmit_buffer_size = retransmit_buffer_size
+        self.main_channel = _Channel(None, multicast_group, multicast_port, retransmit_buffer_size)
+        self.channels = {}  # имя группы -> _Channel
+
+        # Личные сообщения уходят через постоянную очередь с подтверждениями
+        self.ACK_TIMEOUT = ack_timeout  # секунд ожидания подтверждения до повтора
+        self.MAX_SENDS = max_sends  # отправок без подтверждения до отказа; ожидание каждый раз вдвое
+        self.outbox = outbox.Outbox(outbox_path)
+        self._delivering = set()  # собеседники, которым сейчас идёт отправка
+        self._offered_moves = set()  # (старый, новый адрес), уже предложенные GUI
+        self._seen_private = OrderedDict()  # id недавно полученных личных сообщений
+        self._seen_invites = OrderedDict()  # (от кого, группа) уже показанных приглашений
+        self.SEEN_PRIVATE_LIMIT = 4096
+
+        # Лимиты на отправителя: пакеты по IP до разбора, сообщения общего
+        # и групповых чатов по отправителю, личные - торможением чтения
+        self.receive_buffer = receive_buffer  # SO_RCVBUF приёмных сокетов, байт
+        self.receive_buffer_size = None  # сколько выделило ядро
+        self.packet_limiter = ratelimit.SenderLimiter(packet_rate, packet_burst) if packet_rate else None
+        self.message_limiter = ratelimit.SenderLimiter(message_rate, message_burst) if message_rate else None
+        self.private_limiter = ratelimit.SenderLimiter(private_rate, private_burst) if private_rate else None
+        # Ретрансляторы приносят трафик целой подсети с одного IP: лимит пакетов
+        # по адресу к ним не применяется, отправителей держит лимит по имени
+        self.relay_hosts = frozenset(relay_hosts)
+        self.SUPPRESSED_REPORT_INTERVAL = 2.0  # секунд между сводками о скрытых сообщениях
+
+        self.events = queue.Queue()
+        self.running = False
+
+        metrics.gauge('net.presence_online', self.presence.online_count)
+        metrics.gauge('net.pool_connections', lambda: len(self.pool.connections))
+        metrics.gauge('net.outbox_pending', self.outbox.pending_count)
+        metrics.gauge('net.group_duplicates', lambda: self.receiver.duplicates)
+        metrics.gauge('net.group_lost', lambda: self.receiver.lost)
+        metrics.gauge('net.events_queue', self.events.qsize)
+        metrics.gauge('net.group_channels', lambda: len(self.channels))
+        metrics.gauge('net.udp_drops', self.udp_drops)
+        metrics.gauge('net.receive_buffer', lambda: self.receive_buffer_size)
+
+        self.loop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._tasks = []
+
+    def setup_sockets(self):
+        """Создание сокетов. Ошибки пробрасываются вызывающему коду"""
+        # Multicast сокет для отправки в групповой чат
+        self.multicast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
+        if self.interface:
+            self.multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                             socket.inet_aton(self.interface))
+        self.multicast_socket.setblocking(False)
+
+        # UDP сокет для приема multicast
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.udp_socket.bind(('', self.multicast_port))
+        self.udp_socket.setblocking(False)
+        self.receive_buffer_size = ratelimit.set_receive_buffer(self.udp_socket, self.receive_buffer)
+
+        # Подписка на multicast группу
+        group = socket.inet_aton(self.multicast_group)
+        mreq = group + socket.inet_aton(self.interface or '0.0.0.0')
+        self.udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+        # TCP сокет для личных сообщений
+        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_socket.bind(('0.0.0.0', self.tcp_port))
+        self.tcp_socket.listen(128)
+        self.tcp_socket.setblocking(False)
+
+    # ------------------------------------------------------------------
+    # Управление циклом событий
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Запуск цикла asyncio в фоновом потоке"""
+        self.running = True
+        self._thread = threading.Thread(target=self._run_loop, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        """Остановка цикла и закрытие сокетов"""
+        if not self.running:
+            return
+        self.running = False
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.broadcast_offline)
+            self.loop.call_soon_threadsafe(self._shutdown)
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+        self.outbox.close()
+        self.directory.close()
+
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._start_services())
+        finally:
+            self._ready.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def _start_services(self):
+        self._presence_wakeup = asyncio.Event()
+        self._repair_wakeup = asyncio.Event()
+        self._outbox_wakeup = asyncio.Event()
+        self.send_transport, _ = await self.loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, sock=self.multicast_socket)
+        self.group_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _GroupProtocol(self), sock=self.udp_socket)
+        self.main_channel.socket = self.udp_socket
+        self.main_channel.transport = self.group_transport
+        self.tcp_server = await asyncio.start_server(
+            self.handle_private_connection, sock=self.tcp_socket)
+
+        self._tasks = [
+            self.loop.create_task(self.send_heartbeat()),
+            self.loop.create_task(self.cleanup_old_users()),
+            self.loop.create_task(self.repair_group_messages()),
+            self.loop.create_task(self.deliver_outbox()),
+            self.loop.create_task(self.pool.evict_idle()),
+            self.loop.create_task(self.report_suppressed()),
+        ]
+
+        pending = self.outbox.pending_count()
+        if pending:
+            self.emit('status', f"Неотправленных личных сообщений: {pending}")
+
+    def _shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        self.pool.close_all()
+        for channel in self.channels.values():
+            channel.transport.close()
+        try:
+            self.group_transport.close()
+            self.send_transport.close()
+            self.tcp_server.close()
+        except Exception:
+            pass
+        self.loop.call_later(0.1, self.loop.stop)
+
+    def emit(self, event_type, data=None):
+        """Передача события потребителю (GUI)"""
+        self.events.put((event_type, data))
+
+    # ------------------------------------------------------------------
+    # Отправка (можно вызывать из любого потока)
+    # ------------------------------------------------------------------
+
+    def _sendto_group(self, data, channel=None):
+        channel = channel or self.main_channel
+        try:
+            for datagram in protocol.encode_datagrams(data, legacy=self.legacy_json):
+                self.send_transport.sendto(datagram, (channel.address, channel.port))
+                BYTES_OUT.labels('group').inc(len(datagram))
+            PACKETS_OUT.labels(data['type']).inc()
+        except Exception as e:
+            self.emit('status', f"Ошибка отправки: {e}")
+
+    def send_group_message(self, message, group=None):
+        """Отправка сообщения в общий чат или в групповой чат ``group``"""
+        data = {
+            'type': 'group_message',
+            'username': self.username,
+            'message': message,
+            'timestamp': datetime.now().strftime("%H:%M:%S")
+        }
+        if group is not None:
+            data['group'] = group
+        self.loop.call_soon_threadsafe(self._send_sequenced, data, group)
+
+    def _send_sequenced(self, data, group=None):
+        """Нумерация и отправка группового сообщения с сохранением для повтора"""
+        channel = self.main_channel if group is None else self.channels.get(group)
+        if channel is None:
+            self.emit('status', f"Вы не состоите в группе {group}")
+            return
+        data['epoch'] = self.epoch
+        data['seq'] = channel.next_seq
+        channel.retransmit_buffer.add(channel.next_seq, data)
+        channel.next_seq += 1
+        self._sendto_group(data, channel)
+
+    def broadcast_online(self, hello=False):
+        """Рассылка информации о том, что пользователь онлайн"""
+        data = {
+            'type': 'user_online',
+            'username': self.username,
+            'interval': round(self.heartbeat_interval()),
+            'tcp_port': self.tcp_port
+        }
+        if self.peer_id:
+            data['peer_id'] = self.peer_id
+        if self.display_name:
+            data['name'] = self.display_name
+        if self.main_channel.next_seq:
+            # Номер последнего сообщения: по нему соседи замечают потерю хвоста
+            data['epoch'] = self.epoch
+            data['last_seq'] = self.main_channel.next_seq - 1
+        if hello:
+            # Первый heartbeat: просим соседей прислать дайджест присутствия
+            data['hello'] = True
+        self.loop.call_soon_threadsafe(self._sendto_group, data)
+
+    def broadcast_offline(self):
+        """Явное сообщение об уходе, чтобы соседи не ждали USER_TIMEOUT"""
+        self._sendto_group({'type': 'user_offline', 'username': self.username})
+
+    # ------------------------------------------------------------------
+    # Групповые чаты
+    # ------------------------------------------------------------------
+
+    def join_group(self, name):
+        """Вступление в групповой чат; возвращает future с True при успехе"""
+        return asyncio.run_coroutine_threadsafe(self._join_group(name), self.loop)
+
+    async def _join_group(self, name):
+        if name in self.channels:
+            return True
+        if not groups.valid_name(name):
+            self.emit('status', f"Недопустимое имя группы: {name!r}")
+            return False
+        address, port = groups.channel_address(name, self.multicast_port)
+        try:
+            sock = groups.open_channel_socket(address, port, self.interface or '0.0.0.0')
+        except OSError as e:
+            self.emit('status', f"Не удалось вступить в группу {name}: {e}")
+            return False
+        ratelimit.set_receive_buffer(sock, self.receive_buffer)
+        channel = _Channel(name, address, port, self.retransmit_buffer_size)
+        channel.socket = sock
+        channel.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _GroupProtocol(self, name), sock=sock)
+        self.channels[name] = channel
+        self.emit('groups', sorted(self.channels))
+        return True
+
+    def leave_group(self, name):
+        """Выход из группового чата: IP_DROP_MEMBERSHIP и закрытие сокета"""
+        self.loop.call_soon_threadsafe(self._leave_group, name)
+
+    def _leave_group(self, name):
+        channel = self.channels.pop(name, None)
+        if channel is None:
+            return
+        groups.drop_membership(channel.socket, channel.address, self.interface or '0.0.0.0')
+        channel.transport.close()
+        self.receiver.forget_group(name)
+        self.emit('groups', sorted(self.channels))
+
+    def invite(self, target_ip, group):
+        """Приглашение собеседника в групповой чат личным кадром"""
+        return asyncio.run_coroutine_threadsafe(self._invite(target_ip, group), self.loop)
+
+    async def _invite(self, target_ip, group):
+        data = {'type': 'group_invite', 'from': self.username, 'group': group}
+        try:
+            await self.pool.send(target_ip, protocol.encode(data))
+            self.emit('status', f"{target_ip} приглашён в группу {group}")
+        except Exception as e:
+            self.emit('status', f"Не удалось пригласить {target_ip}: {e}")
+
+    def heartbeat_interval(self):
+        """Текущий интервал heartbeat с учётом размера группы"""
+        return presence.adaptive_interval(
+            self.HEARTBEAT_INTERVAL, self.presence.online_count() + 1, self.HEARTBEAT_TARGET_RATE)
+
+    def send_private_message(self, target_ip, message):
+        """Постановка личного сообщения в очередь; возвращает его id.
+
+        Вызывающий поток не ждёт сети: о судьбе сообщения сообщают события
+        ``delivery`` с состояниями из модуля ``outbox``.
+        """
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        message_id = self.outbox.add(target_ip, message, timestamp)
+        self.loop.call_soon_threadsafe(self._outbox_wakeup.set)
+        return message_id
+
+    async def deliver_outbox(self):
+        """Отправка созревших сообщений очереди: каждому собеседнику своей задачей"""
+        while self.running:
+            self._outbox_wakeup.clear()
+            by_target = {}
+            for record in self.outbox.due():
+                if record['target'] not in self._delivering:
+                    by_target.setdefault(record['target'], []).append(record)
+            for target_ip, records in by_target.items():
+                self._delivering.add(target_ip)
+                self.loop.create_task(self._deliver_to(target_ip, records))
+
+            # Созревшие записи, которые сейчас уже отправляются, разбудят
+            # цикл по окончании отправки
+            delay = self.CLEANUP_INTERVAL
+            next_due = self.outbox.next_due()
+            if next_due is not None and next_due > time.time():
+                delay = min(delay, next_due - time.time())
+            try:
+                await asyncio.wait_for(self._outbox_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver_to(self, target_ip, records):
+        """Отправка по порядку; при ошибке откладываем все оставшиеся сообщения"""
+        try:
+            for index, record in enumerate(records):
+                if record['sends'] >= self.MAX_SENDS:
+                    # Получатель принимает, но не подтверждает (или старый клиент):
+                    # не засыпаем его копиями бесконечно
+                    self.outbox.fail(record['id'])
+                    self.emit('delivery', {'id': record['id'], 'target_ip': target_ip,
+                                           'state': outbox.FAILED})
+                    continue
+                data = {
+                    'type': 'private_message',
+                    'from': self.username,
+                    'message': record['message'],
+                    'timestamp': record['timestamp'],
+                    'id': record['id']
+                }
+                payload = protocol.encode(data)
+                try:
+                    await self.pool.send(target_ip, payload)
+                except Exception as e:
+                    self._postpone(target_ip, records[index:], e)
+                    return
+                PACKETS_OUT.labels('private_message').inc()
+                BYTES_OUT.labels('private').inc(len(payload))
+                ack_timeout = self.ACK_TIMEOUT * 2 ** min(record['sends'], outbox.MAX_BACKOFF_EXPONENT)
+                if self.outbox.mark_sent(record['id'], ack_timeout):
+                    self.emit('delivery', {'id': record['id'], 'target_ip': target_ip,
+                                           'state': outbox.SENT})
+        finally:
+            self._delivering.discard(target_ip)
+            self._outbox_wakeup.set()
+
+    def _postpone(self, target_ip, records, error):
+        attempts = max(record['attempts'] for record in records) + 1
+        delay = outbox.backoff_delay(attempts)
+        for record in records:
+            self.outbox.reschedule(record['id'], attempts, delay)
+            self.emit('delivery', {'id': record['id'], 'target_ip': target_ip,
+                                   'state': outbox.RETRY, 'delay': delay, 'error': str(error)})
+        self.emit('status', f"{target_ip} недоступен ({error}), повтор через {delay:.0f} с")
+
+    def handle_private_reply(self, target_ip, frame):
+        """Ответный кадр собеседника по нашему соединению - подтверждение"""
+        BYTES_IN.labels('private').inc(len(frame))
+        try:
+            message_data = protocol.decode(frame)
+        except protocol.ProtocolError as e:
+            DECODE_ERRORS.labels('private').inc()
+            print(f"Некорректный ответ от {target_ip}: {e}")
+            return
+        PACKETS_IN.labels(protocol.type_label(message_data.get('type'))).inc()
+        if message_data.get('type') == 'private_ack' and self.outbox.delivered(message_data.get('id')):
+            self.emit('delivery', {'id': message_data['id'], 'target_ip': target_ip,
+                                   'state': outbox.DELIVERED})
+            self.emit('status', f"Личное сообщение доставлено {target_ip}")
+
+    def peer_address(self, user):
+        """Адрес TCP-сервера собеседника; без объявленного - его IP и наш порт"""
+        return self.peer_addresses.get(user, (user, self.tcp_port))
+
+    def expedite_outbox(self, user):
+        """Собеседник появился в сети - отправляем ему очередь, не дожидаясь паузы"""
+        if self.outbox.expedite(user):
+            self._outbox_wakeup.set()
+
+    # ------------------------------------------------------------------
+    # Приём
+    # ------------------------------------------------------------------
+
+    async def handle_private_connection(self, reader, writer):
+        """Обработка входящего соединения: по нему может прийти много кадров"""
+        peer_ip = writer.get_extra_info('peername')[0]
+        try:
+            async for frame in read_frames(reader):
+                BYTES_IN.labels('private').inc(len(frame))
+                if self.private_limiter is not None:
+                    # Сверх лимита не теряем, а перестаём читать: буфер TCP
+                    # заполнится, и отправитель сам упрётся в drain
+                    delay = self.private_limiter.delay(peer_ip)
+                    if delay:
+                        RATE_LIMITED.labels('private').inc()
+                        await asyncio.sleep(delay)
+                try:
+                    message_data = protocol.decode(frame)
+                except protocol.ProtocolError:
+                    DECODE_ERRORS.labels('private').inc()
+                    raise
+                message_type = message_data.get('type')
+                PACKETS_IN.labels(protocol.type_label(message_type)).inc()
+                # GUI читает эти поля без проверок: пакет без них отбрасывается
+                message_data['from'] = _text(message_data.get('from')) or peer_ip
+                if message_type == 'group_invite':
+                    group = message_data.get('group')
+                    if not groups.valid_name(group):
+                        DECODE_ERRORS.labels('private').inc()
+                        continue
+                    invite = (message_data['from'], group)
+                    # Повторное приглашение и приглашение в свою группу не показываем
+                    if group not in self.channels and invite not in self._seen_invites:
+                        self._seen_invites[invite] = True
+                        if len(self._seen_invites) > self.SEEN_PRIVATE_LIMIT:
+                            self._seen_invites.popitem(last=False)
+                        self.emit('group_invite', message_data)
+                elif message_type == 'private_message':
+                    if _text(message_data.get('message')) is None:
+                        DECODE_ERRORS.labels('private').inc()
+                        continue
+                    message_id = message_data.get('id')
+                    if message_id is None:
+                        self.emit('private_message', message_data)  # старый клиент
+                        continue
+                    # Подтверждаем и повторы: прошлое подтверждение могло потеряться
+                    ack = protocol.encode({'type': 'private_ack', 'from': self.username, 'id': message_id})
+                    write_frame(writer, ack)
+                    PACKETS_OUT.labels('private_ack').inc()
+                    BYTES_OUT.labels('private').inc(len(ack))
+                    if message_id not in self._seen_private:
+                        self._seen_private[message_id] = True
+                        if len(self._seen_private) > self.SEEN_PRIVATE_LIMIT:
+                            self._seen_private.popitem(last=False)
+                        self.emit('private_message', message_data)
+                    await writer.drain()
+        except Exception as e:
+            RECEIVE_ERRORS.labels('private').inc()
+            print(f"Ошибка при обработке личного сообщения: {e}")
+        finally:
+            writer.close()
+
+    def handle_group_datagram(self, data, address, group=None):
+        """Разбор multicast-пакета общего чата или группового чата ``group``"""
+        BYTES_IN.labels('group').inc(len(data))
+        if (self.packet_limiter is not None and address[0] not in self.relay_hosts
+                and not self.packet_limiter.allow(address[0])):
+            RATE_LIMITED.labels('packet').inc()
+            return  # поток с этого адреса отбрасывается ещё до разбора
+        try:
+            try:
+                message_data = self.reassembler.feed(data, address)
+            except protocol.ProtocolError:
+                DECODE_ERRORS.labels('group').inc()
+                raise
+            if message_data is None:
+                return  # ждём остальные фрагменты
+            message_type = message_data.get('type')
+            PACKETS_IN.labels(protocol.type_label(message_type)).inc()
+
+            if message_data.get('group') != group:
+                return  # чужая группа, попавшая на тот же порт
+            if group is not None and message_type not in ('group_message', 'nack'):
+                return  # присутствие живёт только в общем канале
+
+            if message_type == 'group_message':
+                user = _text(message_data.get('username')) or address[0]
+                # Обновляем список известных пользователей
+                self.touch_user(self.presence_key(user, address))
+                if 'seq' in message_data:
+                    key = self._sequence_key(user, group)
+                    if not self.receiver.accept(key, message_data.get('epoch'), message_data['seq']):
+                        return  # дубликат или повтор, который мы уже видели
+                    if self.receiver.has_gaps():
+                        self._repair_wakeup.set()
+                # Номер уже учтён, поэтому скрытое сообщение не вызовет NACK
+                if _text(message_data.get('message')) is None:
+                    DECODE_ERRORS.labels('group').inc()
+                    return  # GUI и история ждут строку
+                if self.message_limiter is not None and not self.message_limiter.allow(user):
+                    RATE_LIMITED.labels('group').inc()
+                    return
+                message_data['username'] = user
+                self.emit('group_message', message_data)
+
+            elif message_type == 'user_online':
+                tcp_port = message_data.get('tcp_port')
+                advertised = isinstance(tcp_port, int) and 0 < tcp_port < 65536
+                user = self.presence_key(_text(message_data.get('username')), address, advertised)
+                interval = message_data.get('interval')
+                # Срок ожидания масштабируется по объявленному интервалу отправителя
+                timeout = interval * self.USER_TIMEOUT / self.HEARTBEAT_INTERVAL if interval else None
+                if advertised:
+                    # Пакет мог прийти через ретранслятор (relay.py) с его адресом
+                    # отправителя; имя-IP указывает на самого собеседника
+                    host = user if _is_ipv4(user) else address[0]
+                    self.peer_addresses[user] = (host, tcp_port)
+                if user != self.username:
+                    previous = self.directory.observe(user, message_data.get('peer_id'),
+                                                      message_data.get('name'))
+                    if previous is not None and not self.presence.is_online(previous):
+                        self.offer_move(previous, user)
+                self.touch_user(user, timeout)
+                if 'last_seq' in message_data:
+                    self.receiver.advertise(user, message_data.get('epoch'), message_data['last_seq'])
+                    if self.receiver.has_gaps():
+                        self._repair_wakeup.set()
+                if message_data.get('hello') and user != self.username:
+                    self.schedule_digest()
+
+            elif message_type == 'user_offline':
+                user = self.presence_key(_text(message_data.get('username')), address)
+                self.receiver.forget(user)
+                self.peer_left(user)
+                delta = self.presence.remove(user)
+                if delta is not None:
+                    self.emit('presence', [delta])
+
+            elif message_type == 'presence_digest':
+                self.handle_digest(message_data)
+
+            elif message_type == 'nack':
+                self.handle_nack(message_data, group)
+
+        except Exception as e:
+            RECEIVE_ERRORS.labels('group').inc()
+            if self.running:
+                print(f"Ошибка приема multicast: {e}")
+
+    # ------------------------------------------------------------------
+    # Пользователи
+    # ------------------------------------------------------------------
+
+    def peer_left(self, user):
+        """Ушёл старый адрес собеседника, который уже виден под новым"""
+        peer_id = self.directory.peer_id(user)
+        current = self.directory.user(peer_id) if peer_id else None
+        if current is not None and current != user:
+            self.offer_move(user, current)
+
+    def offer_move(self, old_user, new_user):
+        """Тот же peer_id под другим адресом: спросить GUI, переслать ли туда очередь.
+
+        peer_id передаётся открытым текстом, и его может объявить кто угодно,
+        поэтому очередь личных сообщений сама не переносится: ``peer_moved``
+        предлагает это пользователю, и только он вызывает ``follow_peer``.
+        Одна и та же пара адресов предлагается один раз.
+        """
+        if (old_user, new_user) in self._offered_moves:
+            return
+        pending = self.outbox.pending_count(old_user)
+        if pending:
+            self._offered_moves.add((old_user, new_user))
+            self.emit('peer_moved', {'old': old_user, 'new': new_user, 'pending': pending})
+
+    def follow_peer(self, old_user, new_user):
+        """Перенос очереди личных сообщений на новый адрес (по согласию пользователя)"""
+        moved = self.outbox.retarget(old_user, new_user)
+        if moved:
+            self.emit('status', f"{old_user} теперь {new_user}: сообщений в очереди {moved}")
+            self.loop.call_soon_threadsafe(self._outbox_wakeup.set)
+
+    def presence_key(self, claimed, address, advertised=False):
+        """Под каким именем отправитель попадает в список собеседников.
+
+        Заявленное имя годится, только если по нему можно написать: это IP
+        или имя клиента, объявившего в heartbeat свой TCP-порт. Иначе
+        (переводчик, старые боты) - адрес отправителя, иначе личные
+        сообщения ушли бы на имя, которое не резолвится.
+        """
+        if claimed and (_is_ipv4(claimed) or advertised or claimed in self.peer_addresses):
+            return claimed
+        return address[0]
+
+    def touch_user(self, user, timeout=None):
+        """Отметка активности; в GUI уходят только появления пользователей"""
+        if user == self.username:
+            return
+        kind, _ = self.presence.touch(user, timeout=timeout)
+        if kind == presence.JOIN:
+            self.emit('presence', [(kind, user)])
+            self._presence_wakeup.set()
+            self.expedite_outbox(user)
+
+    def schedule_digest(self):
+        """Ответ новичку дайджестом после случайной задержки.
+
+        Если за это время дайджест пришлёт кто-то другой, наш отменяется,
+        так что на одного новичка обычно уходит один дайджест на всю группу.
+        """
+        if not self.presence_digests or self._digest_handle is not None:
+            return
+        self._digest_handle = self.loop.call_later(
+            random.uniform(0, self.DIGEST_MAX_DELAY), self.send_digest)
+
+    def send_digest(self):
+        """Рассылка дайджеста: кто онлайн и сколько секунд назад был слышен"""
+        self._digest_handle = None
+        ages = self.presence.ages()
+        data = {
+            'type': 'presence_digest',
+            'username': self.username,
+            'users': [self.username] + list(ages),
+            'ages': [0] + [int(age) for age in ages.values()]
+        }
+        self._sendto_group(data)
+
+    def handle_digest(self, message_data):
+        """Приём дайджеста: подавляем свой и узнаём о пропущенных пользователях"""
+        if message_data.get('username') == self.username:
+            return
+        if self._digest_handle is not None:
+            self._digest_handle.cancel()
+            self._digest_handle = None
+
+        deltas = []
+        for user, age in zip(message_data.get('users', ()), message_data.get('ages', ())):
+            if user == self.username or not isinstance(user, str):
+                continue
+            if not (_is_ipv4(user) or user in self.peer_addresses):
+                continue  # имя, по которому не написать: его ключ - адрес, а адреса здесь нет
+            delta = self.presence.learn(user, age)
+            if delta is not None:
+                deltas.append(delta)
+                self.expedite_outbox(user)
+        if deltas:
+            self.emit('presence', deltas)
+            self._presence_wakeup.set()
+
+    # ------------------------------------------------------------------
+    # Восстановление потерянных групповых сообщений
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _sequence_key(user, group):
+        """Ключ нумерации отправителя: у каждого канала своя последовательность"""
+        return user if group is None else (user, group)
+
+    def handle_nack(self, message_data, group=None):
+        """NACK в канале: свой - повторяем сообщения, чужой - подавляет наш"""
+        missing = message_data.get('missing', ())
+        target = message_data.get('target')
+        channel = self.main_channel if group is None else self.channels.get(group)
+        if channel is None:
+            return
+        if target == self.username:
+            if message_data.get('epoch') != self.epoch:
+                return  # просят сообщения прошлого запуска
+            for seq in missing:
+                data = channel.retransmit_buffer.retransmit(seq)
+                if data is not None:
+                    RETRANSMITS.inc()
+                    self._sendto_group(data, channel)
+        elif message_data.get('username') != self.username:
+            self.receiver.suppress(self._sequence_key(target, group), message_data.get('epoch'), missing)
+
+    async def repair_group_messages(self):
+        """Рассылка NACK о пропусках, пока они есть; иначе ждём нового пропуска"""
+        while self.running:
+            nacks, lost = self.receiver.collect_nacks()
+            for key, (epoch, missing) in nacks.items():
+                sender, group = key if isinstance(key, tuple) else (key, None)
+                channel = self.main_channel if group is None else self.channels.get(group)
+                if channel is None:
+                    continue
+                data = {
+                    'type': 'nack',
+                    'username': self.username,
+                    'target': sender,
+                    'epoch': epoch,
+                    'missing': missing
+                }
+                if group is not None:
+                    data['group'] = group
+                NACKS_SENT.inc()
+                self._sendto_group(data, channel)
+            for key, count in lost.items():
+                sender, group = key if isinstance(key, tuple) else (key, None)
+                where = f" в группе {group}" if group is not None else ""
+                self.emit('system', f"Не удалось получить {count} сообщ. от {sender}{where}")
+
+            delay = self.receiver.next_check()
+            self._repair_wakeup.clear()
+            try:
+                await asyncio.wait_for(self._repair_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def udp_drops(self):
+        """Датаграммы, отброшенные ядром на приёмных сокетах: буфер не успевали читать"""
+        sockets = [self.udp_socket] + [channel.socket for channel in self.channels.values()]
+        return ratelimit.udp_drops(sockets)
+
+    async def report_suppressed(self):
+        """Сводка по скрытым сообщениям: одно событие вместо потока строк в чате"""
+        while self.running:
+            await asyncio.sleep(self.SUPPRESSED_REPORT_INTERVAL)
+            suppressed = {}
+            for limiter in (self.packet_limiter, self.message_limiter):
+                if limiter is None:
+                    continue
+                for sender, count in limiter.take_suppressed().items():
+                    suppressed[sender] = suppressed.get(sender, 0) + count
+            if suppressed:
+                self.emit('suppressed', suppressed)
+
+    async def send_heartbeat(self):
+        """Heartbeat с адаптивным интервалом и случайным разбросом"""
+        self.broadcast_online(hello=True)
+        while self.running:
+            await asyncio.sleep(presence.jittered(self.heartbeat_interval(), self.HEARTBEAT_JITTER))
+            self.broadcast_online()
+
+    async def cleanup_old_users(self):
+        """Отметка отключившихся точно в срок по куче индекса присутствия"""
+        while self.running:
+            deltas = self.presence.expire()
+            if deltas:
+                for _, user in deltas:
+                    self.receiver.forget(user)
+                    self.peer_left(user)
+                self.emit('presence', deltas)
+
+            # Спим до ближайшего срока; появление пользователя будит задачу,
+            # чтобы запланировать его срок
+            deadline = self.presence.next_deadline()
+            delay = self.CLEANUP_INTERVAL
+            if deadline is not None:
+                delay = min(delay, max(0.0, deadline - time.monotonic()) + 0.01)
+            self._presence_wakeup.clear()
+            try:
+                await asyncio.wait_for(self._presence_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+class _GroupProtocol(asyncio.DatagramProtocol):
+    """Приём multicast-датаграмм в цикле asyncio"""
+
+    def __init__(self, network, group=None):
+        self.network = network
+        self.group = group
+
+    def datagram_received(self, data, addr):
+        self.network.handle_group_datagram(data, addr, self.group)
+
+    def error_received(self, exc):
+        if self.network.running:
+            print(f"Ошибка приема multicast: {exc}")
@@ -0,0 +1,163 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+
+DEFAULT_OUTBOX_PATH = os.path.join(os.path.expanduser('~'), '.localchat', 'outbox.sqlite3')
+
+# Состояния доставки личного сообщения
+QUEUED = 'queued'  # ждёт отправки
+SENT = 'sent'  # записано в соединение, ждём подтверждения
+RETRY = 'retry'  # собеседник недоступен, повтор позже
+DELIVERED = 'delivered'  # получатель подтвердил приём
+FAILED = 'failed'  # подтверждения так и не было: больше не отправляем
+
+
+MAX_BACKOFF_EXPONENT = 30  # 2**30 с - уже больше любого разумного cap
+
+
+def backoff_delay(attempts, base=1.0, cap=300.0):
+    """Экспоненциальная задержка повтора со случайным разбросом в половину задержки.
+
+    Показатель ограничен: ``attempts`` хранится между запусками и может
+    расти сколько угодно, а ``2 ** 1024`` уже не влезает во float.
+    """
+    delay = min(cap, base * 2 ** min(attempts, MAX_BACKOFF_EXPONENT))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class Outbox:
+    """Исходящие личные сообщения, ещё не подтверждённые получателем.
+
+    Хранится в SQLite и переживает перезапуск клиента. Каждая запись ждёт
+    своего ``next_attempt``: после ошибки отправки он сдвигается по
+    ``backoff_delay``, после отправки - на время ожидания подтверждения.
+    ``sends`` считает отправки без подтверждения; сообщение, на которое
+    не ответили ``max_sends`` раз, становится ``FAILED`` и больше не уходит.
+    Подтверждённые сообщения удаляются: их текст остаётся в истории чата.
+    """
+
+    def __init__(self, path=DEFAULT_OUTBOX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id TEXT PRIMARY KEY,
+                target TEXT NOT NULL,
+                message TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                created REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                state TEXT NOT NULL,
+                sends INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        columns = {row['name'] for row in self.db.execute('PRAGMA table_info(outbox)')}
+        if 'sends' not in columns:  # очередь прежней версии
+            self.db.execute('ALTER TABLE outbox ADD COLUMN sends INTEGER NOT NULL DEFAULT 0')
+        self.db.execute('CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (next_attempt)')
+        # После перезапуска пробуем отправить всё, что осталось, сразу
+        self.db.execute('UPDATE outbox SET next_attempt=?', (time.time(),))
+        self.db.commit()
+
+    def add(self, target, message, timestamp):
+        """Постановка сообщения в очередь; возвращает его id"""
+        message_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self.db.execute(
+                'INSERT INTO outbox VALUES (?, ?, ?, ?, ?, 0, ?, ?, 0)',
+                (message_id, target, message, timestamp, now, now, QUEUED))
+            self.db.commit()
+        return message_id
+
+    def due(self, now=None):
+        """Записи, которые пора отправить, в порядке постановки"""
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self.db.execute(
+                'SELECT * FROM outbox WHERE next_attempt<=? AND state!=? ORDER BY created',
+                (now, FAILED)).fetchall()
+        return [dict(row) for row in rows]
+
+    def next_due(self):
+        """Время ближайшей попытки или None, если очередь пуста"""
+        with self._lock:
+            return self.db.execute('SELECT MIN(next_attempt) FROM outbox WHERE state!=?',
+                                   (FAILED,)).fetchone()[0]
+
+    def mark_sent(self, message_id, ack_timeout):
+        """Сообщение ушло; если подтверждения не будет, отправим его ещё раз.
+
+        False - сообщения уже нет: подтверждение обогнало отметку об отправке.
+        """
+        with self._lock:
+            cursor = self.db.execute(
+                'UPDATE outbox SET state=?, sends=sends+1, next_attempt=? WHERE id=?',
+                (SENT, time.time() + ack_timeout, message_id))
+            self.db.commit()
+        return cursor.rowcount > 0
+
+    def reschedule(self, message_id, attempts, delay):
+        """Отложенный повтор после ошибки отправки"""
+        with self._lock:
+            self.db.execute('UPDATE outbox SET state=?, attempts=?, next_attempt=? WHERE id=?',
+                            (RETRY, attempts, time.time() + delay, message_id))
+            self.db.commit()
+
+    def delivered(self, message_id):
+        """Подтверждение получателя; False, если такого сообщения в очереди нет"""
+        with self._lock:
+            cursor = self.db.execute('DELETE FROM outbox WHERE id=?', (message_id,))
+            self.db.commit()
+        return cursor.rowcount > 0
+
+    def fail(self, message_id):
+        """Подтверждения не дождались: сообщение остаётся в очереди как FAILED"""
+        with self._lock:
+            self.db.execute('UPDATE outbox SET state=? WHERE id=?', (FAILED, message_id))
+            self.db.commit()
+
+    def expedite(self, target):
+        """Собеседник снова в сети: его неотправленные сообщения - немедленно.
+
+        Сообщения, ждущие подтверждения, и FAILED не трогаем. Возвращает число записей.
+        """
+        with self._lock:
+            cursor = self.db.execute(
+                'UPDATE outbox SET next_attempt=?, attempts=0 WHERE target=? AND state NOT IN (?, ?)',
+                (time.time(), target, SENT, FAILED))
+            self.db.commit()
+        return cursor.rowcount
+
+    def retarget(self, old_target, new_target):
+        """Собеседник сменил адрес: его очередь уходит на новый"""
+        with self._lock:
+            cursor = self.db.execute(
+                'UPDATE outbox SET target=?, next_attempt=?, attempts=0 WHERE target=? AND state!=?',
+                (new_target, time.time(), old_target, FAILED))
+            self.db.commit()
+        return cursor.rowcount
+
+    def pending_count(self, target=None):
+        with self._lock:
+            if target is None:
+                return self.db.execute('SELECT COUNT(*) FROM outbox WHERE state!=?',
+                                       (FAILED,)).fetchone()[0]
+            return self.db.execute('SELECT COUNT(*) FROM outbox WHERE target=? AND state!=?',
+                                   (target, FAILED)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
@@ -0,0 +1,167 @@
+"""Справочник собеседников: постоянный id, адрес и отображаемое имя.
+
+Каждый клиент один раз создаёт себе ``peer_id`` и хранит его в
+``~/.localchat``: по нему собеседник узнаётся и после смены IP. Id
+передаётся открытым текстом и ничем не подтверждён, поэтому служит только
+подсказкой: очередь личных сообщений на новый адрес переносит пользователь.
+Имя собеседник объявляет сам в heartbeat. Для старых клиентов, которые имени
+не присылают, имя хоста ищется обратным DNS в фоновых потоках; результат,
+в том числе неудачный, кэшируется на ``resolve_ttl`` / ``negative_ttl``.
+Путь отрисовки сообщений читает только готовый кэш и никогда не ждёт DNS.
+"""
+import getpass
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_PEER_ID_PATH = os.path.join(os.path.expanduser('~'), '.localchat', 'peer_id')
+MAX_NAME_LENGTH = 64
+
+
+def load_peer_id(path=DEFAULT_PEER_ID_PATH):
+    """Постоянный id этого клиента; создаётся при первом запуске"""
+    try:
+        with open(path, encoding='ascii') as peer_id_file:
+            peer_id = peer_id_file.read().strip()
+        if peer_id:
+            return peer_id
+    except OSError:
+        pass
+    peer_id = uuid.uuid4().hex
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='ascii') as peer_id_file:
+            peer_id_file.write(peer_id + '\n')
+    except OSError as e:
+        print(f"Не удалось сохранить id клиента в {path}: {e}")
+    return peer_id
+
+
+def default_display_name():
+    """Имя для других: пользователь@хост без домена"""
+    host = socket.gethostname().split('.')[0]
+    try:
+        return f"{getpass.getuser()}@{host}"
+    except Exception:
+        return host
+
+
+def _is_address(value):
+    try:
+        socket.inet_aton(value)
+    except (OSError, TypeError):
+        return False
+    return True
+
+
+class PeerDirectory:
+    """Собеседники по имени в сети (у клиентов чата это IP).
+
+    ``observe`` вызывается из сетевого потока на каждый heartbeat,
+    ``label`` и ``name`` - из GUI; ``on_change(user)`` сообщает, что
+    отображаемое имя собеседника изменилось (из любого потока).
+    """
+
+    def __init__(self, resolve_ttl=3600, negative_ttl=300, on_change=None, workers=2):
+        self.resolve_ttl = resolve_ttl
+        self.negative_ttl = negative_ttl
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._peers = {}  # пользователь -> {'peer_id': ..., 'name': ...}
+        self._users = {}  # peer_id -> пользователь
+        self._resolved = {}  # IP -> (имя хоста или None, срок годности)
+        self._resolving = set()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="peer-dns")
+
+    def observe(self, user, peer_id=None, name=None):
+        """Heartbeat собеседника; возвращает прежнее имя в сети того же peer_id, если оно сменилось"""
+        if isinstance(name, str):
+            name = name.strip()[:MAX_NAME_LENGTH] or None
+        else:
+            name = None
+        with self._lock:
+            entry = self._peers.setdefault(user, {'peer_id': None, 'name': None})
+            changed = entry['name'] != name
+            entry['name'] = name
+            previous = None
+            if peer_id:
+                entry['peer_id'] = peer_id
+                previous = self._users.get(peer_id)
+                self._users[peer_id] = user
+                if previous == user:
+                    previous = None
+            need_lookup = name is None and self._lookup_due(user)
+        if need_lookup:
+            self._resolve(user)
+        if changed and self.on_change is not None:
+            self.on_change(user)
+        return previous
+
+    def peer_id(self, user):
+        with self._lock:
+            entry = self._peers.get(user)
+            return entry['peer_id'] if entry else None
+
+    def user(self, peer_id):
+        """Последний адрес, с которого собеседник с этим peer_id присылал heartbeat.
+
+        Записи ушедших собеседников не удаляются: по ним предлагается
+        переезд на новый адрес, а строка «отключился» показывается с именем.
+        """
+        with self._lock:
+            return self._users.get(peer_id)
+
+    def name(self, user):
+        """Объявленное или найденное в DNS имя; None, если его пока нет"""
+        with self._lock:
+            entry = self._peers.get(user)
+            if entry and entry['name']:
+                return entry['name']
+            resolved = self._resolved.get(user)
+            return resolved[0] if resolved else None
+
+    def label(self, user):
+        """Строка для списка и чата: «имя (IP)» или просто IP"""
+        name = self.name(user)
+        return f"{name} ({user})" if name and name != user else user
+
+    # ------------------------------------------------------------------
+    # Обратный DNS
+    # ------------------------------------------------------------------
+
+    def _lookup_due(self, user):
+        """Нужен ли поиск имени (вызывается под блокировкой)"""
+        if user in self._resolving or not _is_address(user):
+            return False
+        resolved = self._resolved.get(user)
+        return resolved is None or resolved[1] <= time.monotonic()
+
+    def _resolve(self, address):
+        with self._lock:
+            self._resolving.add(address)
+        try:
+            self._executor.submit(self._lookup, address)
+        except RuntimeError:
+            pass  # справочник уже закрыт
+
+    def _lookup(self, address):
+        try:
+            hostname = socket.gethostbyaddr(address)[0].split('.')[0] or None
+        except (OSError, UnicodeError):
+            hostname = None
+        ttl = self.resolve_ttl if hostname else self.negative_ttl
+        with self._lock:
+            previous = self._resolved.get(address, (None, 0))[0]
+            self._resolved[address] = (hostname, time.monotonic() + ttl)
+            self._resolving.discard(address)
+            entry = self._peers.get(address)
+            visible = entry is not None and entry['name'] is None
+        if visible and previous != hostname and self.on_change is not None:
+            self.on_change(address)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,145 @@
+import heapq
+import random
+import threading
+import time
+
+
+JOIN = 'join'
+LEAVE = 'leave'
+REFRESH = 'refresh'
+
+
+def adaptive_interval(base, peer_count, target_rate):
+    """Интервал heartbeat, при котором вся группа шлёт не больше target_rate пакетов в секунду"""
+    return max(base, peer_count / target_rate)
+
+
+def jittered(interval, jitter=0.2):
+    """Случайный разброс ±jitter, чтобы одновременно запущенные клиенты разошлись"""
+    return interval * random.uniform(1 - jitter, 1 + jitter)
+
+
+class PresenceIndex:
+    """Потокобезопасный индекс присутствия пользователей.
+
+    Вместо полного пересчёта списка на каждый пакет индекс возвращает только
+    изменения: ``(JOIN, user)``, ``(LEAVE, user)`` или ``(REFRESH, user)``.
+    Сроки истечения хранятся в куче, поэтому ``expire`` смотрит только на
+    пользователей, у которых срок действительно подошёл.
+    """
+
+    def __init__(self, timeout, forget_after=None):
+        self.timeout = timeout  # секунд тишины до отметки как offline
+        self.forget_after = forget_after or timeout * 2  # секунд до удаления из индекса
+        self.users = {}  # user -> {'last_seen': monotonic, 'status': ..., 'timeout': секунд}
+        self._deadlines = []  # куча (срок, user); не больше одной записи на пользователя
+        self._scheduled = set()  # пользователи, у которых есть запись в куче
+        self._lock = threading.Lock()
+
+    def touch(self, user, now=None, timeout=None):
+        """Отметка активности пользователя; возвращает JOIN или REFRESH.
+
+        ``timeout`` - индивидуальный срок для пользователя, который объявил
+        более редкий heartbeat, чем у нас; он не бывает меньше общего.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self.users.get(user)
+            if entry is None:
+                self._add(user, now, timeout)
+                return (JOIN, user)
+
+            entry['last_seen'] = now
+            if timeout is not None:
+                entry['timeout'] = max(self.timeout, timeout)
+            if entry['status'] != 'online':
+                entry['status'] = 'online'
+                return (JOIN, user)
+            return (REFRESH, user)
+
+    def learn(self, user, age, now=None):
+        """Пользователь из чужого дайджеста: добавляется, только если неизвестен.
+
+        Уже известных дайджест не освежает, иначе клиенты поддерживали бы
+        друг у друга давно ушедших пользователей.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if user in self.users or age >= self.timeout:
+                return None
+            self._add(user, now - age, None)
+            return (JOIN, user)
+
+    def _add(self, user, last_seen, timeout):
+        self.users[user] = {
+            'last_seen': last_seen,
+            'status': 'online',
+            'timeout': max(self.timeout, timeout or 0),
+        }
+        if user not in self._scheduled:
+            self._scheduled.add(user)
+            heapq.heappush(self._deadlines, (last_seen + self.users[user]['timeout'], user))
+
+    def remove(self, user):
+        """Явный уход пользователя; возвращает LEAVE, если он был онлайн"""
+        with self._lock:
+            entry = self.users.pop(user, None)
+            # Запись в куче останется и будет пропущена в expire
+            if entry is not None and entry['status'] == 'online':
+                return (LEAVE, user)
+            return None
+
+    def expire(self, now=None):
+        """Обработка истёкших сроков; возвращает список LEAVE"""
+        now = time.monotonic() if now is None else now
+        deltas = []
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, user = heapq.heappop(self._deadlines)
+                entry = self.users.get(user)
+                if entry is None:
+                    self._scheduled.discard(user)
+                    continue
+
+                # Пользователь мог быть активен после постановки срока:
+                # переносим запись на актуальный срок
+                if entry['status'] == 'online':
+                    deadline = entry['last_seen'] + entry['timeout']
+                    if deadline <= now:
+                        entry['status'] = 'offline'
+                        deltas.append((LEAVE, user))
+                        deadline = entry['last_seen'] + self.forget_after
+                else:
+                    deadline = entry['last_seen'] + self.forget_after
+                    if deadline <= now:
+                        del self.users[user]
+                        self._scheduled.discard(user)
+                        continue
+                heapq.heappush(self._deadlines, (deadline, user))
+        return deltas
+
+    def next_deadline(self):
+        """Ближайший срок в шкале time.monotonic() или None"""
+        with self._lock:
+            return self._deadlines[0][0] if self._deadlines else None
+
+    def online(self):
+        """Отсортированный список пользователей онлайн"""
+        with self._lock:
+            return sorted(user for user, entry in self.users.items() if entry['status'] == 'online')
+
+    def ages(self, now=None):
+        """Пользователи онлайн и сколько секунд назад их слышали (для дайджеста)"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return {user: now - entry['last_seen'] for user, entry in self.users.items()
+                    if entry['status'] == 'online'}
+
+    def online_count(self):
+        with self._lock:
+            return sum(1 for entry in self.users.values() if entry['status'] == 'online')
+
+    def is_online(self, user):
+        with self._lock:
+            entry = self.users.get(user)
+            return entry is not None and entry['status'] == 'online'
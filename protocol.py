@@ -0,0 +1,381 @@
+"""Бинарный формат пакетов чата.
+
+Пакет: заголовок ``magic, version, flags, type`` (4 байта) и тело - набор
+полей ``(id ключа, типизированное значение)``. Частые ключи и типы сообщений
+кодируются одним байтом, тело сжимается zlib, если оно больше порога.
+Пакеты, не влезающие в одну датаграмму, режутся на фрагменты и собираются
+на приёме ``FragmentReassembler``. Пакеты, начинающиеся с ``{``, считаются
+JSON старых клиентов.
+"""
+import itertools
+import json
+import os
+import struct
+import time
+import zlib
+
+
+MAGIC = 0xC7
+VERSION = 1
+
+FLAG_COMPRESSED = 0x01
+FLAG_FRAGMENT = 0x02
+
+HEADER = struct.Struct('!BBBB')  # magic, version, flags, type
+FRAGMENT_HEADER = struct.Struct('!IHH')  # id сообщения, номер фрагмента, всего фрагментов
+
+COMPRESS_THRESHOLD = 256  # байт тела, начиная с которых пробуем zlib
+MAX_DATAGRAM_SIZE = 1400  # не больше MTU Ethernet за вычетом заголовков IP/UDP
+MAX_FRAGMENTS = 1024
+MAX_MESSAGE_SIZE = MAX_FRAGMENTS * MAX_DATAGRAM_SIZE  # и после распаковки zlib
+
+# Коды типов сообщений и ключей. Новые значения добавляются только в конец,
+# иначе клиенты разных версий перестанут понимать друг друга
+MESSAGE_TYPES = (None, 'group_message', 'user_online', 'private_message',
+                 'user_offline', 'presence_digest', 'translator_online', 'nack',
+                 'private_ack', 'group_invite')
+FIELD_NAMES = (None, 'type', 'username', 'message', 'timestamp', 'from',
+               'interval', 'hello', 'users', 'ages', 'translated', 'translator_id',
+               'epoch', 'seq', 'last_seq', 'target', 'missing', 'id',
+               'tcp_port', 'group', 'peer_id', 'name')
+
+_TYPE_CODES = {name: code for code, name in enumerate(MESSAGE_TYPES) if name}
+_FIELD_CODES = {name: code for code, name in enumerate(FIELD_NAMES) if name}
+
+# Теги типов значений
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _LIST, _BYTES, _DICT = range(9)
+_FLOAT_STRUCT = struct.Struct('!d')
+
+
+class ProtocolError(ValueError):
+    """Пакет не удалось разобрать"""
+
+
+# ----------------------------------------------------------------------
+# Примитивы
+# ----------------------------------------------------------------------
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    result = shift = 0
+    while True:
+        if pos >= len(data):
+            raise ProtocolError("Обрезанный varint")
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _write_bytes(out, value):
+    _write_varint(out, len(value))
+    out += value
+
+
+def _read_bytes(data, pos):
+    length, pos = _read_varint(data, pos)
+    end = pos + length
+    if end > len(data):
+        raise ProtocolError("Обрезанная строка")
+    return bytes(data[pos:end]), end
+
+
+def _write_value(out, value):
+    if value is None:
+        out.append(_NONE)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, int):
+        out.append(_INT)
+        _write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+    elif isinstance(value, float):
+        out.append(_FLOAT)
+        out += _FLOAT_STRUCT.pack(value)
+    elif isinstance(value, str):
+        out.append(_STR)
+        _write_bytes(out, value.encode('utf-8'))
+    elif isinstance(value, (bytes, bytearray)):
+        out.append(_BYTES)
+        _write_bytes(out, value)
+    elif isinstance(value, (list, tuple)):
+        out.append(_LIST)
+        _write_varint(out, len(value))
+        for item in value:
+            _write_value(out, item)
+    elif isinstance(value, dict):
+        out.append(_DICT)
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            _write_bytes(out, str(key).encode('utf-8'))
+            _write_value(out, item)
+    else:
+        raise ProtocolError(f"Неподдерживаемый тип значения: {type(value).__name__}")
+
+
+def _read_value(data, pos):
+    if pos >= len(data):
+        raise ProtocolError("Обрезанное значение")
+    tag = data[pos]
+    pos += 1
+    if tag == _NONE:
+        return None, pos
+    if tag == _TRUE:
+        return True, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag == _INT:
+        raw, pos = _read_varint(data, pos)
+        return (raw >> 1) if not raw & 1 else -((raw + 1) >> 1), pos
+    if tag == _FLOAT:
+        end = pos + _FLOAT_STRUCT.size
+        if end > len(data):
+            raise ProtocolError("Обрезанное число")
+        return _FLOAT_STRUCT.unpack_from(data, pos)[0], end
+    if tag == _STR:
+        raw, pos = _read_bytes(data, pos)
+        return raw.decode('utf-8'), pos
+    if tag == _BYTES:
+        return _read_bytes(data, pos)
+    if tag == _LIST:
+        count, pos = _read_varint(data, pos)
+        items = []
+        for _ in range(count):
+            item, pos = _read_value(data, pos)
+            items.append(item)
+        return items, pos
+    if tag == _DICT:
+        count, pos = _read_varint(data, pos)
+        items = {}
+        for _ in range(count):
+            key, pos = _read_bytes(data, pos)
+            items[key.decode('utf-8')], pos = _read_value(data, pos)
+        return items, pos
+    raise ProtocolError(f"Неизвестный тег значения: {tag}")
+
+
+# ----------------------------------------------------------------------
+# Пакеты
+# ----------------------------------------------------------------------
+
+def encode(message, legacy=False):
+    """Кодирование сообщения (dict) в один пакет.
+
+    ``legacy=True`` даёт JSON, понятный клиентам до перехода на этот формат.
+    """
+    if legacy:
+        return json.dumps(message).encode('utf-8')
+
+    type_code = _TYPE_CODES.get(message.get('type'), 0)
+    body = bytearray()
+    for key, value in message.items():
+        if key == 'type' and type_code:
+            continue
+        field_code = _FIELD_CODES.get(key, 0)
+        body.append(field_code)
+        if not field_code:
+            _write_bytes(body, key.encode('utf-8'))
+        _write_value(body, value)
+
+    flags = 0
+    if len(body) >= COMPRESS_THRESHOLD:
+        compressed = zlib.compress(bytes(body))
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= FLAG_COMPRESSED
+
+    return HEADER.pack(MAGIC, VERSION, flags, type_code) + bytes(body)
+
+
+def decode(packet):
+    """Разбор пакета (бинарного или JSON) в dict.
+
+    Любой испорченный пакет даёт ``ProtocolError``, а не другое исключение.
+    Поля ``type`` может не быть (записи истории, чужие пакеты): получатели
+    читают его через ``get``.
+    """
+    if packet[:1] == b'{':
+        try:
+            message = json.loads(packet.decode('utf-8'))
+        except (ValueError, RecursionError) as e:
+            raise ProtocolError(f"Некорректный JSON: {e}") from e
+    else:
+        message = _decode_binary(packet)
+    if not isinstance(message, dict):
+        raise ProtocolError("Пакет - не словарь")
+    return message
+
+
+def _decode_binary(packet):
+
+    if len(packet) < HEADER.size:
+        raise ProtocolError("Слишком короткий пакет")
+    magic, version, flags, type_code = HEADER.unpack_from(packet)
+    if magic != MAGIC:
+        raise ProtocolError("Неизвестный формат пакета")
+    if version > VERSION:
+        raise ProtocolError(f"Неподдерживаемая версия протокола: {version}")
+    if flags & FLAG_FRAGMENT:
+        raise ProtocolError("Фрагмент нужно передавать в FragmentReassembler")
+
+    body = packet[HEADER.size:]
+    if flags & FLAG_COMPRESSED:
+        # Ограничение на распакованный размер: иначе одна датаграмма-«бомба»
+        # раздувается в гигабайты у каждого клиента
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(body, MAX_MESSAGE_SIZE)
+        except zlib.error as e:
+            raise ProtocolError(f"Ошибка распаковки: {e}") from e
+        if decompressor.unconsumed_tail:
+            raise ProtocolError("Распакованный пакет слишком большой")
+
+    # Коды, добавленные более новыми клиентами, не ошибка: такие типы
+    # и ключи получают служебные имена и игнорируются обработчиками
+    message = {}
+    if type_code:
+        if type_code < len(MESSAGE_TYPES):
+            message['type'] = MESSAGE_TYPES[type_code]
+        else:
+            message['type'] = f'unknown_{type_code}'
+
+    pos = 0
+    try:
+        while pos < len(body):
+            field_code = body[pos]
+            pos += 1
+            if field_code:
+                if field_code < len(FIELD_NAMES):
+                    key = FIELD_NAMES[field_code]
+                else:
+                    key = f'_field_{field_code}'
+            else:
+                raw_key, pos = _read_bytes(body, pos)
+                key = raw_key.decode('utf-8')
+            message[key], pos = _read_value(body, pos)
+    except (UnicodeDecodeError, struct.error, RecursionError) as e:
+        raise ProtocolError(f"Некорректное тело пакета: {e}") from e
+    return message
+
+
+def type_label(message_type):
+    """Метка метрики для типа разобранного пакета: известный тип или 'other'.
+
+    Тип приходит от кого угодно, а каждая новая метка - новый счётчик.
+    """
+    return message_type if isinstance(message_type, str) and message_type in _TYPE_CODES else 'other'
+
+
+def packet_type(datagram):
+    """Тип сообщения по заголовку, без разбора тела: для статистики транзита"""
+    if datagram[:1] == b'{':
+        return 'json'
+    if len(datagram) < HEADER.size or datagram[0] != MAGIC:
+        return 'unknown'
+    if datagram[2] & FLAG_FRAGMENT:
+        return 'fragment'
+    type_code = datagram[3]
+    return MESSAGE_TYPES[type_code] if 0 < type_code < len(MESSAGE_TYPES) else 'unknown'
+
+
+_message_ids = itertools.count(int.from_bytes(os.urandom(4), 'big'))
+
+
+def encode_datagrams(message, legacy=False, max_size=MAX_DATAGRAM_SIZE):
+    """Кодирование сообщения в список датаграмм (с фрагментацией)"""
+    packet = encode(message, legacy=legacy)
+    if len(packet) <= max_size or legacy:
+        return [packet]
+
+    chunk_size = max_size - HEADER.size - FRAGMENT_HEADER.size
+    count = -(-len(packet) // chunk_size)
+    if count > MAX_FRAGMENTS:
+        raise ProtocolError(f"Сообщение слишком большое: {len(packet)} байт")
+
+    message_id = next(_message_ids) & 0xFFFFFFFF
+    header = HEADER.pack(MAGIC, VERSION, FLAG_FRAGMENT, 0)
+    return [
+        header + FRAGMENT_HEADER.pack(message_id, index, count)
+        + packet[index * chunk_size:(index + 1) * chunk_size]
+        for index in range(count)
+    ]
+
+
+class FragmentReassembler:
+    """Сборка фрагментированных датаграмм.
+
+    ``feed`` возвращает готовое сообщение или ``None``, если пакет оказался
+    фрагментом ещё не собранного сообщения. Незавершённые сообщения
+    выбрасываются через ``timeout`` секунд, а когда их больше ``max_pending``
+    или вместе они занимают больше ``max_bytes`` - начиная с самых старых.
+    """
+
+    def __init__(self, timeout=10, max_pending=256, max_bytes=16 * 1024 * 1024):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.buffered = 0  # байт во всех незавершённых сообщениях
+        self.pending = {}  # (адрес, id) -> {'parts': {}, 'count': n, 'started': t, 'size': байт}
+
+    def feed(self, datagram, address=None):
+        if len(datagram) < HEADER.size or datagram[0] != MAGIC or not datagram[2] & FLAG_FRAGMENT:
+            return decode(datagram)
+
+        offset = HEADER.size + FRAGMENT_HEADER.size
+        if len(datagram) < offset:
+            raise ProtocolError("Обрезанный фрагмент")
+        if len(datagram) > MAX_DATAGRAM_SIZE:
+            raise ProtocolError("Фрагмент больше допустимой датаграммы")
+        message_id, index, count = FRAGMENT_HEADER.unpack_from(datagram, HEADER.size)
+        if not count or count > MAX_FRAGMENTS or index >= count:
+            raise ProtocolError("Некорректный заголовок фрагмента")
+
+        now = time.monotonic()
+        self.expire(now)
+
+        key = (address, message_id)
+        entry = self.pending.get(key)
+        if entry is not None and entry['count'] != count:
+            self._drop(key)
+            raise ProtocolError("Фрагменты одного сообщения расходятся в числе частей")
+        if entry is None:
+            if len(self.pending) >= self.max_pending:
+                self._drop_oldest()
+            entry = self.pending[key] = {'parts': {}, 'count': count, 'started': now, 'size': 0}
+
+        part = datagram[offset:]
+        previous = entry['parts'].get(index)
+        growth = len(part) - (len(previous) if previous is not None else 0)
+        while self.buffered + growth > self.max_bytes and len(self.pending) > 1:
+            self._drop_oldest(keep=key)
+        entry['parts'][index] = part
+        entry['size'] += growth
+        self.buffered += growth
+        if len(entry['parts']) < entry['count']:
+            return None
+
+        self._drop(key)
+        parts = entry['parts']
+        return decode(b''.join(parts[i] for i in range(entry['count'])))
+
+    def _drop(self, key):
+        entry = self.pending.pop(key)
+        self.buffered -= entry['size']
+
+    def _drop_oldest(self, keep=None):
+        oldest = min((k for k in self.pending if k != keep), key=lambda k: self.pending[k]['started'])
+        self._drop(oldest)
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        for key in [k for k, entry in self.pending.items() if now - entry['started'] > self.timeout]:
+            self._drop(key)
@@ -0,0 +1,120 @@
+"""Ограничение потока от отдельных отправителей и настройка приёмного буфера.
+
+Один шумный хост (или переводчик, отвечающий сам себе) не должен занимать
+весь сетевой поток и GUI у всех клиентов. На каждого отправителя заводится
+корзина токенов: пока токены есть, пакеты проходят; сверх лимита - считаются
+и отбрасываются, а GUI получает одну сводку «N сообщений скрыто».
+"""
+import os
+import socket
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Корзина токенов: ``rate`` в секунду, не больше ``burst`` подряд"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now=None):
+        """Взять токен; False - лимит исчерпан"""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def reserve(self, now=None):
+        """Взять токен в долг; сколько секунд подождать, пока долг погасится"""
+        self._refill(time.monotonic() if now is None else now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class SenderLimiter:
+    """Корзины токенов по отправителям с учётом подавленных пакетов.
+
+    Корзины не использовавшихся отправителей вытесняются, когда их больше
+    ``max_senders``: полная корзина ничем не отличается от новой.
+    """
+
+    def __init__(self, rate, burst, max_senders=4096):
+        self.rate = rate
+        self.burst = burst
+        self.max_senders = max_senders
+        self.buckets = OrderedDict()  # отправитель -> TokenBucket
+        self.suppressed = {}  # отправитель -> подавлено с прошлой сводки
+        self.total_suppressed = 0
+
+    def _bucket(self, sender, now):
+        bucket = self.buckets.get(sender)
+        if bucket is None:
+            if len(self.buckets) >= self.max_senders:
+                self.buckets.popitem(last=False)
+            bucket = self.buckets[sender] = TokenBucket(self.rate, self.burst, now)
+        else:
+            self.buckets.move_to_end(sender)
+        return bucket
+
+    def allow(self, sender, now=None):
+        now = time.monotonic() if now is None else now
+        if self._bucket(sender, now).take(now):
+            return True
+        self.suppressed[sender] = self.suppressed.get(sender, 0) + 1
+        self.total_suppressed += 1
+        return False
+
+    def delay(self, sender, now=None):
+        """Задержка перед обработкой очередного пакета: для потоков, которые можно притормозить"""
+        now = time.monotonic() if now is None else now
+        return self._bucket(sender, now).reserve(now)
+
+    def take_suppressed(self):
+        """Подавленное с прошлого вызова: {отправитель: число}"""
+        suppressed, self.suppressed = self.suppressed, {}
+        return suppressed
+
+
+def set_receive_buffer(sock, size):
+    """SO_RCVBUF сокета; возвращает размер, который ядро выделило на самом деле.
+
+    Linux удваивает запрошенное значение и ограничивает его
+    ``net.core.rmem_max``: если вернулось меньше, лимит нужно поднять sysctl.
+    """
+    if size:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        except OSError as e:
+            print(f"Не удалось задать SO_RCVBUF={size}: {e}")
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+
+def udp_drops(sockets, path='/proc/net/udp'):
+    """Датаграммы, отброшенные ядром из-за переполненного буфера этих сокетов.
+
+    Берётся из последнего столбца ``/proc/net/udp`` по inode сокета; вне
+    Linux возвращает None.
+    """
+    inodes = set()
+    for sock in sockets:
+        try:
+            inodes.add(str(os.fstat(sock.fileno()).st_ino))
+        except (OSError, ValueError):
+            continue  # сокет уже закрыт
+    try:
+        with open(path, encoding='ascii') as table:
+            next(table)  # заголовок
+            return sum(int(fields[-1]) for fields in map(str.split, table)
+                       if len(fields) > 9 and fields[9] in inodes)
+    except (OSError, StopIteration, ValueError):
+        return None
@@ -0,0 +1,375 @@
+"""Ретранслятор чата между подсетями, без GUI.
+
+Multicast с TTL=1 не выходит за пределы своего сегмента. Ретранслятор
+слушает группу чата в своей подсети и пересылает датаграммы как есть по
+постоянным TCP-соединениям ретрансляторам других подсетей, а те
+выпускают их в свою группу. Клиентам ничего настраивать не нужно:
+на каждый сегмент достаточно одного ретранслятора.
+
+    python relay.py --peer 10.0.2.15:5009 --peer 10.0.3.15:5009
+    python relay.py --listen 5009 --allow 10.0.2.15,10.0.3.15 --groups dev,ops
+
+Каждая датаграмма, принятая из своей подсети, получает id: случайный id
+ретранслятора и его порядковый номер. По этому id копия, вернувшаяся по
+кольцу соседей, отбрасывается, а повтор сообщения отправителем (ответ на
+NACK) получает новый id и проходит. Свои же датаграммы, выпущенные в
+группу, ретранслятор узнаёт по хэшу содержимого и не пересылает повторно.
+Принимаются только адреса групп чата: произвольные адрес и порт из кадра
+соседа не используются.
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import os
+import socket
+import struct
+import time
+from collections import OrderedDict
+
+import groups
+import metrics
+from network import read_frames, write_frame
+from outbox import backoff_delay
+import protocol
+
+
+# Запись в кадре: id ретранслятора-источника, его номер датаграммы,
+# адрес и порт группы назначения, длина датаграммы
+RECORD_HEADER = struct.Struct('!8sQ4sHH')
+BATCH_MAX_BYTES = 64 * 1024
+LINK_QUEUE_LIMIT = 4096  # датаграмм в очереди к одному соседу
+MAX_CONNECT_ATTEMPTS = 16  # счётчик неудачных подключений к соседу: дальше задержка - cap
+
+DATAGRAMS_IN = metrics.counter('relay.datagrams_in')  # local / link
+DATAGRAMS_OUT = metrics.counter('relay.datagrams_out')  # local / link
+DUPLICATES = metrics.counter('relay.duplicates')  # loop / echo
+DROPPED = metrics.counter('relay.dropped')  # destination / overflow
+PACKET_TYPES = metrics.counter('relay.packet_types')
+BATCH_SIZE = metrics.histogram('relay.batch_datagrams', metrics.SIZE_BUCKETS)
+
+
+class _SeenIds:
+    """Id недавно пересланных датаграмм: отсекают петли между ретрансляторами"""
+
+    def __init__(self, max_entries=65536):
+        self.max_entries = max_entries
+        self._seen = OrderedDict()
+
+    def check_and_add(self, key):
+        """True, если датаграмма с таким id уже проходила"""
+        if key in self._seen:
+            return True
+        self._seen[key] = True
+        if len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+        return False
+
+
+class _EchoFilter:
+    """Датаграммы, которые мы сами выпустили в группу и сейчас услышим обратно.
+
+    Каждая выпущенная копия гасит ровно одну услышанную; копии, которые
+    не вернулись за ``window`` секунд, забываются.
+    """
+
+    def __init__(self, window=2.0):
+        self.window = window
+        self._pending = OrderedDict()  # хэш -> [число копий, время последней]
+
+    @staticmethod
+    def _key(datagram):
+        return hashlib.blake2b(datagram, digest_size=8).digest()
+
+    def _expire(self, now):
+        while self._pending:
+            key, (_, sent_at) = next(iter(self._pending.items()))
+            if now - sent_at <= self.window:
+                break
+            del self._pending[key]
+
+    def injected(self, datagram, now=None):
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        key = self._key(datagram)
+        entry = self._pending.pop(key, [0, now])
+        entry[0] += 1
+        entry[1] = now
+        self._pending[key] = entry
+
+    def is_echo(self, datagram, now=None):
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        key = self._key(datagram)
+        entry = self._pending.get(key)
+        if entry is None:
+            return False
+        entry[0] -= 1
+        if not entry[0]:
+            del self._pending[key]
+        return True
+
+
+class _Link:
+    """Соединение с соседним ретранслятором: очередь исходящих и запись пачками"""
+
+    def __init__(self, relay, name, writer):
+        self.relay = relay
+        self.name = name
+        self.writer = writer
+        self.queue = asyncio.Queue(LINK_QUEUE_LIMIT)
+        self.task = asyncio.get_running_loop().create_task(self._write_batches())
+
+    def send(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            # Сосед не успевает читать: теряем датаграмму, а не память
+            DROPPED.labels('overflow').inc()
+
+    async def _write_batches(self):
+        try:
+            while True:
+                batch = [await self.queue.get()]
+                size = len(batch[0][-1])
+                # Подождём попутные датаграммы, чтобы отправить их одним кадром
+                await asyncio.sleep(self.relay.batch_wait)
+                while not self.queue.empty() and size < BATCH_MAX_BYTES:
+                    record = self.queue.get_nowait()
+                    batch.append(record)
+                    size += len(record[-1])
+                write_frame(self.writer, encode_batch(batch))
+                BATCH_SIZE.observe(len(batch))
+                DATAGRAMS_OUT.labels('link').inc(len(batch))
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.writer.close()
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+
+def encode_batch(batch):
+    """Кадр из записей ``(id источника, номер, (адрес, порт), датаграмма)``"""
+    parts = []
+    for origin, number, (address, port), datagram in batch:
+        parts.append(RECORD_HEADER.pack(origin, number, socket.inet_aton(address), port, len(datagram)))
+        parts.append(datagram)
+    return b''.join(parts)
+
+
+def decode_batch(frame):
+    pos = 0
+    while pos < len(frame):
+        origin, number, packed_address, port, length = RECORD_HEADER.unpack_from(frame, pos)
+        pos += RECORD_HEADER.size
+        if pos + length > len(frame):
+            raise ValueError("Обрезанная запись в кадре ретранслятора")
+        yield origin, number, (socket.inet_ntoa(packed_address), port), frame[pos:pos + length]
+        pos += length
+
+
+class Relay:
+    """Мост между группой чата в своей подсети и соседними ретрансляторами"""
+
+    def __init__(self, multicast_group='224.1.1.1', multicast_port=5007, listen_port=5009,
+                 peers=(), group_names=(), multicast_ttl=1, batch_wait=0.005, allow=None):
+        self.multicast_group = multicast_group
+        self.multicast_port = multicast_port
+        self.listen_port = listen_port
+        self.peers = list(peers)  # [(хост, порт)] - к ним подключаемся сами
+        self.group_names = list(group_names)
+        self.multicast_ttl = multicast_ttl
+        self.batch_wait = batch_wait
+        self.allow = set(allow) if allow else None  # с каких IP принимать соседей
+        self.destinations = set(self.channels())
+
+        self.relay_id = os.urandom(8)
+        self._numbers = itertools.count()
+        self.seen = _SeenIds()
+        self.echoes = _EchoFilter()
+        self.links = set()
+        metrics.gauge('relay.links', lambda: len(self.links))
+
+    def channels(self):
+        """Группы, которые ретранслятор слушает в своей подсети"""
+        result = [(self.multicast_group, self.multicast_port)]
+        for name in self.group_names:
+            result.append(groups.channel_address(name, self.multicast_port))
+        return result
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
+        self.send_socket.setblocking(False)
+        self.send_transport, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, sock=self.send_socket)
+
+        for address, port in self.channels():
+            sock = groups.open_channel_socket(address, port)
+            await loop.create_datagram_endpoint(
+                lambda destination=(address, port): _LocalProtocol(self, destination), sock=sock)
+            print(f"Слушаю группу {address}:{port}")
+
+        if self.allow is None:
+            print("ВНИМАНИЕ: входящие соединения принимаются от любого адреса. "
+                  "Любой, кто достучится до порта, сможет писать в группы этой подсети")
+        server = await asyncio.start_server(self.handle_incoming, '0.0.0.0', self.listen_port)
+        print(f"Принимаю ретрансляторы на порту {self.listen_port}")
+        # Ссылки держим: иначе задачу может собрать сборщик мусора
+        self.connectors = [loop.create_task(self.keep_connected(host, port))
+                           for host, port in self.peers]
+        async with server:
+            await server.serve_forever()
+
+    # ------------------------------------------------------------------
+    # Из своей подсети - соседям
+    # ------------------------------------------------------------------
+
+    def handle_local(self, destination, datagram):
+        DATAGRAMS_IN.labels('local').inc()
+        if self.echoes.is_echo(datagram):
+            DUPLICATES.labels('echo').inc()  # наша же датаграмма от соседа
+            return
+        PACKET_TYPES.labels(protocol.packet_type(datagram)).inc()
+        record = (self.relay_id, next(self._numbers), destination, datagram)
+        self.seen.check_and_add(record[:2])
+        for link in self.links:
+            link.send(record)
+
+    # ------------------------------------------------------------------
+    # От соседей - в свою подсеть и дальше
+    # ------------------------------------------------------------------
+
+    async def handle_incoming(self, reader, writer):
+        peer_ip = writer.get_extra_info('peername')[0]
+        if self.allow is not None and peer_ip not in self.allow:
+            print(f"Отклонено соединение от {peer_ip}")
+            writer.close()
+            return
+        await self.serve_link(f"{peer_ip} (входящее)", reader, writer)
+
+    async def keep_connected(self, host, port):
+        """Постоянное соединение с соседом; при обрыве - повтор с задержкой"""
+        attempts = 0
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError as e:
+                # Дальше cap задержка всё равно не растёт, а счётчик не переполнится
+                attempts = min(attempts + 1, MAX_CONNECT_ATTEMPTS)
+                delay = backoff_delay(attempts, cap=60)
+                print(f"Нет связи с {host}:{port} ({e}), повтор через {delay:.0f} с")
+                await asyncio.sleep(delay)
+                continue
+            attempts = 0
+            try:
+                await self.serve_link(f"{host}:{port}", reader, writer)
+            except Exception as e:
+                # Задачу никто не ждёт: упав, она бы молча оставила соседа без связи
+                print(f"Ошибка связи с {host}:{port}: {e}")
+            await asyncio.sleep(1)
+
+    async def serve_link(self, name, reader, writer):
+        link = _Link(self, name, writer)
+        self.links.add(link)
+        print(f"Сосед подключён: {name}")
+        try:
+            async for frame in read_frames(reader):
+                for record in decode_batch(frame):
+                    self.handle_remote(link, record)
+        except (ConnectionError, OSError, ValueError, struct.error, asyncio.IncompleteReadError) as e:
+            print(f"Связь с {name} прервана: {e}")
+        finally:
+            self.links.discard(link)
+            link.close()
+            print(f"Сосед отключён: {name}")
+
+    def handle_remote(self, source, record):
+        origin, number, destination, datagram = record
+        DATAGRAMS_IN.labels('link').inc()
+        if destination not in self.destinations:
+            # Только группы чата: иначе сосед мог бы слать UDP куда угодно от нашего имени
+            DROPPED.labels('destination').inc()
+            return
+        if self.seen.check_and_add((origin, number)):
+            DUPLICATES.labels('loop').inc()
+            return
+        PACKET_TYPES.labels(protocol.packet_type(datagram)).inc()
+        self.echoes.injected(datagram)
+        self.send_transport.sendto(datagram, destination)
+        DATAGRAMS_OUT.labels('local').inc()
+        for link in self.links:
+            if link is not source:
+                link.send(record)
+
+
+class _LocalProtocol(asyncio.DatagramProtocol):
+    def __init__(self, relay, destination):
+        self.relay = relay
+        self.destination = destination
+
+    def datagram_received(self, data, addr):
+        self.relay.handle_local(self.destination, data)
+
+    def error_received(self, exc):
+        print(f"Ошибка приема multicast: {exc}")
+
+
+def parse_peer(value):
+    host, _, port = value.rpartition(':')
+    return (host, int(port)) if host else (value, 5009)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ретранслятор чата между подсетями")
+    parser.add_argument('--peer', action='append', default=[], type=parse_peer,
+                        help="ретранслятор другой подсети, хост[:порт]; можно несколько раз")
+    parser.add_argument('--listen', type=int, default=5009, help="порт для входящих ретрансляторов")
+    parser.add_argument('--allow', default='',
+                        help="IP ретрансляторов через запятую, от которых принимать соединения "
+                             "(по умолчанию - адреса из --peer)")
+    parser.add_argument('--allow-any', action='store_true',
+                        help="принимать соединения от любого адреса")
+    parser.add_argument('--group', default='224.1.1.1', help="multicast-группа общего чата")
+    parser.add_argument('--port', type=int, default=5007, help="multicast-порт общего чата")
+    parser.add_argument('--groups', default='', help="групповые чаты через запятую")
+    parser.add_argument('--batch-wait', type=float, default=0.005,
+                        help="секунд накопления датаграмм перед отправкой соседу")
+    parser.add_argument('--stats-port', type=int, default=None,
+                        help="локальный сокет статистики на 127.0.0.1")
+    args = parser.parse_args()
+
+    if args.allow_any:
+        args.allowed = None
+    else:
+        args.allowed = [ip for ip in args.allow.split(',') if ip]
+        for host, _ in args.peer:
+            try:
+                args.allowed.append(socket.gethostbyname(host))
+            except OSError as e:
+                parser.error(f"не удалось разрешить {host}: {e}")
+        if not args.allowed:
+            parser.error("укажите --allow или --peer, от кого принимать соединения "
+                         "(или явно --allow-any)")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    metrics.configure_from_env(default_port=args.stats_port)
+    relay = Relay(
+        multicast_group=args.group,
+        multicast_port=args.port,
+        listen_port=args.listen,
+        peers=args.peer,
+        group_names=[name for name in args.groups.split(',') if name],
+        batch_wait=args.batch_wait,
+        allow=args.allowed,
+    )
+    try:
+        asyncio.run(relay.run())
+    except KeyboardInterrupt:
+        pass
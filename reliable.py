@@ -0,0 +1,181 @@
+"""Надёжная доставка групповых сообщений поверх multicast.
+
+Отправитель нумерует свои сообщения (``epoch`` - случайный номер запуска,
+``seq`` - порядковый номер) и хранит последние из них в ``RetransmitBuffer``.
+Получатель по номерам отбрасывает дубликаты и замечает пропуски, в том числе
+в хвосте - по ``last_seq`` из heartbeat. О пропусках он просит NACK-ом в ту же
+группу после случайной задержки: увидев чужой NACK на те же номера, остальные
+получатели свой не шлют, а повтор отправителя достаётся всем сразу.
+Сообщения отдаются сразу по приходу, без ожидания пропущенных.
+"""
+import random
+import time
+from collections import OrderedDict
+
+
+class RetransmitBuffer:
+    """Последние отправленные сообщения для повторной отправки по NACK"""
+
+    def __init__(self, size=1024, min_interval=0.1):
+        self.size = size
+        self.min_interval = min_interval  # не чаще одного повтора номера за интервал
+        self._messages = OrderedDict()  # seq -> [сообщение, время последней отправки]
+
+    def add(self, seq, message):
+        self._messages[seq] = [message, 0.0]
+        while len(self._messages) > self.size:
+            self._messages.popitem(last=False)
+
+    def retransmit(self, seq, now=None):
+        """Сообщение для повтора или None, если его нет или его только что повторили"""
+        entry = self._messages.get(seq)
+        if entry is None:
+            return None
+        now = time.monotonic() if now is None else now
+        if now - entry[1] < self.min_interval:
+            return None
+        entry[1] = now
+        return entry[0]
+
+
+class _SenderState:
+    __slots__ = ('epoch', 'next_seq', 'highest', 'received', 'nacks')
+
+    def __init__(self, epoch, next_seq):
+        self.epoch = epoch
+        self.next_seq = next_seq  # все номера ниже получены или признаны потерянными
+        self.highest = next_seq - 1  # наибольший известный номер отправителя
+        self.received = set()  # полученные номера выше next_seq
+        self.nacks = {}  # пропущенный номер -> [отправлено NACK, время следующего]
+
+
+class ReliableReceiver:
+    """Учёт номеров сообщений по отправителям: дубликаты, пропуски, NACK.
+
+    Первое сообщение отправителя (или нового его запуска) задаёт начальный
+    номер - более раннюю историю не запрашиваем. Пропуск, который не удалось
+    восполнить за ``nack_attempts`` NACK, считается потерянным.
+    """
+
+    def __init__(self, nack_delay=0.05, nack_interval=0.3, nack_attempts=5,
+                 max_gap=256, max_nack_size=64):
+        self.nack_delay = nack_delay  # верхняя граница случайной задержки первого NACK
+        self.nack_interval = nack_interval
+        self.nack_attempts = nack_attempts
+        self.max_gap = max_gap  # больший разрыв - отправитель перезапущен или мы отстали
+        self.max_nack_size = max_nack_size
+        self.duplicates = 0
+        self.lost = 0
+        self._senders = {}
+
+    def _state(self, sender, epoch, seq):
+        state = self._senders.get(sender)
+        if state is None or state.epoch != epoch:
+            state = _SenderState(epoch, seq)
+            self._senders[sender] = state
+        elif seq - state.next_seq > self.max_gap:
+            state.next_seq = seq
+            state.highest = seq - 1
+            state.received.clear()
+            state.nacks.clear()
+        return state
+
+    def accept(self, sender, epoch, seq):
+        """Учёт полученного сообщения; False - это дубликат"""
+        state = self._state(sender, epoch, seq)
+        if seq < state.next_seq or seq in state.received:
+            self.duplicates += 1
+            return False
+        state.received.add(seq)
+        state.nacks.pop(seq, None)
+        state.highest = max(state.highest, seq)
+        self._advance(state)
+        return True
+
+    def advertise(self, sender, epoch, last_seq):
+        """Номер последнего сообщения из heartbeat: так замечаются потери в хвосте"""
+        state = self._senders.get(sender)
+        if state is None or state.epoch != epoch:
+            self._senders[sender] = _SenderState(epoch, last_seq + 1)
+            return
+        if last_seq - state.next_seq > self.max_gap:
+            self._state(sender, epoch, last_seq + 1)
+            return
+        state.highest = max(state.highest, last_seq)
+
+    def has_gaps(self):
+        return any(state.highest >= state.next_seq for state in self._senders.values())
+
+    def suppress(self, sender, epoch, seqs, now=None):
+        """Чужой NACK на те же номера: свой откладываем, повтор придёт всем"""
+        state = self._senders.get(sender)
+        if state is None or state.epoch != epoch:
+            return
+        now = time.monotonic() if now is None else now
+        for seq in seqs:
+            entry = state.nacks.get(seq)
+            if entry is not None:
+                entry[1] = max(entry[1], now + self.nack_interval)
+
+    def collect_nacks(self, now=None):
+        """Номера, о которых пора попросить, и число потерянных по отправителям.
+
+        Возвращает ``({отправитель: (epoch, [номера])}, {отправитель: потеряно})``.
+        """
+        now = time.monotonic() if now is None else now
+        nacks = {}
+        lost = {}
+        for sender, state in self._senders.items():
+            missing = []
+            for seq in range(state.next_seq, state.highest + 1):
+                if seq in state.received:
+                    continue
+                entry = state.nacks.get(seq)
+                if entry is None:
+                    entry = state.nacks[seq] = [0, now + random.uniform(0, self.nack_delay)]
+                if now < entry[1]:
+                    continue
+                if entry[0] >= self.nack_attempts:
+                    # Отправитель не ответил: номер уже вытеснен из его буфера
+                    state.received.add(seq)
+                    del state.nacks[seq]
+                    lost[sender] = lost.get(sender, 0) + 1
+                    continue
+                if len(missing) >= self.max_nack_size:
+                    continue  # остальное попросим следующим NACK
+                entry[0] += 1
+                entry[1] = now + self.nack_interval
+                missing.append(seq)
+            if missing:
+                nacks[sender] = (state.epoch, missing)
+            if sender in lost:
+                self.lost += lost[sender]
+                self._advance(state)
+        return nacks, lost
+
+    def next_check(self):
+        """Через сколько секунд снова вызывать ``collect_nacks``; None - пропусков нет"""
+        if not self.has_gaps():
+            return None
+        return min(self.nack_delay, self.nack_interval)
+
+    def forget(self, sender):
+        """Отправитель ушёл: его номера больше не отслеживаем ни в одном канале.
+
+        Ключ отправителя - его имя или пара ``(имя, канал)``.
+        """
+        for key in [key for key in self._senders
+                    if key == sender or (isinstance(key, tuple) and key[0] == sender)]:
+            del self._senders[key]
+
+    def forget_group(self, group):
+        """Мы вышли из канала: номера всех его отправителей больше не нужны"""
+        for key in [key for key in self._senders if isinstance(key, tuple) and key[1] == group]:
+            del self._senders[key]
+
+    @staticmethod
+    def _advance(state):
+        while state.next_seq in state.received:
+            state.received.discard(state.next_seq)
+            state.nacks.pop(state.next_seq, None)
+            state.next_seq += 1
@@ -0,0 +1,52 @@
+import unittest
+
+import language
+
+
+class DetectLanguageTest(unittest.TestCase):
+    def test_russian(self):
+        for text in ("Привет, как дела?", "Запушил фикс в master, посмотри"):
+            with self.subTest(text=text):
+                self.assertEqual(language.detect_language(text), 'ru')
+
+    def test_english(self):
+        for text in ("Hello, how are you doing today?", "build failed", "Deploy complete",
+                     "Tests passed", "Server restarted"):
+            with self.subTest(text=text):
+                self.assertEqual(language.detect_language(text), 'en')
+
+    def test_not_sure(self):
+        for text in ("ok", "", "12345 :) !!!", "privet kak dela", "Merci beaucoup",
+                     "guten Morgen", "la build a echoue", "https://example.com/a/b/c",
+                     "def f(x): return {x: [x * 2]}; y = f(3)"):
+            with self.subTest(text=text):
+                self.assertIsNone(language.detect_language(text))
+
+    def test_noise_is_ignored(self):
+        self.assertEqual(language.detect_language("Смотри https://example.com/path/to/page"), 'ru')
+
+    def test_translation_direction(self):
+        directions = [('en', 'ru')]
+        self.assertEqual(language.translation_direction("build failed", directions), ('en', 'ru'))
+        self.assertIsNone(language.translation_direction("Привет всем", directions))
+        self.assertIsNone(language.translation_direction("x = f(y);", directions))
+
+
+class SegmentTextTest(unittest.TestCase):
+    def test_short_text_is_one_segment(self):
+        self.assertEqual(language.segment_text("Hello."), [("Hello.", "")])
+
+    def test_segments_rejoin_to_original(self):
+        text = ("First sentence here. " * 30 + "\n\n" + "Second paragraph! " * 30
+                + " " + "word" * 150)
+        segments = language.segment_text(text, max_chars=200)
+        self.assertTrue(all(len(segment) <= 200 for segment, _ in segments))
+        self.assertEqual("".join(segment + separator for segment, separator in segments), text)
+
+    def test_paragraphs_are_not_merged(self):
+        segments = language.segment_text("a. " * 100 + "\n" + "b. " * 100, max_chars=250)
+        self.assertTrue(any("\n" in separator for _, separator in segments))
+
+
+if __name__ == '__main__':
+    unittest.main()
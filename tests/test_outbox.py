@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import outbox
+from outbox import Outbox
+
+
+class BackoffTest(unittest.TestCase):
+    def test_grows_and_caps(self):
+        for attempts, low, high in ((0, 0.5, 1), (3, 4, 8), (20, 150, 300)):
+            delay = outbox.backoff_delay(attempts)
+            self.assertTrue(low <= delay <= high, (attempts, delay))
+
+    def test_huge_attempt_count_does_not_overflow(self):
+        self.assertLessEqual(outbox.backoff_delay(1100), 300)
+        self.assertLessEqual(outbox.backoff_delay(10 ** 9, cap=60), 60)
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.outbox = Outbox(':memory:')
+        self.addCleanup(self.outbox.close)
+
+    def test_due_in_order(self):
+        first = self.outbox.add('10.0.0.1', 'one', '10:00')
+        second = self.outbox.add('10.0.0.1', 'two', '10:01')
+        self.assertEqual([r['id'] for r in self.outbox.due()], [first, second])
+        self.assertEqual(self.outbox.pending_count(), 2)
+        self.assertEqual(self.outbox.pending_count('10.0.0.1'), 2)
+        self.assertEqual(self.outbox.pending_count('10.0.0.2'), 0)
+
+    def test_sent_waits_for_ack_and_counts_sends(self):
+        message_id = self.outbox.add('10.0.0.1', 'hi', '10:00')
+        self.assertTrue(self.outbox.mark_sent(message_id, 30))
+        self.assertEqual(self.outbox.due(), [])
+        (record,) = self.outbox.due(now=time.time() + 31)
+        self.assertEqual((record['state'], record['sends']), (outbox.SENT, 1))
+        self.assertTrue(self.outbox.delivered(message_id))
+        self.assertFalse(self.outbox.delivered(message_id))
+        self.assertFalse(self.outbox.mark_sent(message_id, 30))
+
+    def test_failed_is_terminal(self):
+        message_id = self.outbox.add('10.0.0.1', 'hi', '10:00')
+        self.outbox.fail(message_id)
+        self.assertEqual(self.outbox.due(now=time.time() + 10 ** 6), [])
+        self.assertIsNone(self.outbox.next_due())
+        self.assertEqual(self.outbox.pending_count(), 0)
+        self.assertEqual(self.outbox.expedite('10.0.0.1'), 0)
+        self.assertEqual(self.outbox.retarget('10.0.0.1', '10.0.0.2'), 0)
+
+    def test_reschedule_and_expedite(self):
+        message_id = self.outbox.add('10.0.0.1', 'hi', '10:00')
+        self.outbox.reschedule(message_id, 3, 100)
+        self.assertEqual(self.outbox.due(), [])
+        self.assertEqual(self.outbox.expedite('10.0.0.1'), 1)
+        (record,) = self.outbox.due()
+        self.assertEqual((record['state'], record['attempts']), (outbox.RETRY, 0))
+
+    def test_expedite_leaves_sent_alone(self):
+        message_id = self.outbox.add('10.0.0.1', 'hi', '10:00')
+        self.outbox.mark_sent(message_id, 30)
+        self.assertEqual(self.outbox.expedite('10.0.0.1'), 0)
+
+    def test_retarget(self):
+        self.outbox.add('10.0.0.1', 'hi', '10:00')
+        self.assertEqual(self.outbox.retarget('10.0.0.1', '10.0.0.2'), 1)
+        self.assertEqual([r['target'] for r in self.outbox.due()], ['10.0.0.2'])
+
+
+class OutboxFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'outbox.sqlite3')
+
+    def test_survives_restart_and_resends_immediately(self):
+        first = Outbox(self.path)
+        message_id = first.add('10.0.0.1', 'hi', '10:00')
+        first.mark_sent(message_id, 3600)
+        first.close()
+        second = Outbox(self.path)
+        self.addCleanup(second.close)
+        self.assertEqual([r['id'] for r in second.due()], [message_id])
+
+    def test_old_schema_gets_sends_column(self):
+        db = sqlite3.connect(self.path)
+        db.execute("""
+            CREATE TABLE outbox (id TEXT PRIMARY KEY, target TEXT NOT NULL, message TEXT NOT NULL,
+                                 timestamp TEXT NOT NULL, created REAL NOT NULL,
+                                 attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL,
+                                 state TEXT NOT NULL)
+        """)
+        db.execute("INSERT INTO outbox VALUES ('old', '10.0.0.1', 'hi', '10:00', 0, 0, 0, 'sent')")
+        db.commit()
+        db.close()
+        migrated = Outbox(self.path)
+        self.addCleanup(migrated.close)
+        self.assertEqual([r['sends'] for r in migrated.due()], [0])
+        migrated.add('10.0.0.1', 'new', '10:01')
+        self.assertEqual(migrated.pending_count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
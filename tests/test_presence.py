@@ -0,0 +1,61 @@
+import unittest
+
+import presence
+from presence import JOIN, LEAVE, REFRESH, PresenceIndex
+
+
+class PresenceIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = PresenceIndex(timeout=10, forget_after=30)
+
+    def test_join_refresh_expire_forget(self):
+        self.assertEqual(self.index.touch('a', now=0), (JOIN, 'a'))
+        self.assertEqual(self.index.touch('a', now=5), (REFRESH, 'a'))
+        self.assertEqual(self.index.expire(now=12), [])  # срок сдвинулся на 15
+        self.assertEqual(self.index.expire(now=15), [(LEAVE, 'a')])
+        self.assertFalse(self.index.is_online('a'))
+        self.index.expire(now=100)
+        self.assertNotIn('a', self.index.users)
+
+    def test_offline_user_comes_back(self):
+        self.index.touch('a', now=0)
+        self.index.expire(now=10)
+        self.assertEqual(self.index.touch('a', now=16), (JOIN, 'a'))
+        self.assertTrue(self.index.is_online('a'))
+
+    def test_individual_timeout_never_shorter(self):
+        self.index.touch('slow', now=0, timeout=60)
+        self.index.touch('fast', now=0, timeout=1)
+        self.assertEqual(self.index.expire(now=11), [(LEAVE, 'fast')])
+        self.assertEqual(self.index.expire(now=61), [(LEAVE, 'slow')])
+
+    def test_learn_only_unknown_and_fresh(self):
+        self.index.touch('a', now=0)
+        self.assertIsNone(self.index.learn('a', 0, now=1))
+        self.assertIsNone(self.index.learn('old', 20, now=1))
+        self.assertEqual(self.index.learn('b', 3, now=1), (JOIN, 'b'))
+        self.assertEqual(self.index.expire(now=8), [(LEAVE, 'b')])
+
+    def test_remove(self):
+        self.index.touch('a', now=0)
+        self.assertEqual(self.index.remove('a'), (LEAVE, 'a'))
+        self.assertIsNone(self.index.remove('a'))
+        self.assertEqual(self.index.expire(now=100), [])
+
+    def test_listing(self):
+        for user in ('b', 'a'):
+            self.index.touch(user, now=0)
+        self.assertEqual(self.index.online(), ['a', 'b'])
+        self.assertEqual(self.index.online_count(), 2)
+        self.assertEqual(self.index.ages(now=4), {'a': 4, 'b': 4})
+        self.assertEqual(self.index.next_deadline(), 10)
+
+    def test_adaptive_interval(self):
+        self.assertEqual(presence.adaptive_interval(25, 10, 2.0), 25)
+        self.assertEqual(presence.adaptive_interval(25, 200, 2.0), 100)
+        for _ in range(100):
+            self.assertTrue(8 <= presence.jittered(10) <= 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
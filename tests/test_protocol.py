@@ -0,0 +1,144 @@
+import json
+import random
+import unittest
+import zlib
+
+import protocol
+
+
+class CodecTest(unittest.TestCase):
+    def test_binary_round_trip(self):
+        message = {'type': 'group_message', 'username': '10.0.0.1', 'message': 'привет',
+                   'seq': 5, 'epoch': 123456789, 'hello': True, 'users': ['a', 'b'],
+                   'ages': [0, 1.5], 'custom_key': None}
+        self.assertEqual(protocol.decode(protocol.encode(message)), message)
+
+    def test_legacy_json_round_trip(self):
+        message = {'type': 'user_online', 'username': '10.0.0.1'}
+        packet = protocol.encode(message, legacy=True)
+        self.assertEqual(json.loads(packet), message)
+        self.assertEqual(protocol.decode(packet), message)
+
+    def test_long_body_is_compressed(self):
+        message = {'type': 'group_message', 'message': 'abc ' * 500}
+        packet = protocol.encode(message)
+        self.assertTrue(packet[2] & protocol.FLAG_COMPRESSED)
+        self.assertEqual(protocol.decode(packet), message)
+
+    def test_message_without_type(self):
+        # Так хранятся записи истории
+        record = {'conversation': 'group', 'text': 'x'}
+        self.assertEqual(protocol.decode(protocol.encode(record)), record)
+
+    def test_unknown_type_code_gets_service_name(self):
+        packet = protocol.HEADER.pack(protocol.MAGIC, protocol.VERSION, 0, 200)
+        self.assertEqual(protocol.decode(packet), {'type': 'unknown_200'})
+
+    def test_malformed_packets_raise_protocol_error(self):
+        good = protocol.encode({'type': 'group_message', 'message': 'hello'})
+        bad = [
+            b'',
+            b'\x00',
+            b'{not json',
+            b'{"type": "x"',
+            '{"type": "é"}'.encode('latin-1'),
+            good[:-2],
+            protocol.HEADER.pack(protocol.MAGIC, protocol.VERSION, protocol.FLAG_COMPRESSED, 1) + b'junk',
+        ]
+        for packet in bad:
+            with self.subTest(packet=packet):
+                with self.assertRaises(protocol.ProtocolError):
+                    protocol.decode(packet)
+
+    def test_decompression_is_bounded(self):
+        body = zlib.compress(b'\0' * (protocol.MAX_MESSAGE_SIZE * 4))
+        packet = protocol.HEADER.pack(protocol.MAGIC, protocol.VERSION, protocol.FLAG_COMPRESSED, 1) + body
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.decode(packet)
+
+    def test_type_label(self):
+        self.assertEqual(protocol.type_label('group_message'), 'group_message')
+        for value in ('made_up', 'unknown_77', None, ['list'], 5):
+            self.assertEqual(protocol.type_label(value), 'other')
+
+
+class FragmentTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(1)  # случайный текст почти не сжимается zlib
+        self.message = {'type': 'group_message', 'username': 'u',
+                        'message': ''.join(chr(0x400 + rng.randrange(200)) for _ in range(10000))}
+        self.datagrams = protocol.encode_datagrams(self.message)
+
+    def test_fragments_fit_datagram(self):
+        self.assertGreater(len(self.datagrams), 1)
+        self.assertTrue(all(len(d) <= protocol.MAX_DATAGRAM_SIZE for d in self.datagrams))
+
+    def test_reassembly_in_any_order(self):
+        reassembler = protocol.FragmentReassembler()
+        results = [reassembler.feed(d, 'a') for d in reversed(self.datagrams)]
+        self.assertEqual(results[-1], self.message)
+        self.assertTrue(all(result is None for result in results[:-1]))
+        self.assertEqual(reassembler.buffered, 0)
+        self.assertEqual(reassembler.pending, {})
+
+    def test_same_id_from_different_senders_kept_apart(self):
+        reassembler = protocol.FragmentReassembler()
+        for datagram in self.datagrams[:-1]:
+            reassembler.feed(datagram, 'a')
+        self.assertIsNone(reassembler.feed(self.datagrams[-1], 'b'))
+        self.assertEqual(reassembler.feed(self.datagrams[-1], 'a'), self.message)
+
+    def test_count_mismatch_rejected(self):
+        reassembler = protocol.FragmentReassembler()
+        reassembler.feed(self.datagrams[0], 'a')
+        message_id, index, count = protocol.FRAGMENT_HEADER.unpack_from(self.datagrams[1], protocol.HEADER.size)
+        forged = (self.datagrams[1][:protocol.HEADER.size]
+                  + protocol.FRAGMENT_HEADER.pack(message_id, index, count + 1)
+                  + self.datagrams[1][protocol.HEADER.size + protocol.FRAGMENT_HEADER.size:])
+        with self.assertRaises(protocol.ProtocolError):
+            reassembler.feed(forged, 'a')
+        self.assertEqual(reassembler.buffered, 0)
+
+    def test_bad_fragment_headers_rejected(self):
+        header = protocol.HEADER.pack(protocol.MAGIC, protocol.VERSION, protocol.FLAG_FRAGMENT, 0)
+        bad = [
+            header + b'\0',
+            header + protocol.FRAGMENT_HEADER.pack(1, 0, 0),
+            header + protocol.FRAGMENT_HEADER.pack(1, 3, 3),
+            header + protocol.FRAGMENT_HEADER.pack(1, 0, protocol.MAX_FRAGMENTS + 1),
+            header + protocol.FRAGMENT_HEADER.pack(1, 0, 2) + b'x' * protocol.MAX_DATAGRAM_SIZE,
+        ]
+        reassembler = protocol.FragmentReassembler()
+        for datagram in bad:
+            with self.subTest(datagram=datagram[:16]):
+                with self.assertRaises(protocol.ProtocolError):
+                    reassembler.feed(datagram, 'a')
+
+    def test_byte_budget_evicts_oldest(self):
+        budget = sum(len(d) for d in self.datagrams) + 100
+        reassembler = protocol.FragmentReassembler(max_bytes=budget)
+        for datagram in self.datagrams[:-1]:
+            reassembler.feed(datagram, 'old')
+        for datagram in self.datagrams[:-1]:
+            reassembler.feed(datagram, 'new')
+        self.assertLessEqual(reassembler.buffered, budget)
+        self.assertEqual([key[0] for key in reassembler.pending], ['new'])
+        self.assertEqual(reassembler.feed(self.datagrams[-1], 'new'), self.message)
+
+    def test_pending_limit_and_expiry(self):
+        reassembler = protocol.FragmentReassembler(timeout=10, max_pending=2)
+        for sender in ('a', 'b', 'c'):
+            reassembler.feed(self.datagrams[0], sender)
+        self.assertEqual(sorted(key[0] for key in reassembler.pending), ['b', 'c'])
+        reassembler.expire(now=float('inf'))
+        self.assertEqual(reassembler.pending, {})
+        self.assertEqual(reassembler.buffered, 0)
+
+    def test_too_large_message_refused(self):
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.encode_datagrams({'type': 'group_message',
+                                       'message': random.Random(2).randbytes(protocol.MAX_MESSAGE_SIZE)})
+
+
+if __name__ == '__main__':
+    unittest.main()
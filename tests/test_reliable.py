@@ -0,0 +1,87 @@
+import unittest
+
+from reliable import ReliableReceiver, RetransmitBuffer
+
+
+class RetransmitBufferTest(unittest.TestCase):
+    def test_keeps_last_messages(self):
+        buffer = RetransmitBuffer(size=2)
+        for seq in range(3):
+            buffer.add(seq, f'm{seq}')
+        self.assertIsNone(buffer.retransmit(0, now=10))
+        self.assertEqual(buffer.retransmit(2, now=10), 'm2')
+
+    def test_throttles_repeats(self):
+        buffer = RetransmitBuffer(min_interval=1.0)
+        buffer.add(1, 'm')
+        self.assertEqual(buffer.retransmit(1, now=10), 'm')
+        self.assertIsNone(buffer.retransmit(1, now=10.5))
+        self.assertEqual(buffer.retransmit(1, now=11.5), 'm')
+
+
+class ReliableReceiverTest(unittest.TestCase):
+    def setUp(self):
+        self.receiver = ReliableReceiver(nack_delay=0.0, nack_interval=1.0, nack_attempts=2)
+
+    def test_duplicates(self):
+        self.assertTrue(self.receiver.accept('a', 1, 10))
+        self.assertFalse(self.receiver.accept('a', 1, 10))
+        self.assertTrue(self.receiver.accept('a', 1, 11))
+        self.assertEqual(self.receiver.duplicates, 1)
+        self.assertFalse(self.receiver.has_gaps())
+
+    def test_gap_is_nacked_and_filled(self):
+        self.receiver.accept('a', 1, 1)
+        self.receiver.accept('a', 1, 4)
+        self.assertTrue(self.receiver.has_gaps())
+        nacks, lost = self.receiver.collect_nacks(now=0)
+        self.assertEqual(nacks, {'a': (1, [2, 3])})
+        self.assertEqual(lost, {})
+        # Повторный NACK - только через nack_interval
+        self.assertEqual(self.receiver.collect_nacks(now=0.5), ({}, {}))
+        self.receiver.accept('a', 1, 2)
+        self.receiver.accept('a', 1, 3)
+        self.assertFalse(self.receiver.has_gaps())
+        self.assertIsNone(self.receiver.next_check())
+
+    def test_unanswered_gap_counted_lost(self):
+        self.receiver.accept('a', 1, 1)
+        self.receiver.accept('a', 1, 3)
+        for now in (0, 1, 2):
+            nacks, lost = self.receiver.collect_nacks(now=now)
+        self.assertEqual(lost, {'a': 1})
+        self.assertEqual(self.receiver.lost, 1)
+        self.assertFalse(self.receiver.has_gaps())
+
+    def test_foreign_nack_suppresses_ours(self):
+        self.receiver.accept('a', 1, 1)
+        self.receiver.accept('a', 1, 3)
+        self.receiver.collect_nacks(now=0)
+        self.receiver.suppress('a', 1, [2], now=0.9)
+        self.assertEqual(self.receiver.collect_nacks(now=1.0), ({}, {}))
+        self.assertEqual(self.receiver.collect_nacks(now=2.0)[0], {'a': (1, [2])})
+
+    def test_tail_loss_found_by_advertise(self):
+        self.receiver.accept('a', 1, 1)
+        self.receiver.advertise('a', 1, 3)
+        self.assertEqual(self.receiver.collect_nacks(now=0)[0], {'a': (1, [2, 3])})
+
+    def test_new_epoch_and_large_gap_restart_tracking(self):
+        self.receiver.accept('a', 1, 1)
+        self.assertTrue(self.receiver.accept('a', 2, 1))
+        self.assertTrue(self.receiver.accept('a', 2, 1 + self.receiver.max_gap + 10))
+        self.assertFalse(self.receiver.has_gaps())
+
+    def test_forget(self):
+        self.receiver.accept(('a', 'dev'), 1, 1)
+        self.receiver.accept(('a', 'dev'), 1, 3)
+        self.receiver.accept(('b', 'ops'), 1, 1)
+        self.receiver.accept(('b', 'ops'), 1, 3)
+        self.receiver.forget('a')
+        self.assertEqual(list(self.receiver.collect_nacks(now=0)[0]), [('b', 'ops')])
+        self.receiver.forget_group('ops')
+        self.assertFalse(self.receiver.has_gaps())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,27 @@
 from flask import Flask, request, jsonify
 from transformers import MarianMTModel, MarianTokenizer
+import torch
+import argparse
+import statistics
 import threading
 import logging
 import socket
 import threading
 import time
-import json
+import itertools
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 from datetime import datetime
 import sys
 
+import language
+import metrics
+import protocol
+import reliable
+from translation_cache import TranslationCache
+from translator_pool import TranslatorPool, OrderedDelivery
+
 # Отключаем лишние логи
 logging.getLogger("transformers").setLevel(logging.ERROR)
 
@@ -17,6 +30,59 @@ app = Flask(__name__)
 # Словарь моделей: (src_lang, tgt_lang) -> (tokenizer, model)
 MODELS = {}
 MODEL_LOCK = threading.Lock()
+MODEL_LOAD_TIMES = {}  # (src_lang, tgt_lang) -> секунд на загрузку и подготовку
+
+# Динамическая int8-квантизация Linear-слоёв для CPU (включается --quantize)
+QUANTIZE = False
+
+WARMUP_TEXTS = {
+    'en': ["Hello, how are you?", "The build has finished successfully."],
+    'ru': ["Привет, как дела?", "Сборка успешно завершена."],
+}
+
+SUPPORTED_PAIRS = {('ru', 'en'), ('en', 'ru')}
+
+# Какие переводы делает мост в чате (ключ --directions); по умолчанию только en → ru
+TRANSLATE_DIRECTIONS = [('en', 'ru')]
+
+TRANSLATOR_NAME = "переводичик"
+TRANSLATOR_HEARTBEAT_INTERVAL = 5  # секунд между объявлениями переводчика
+
+# Кэш переводов: повторяющиеся фразы не гоняются через модель
+CACHE = TranslationCache()
+
+# Микробатчинг: ждём до BATCH_MAX_WAIT секунд или до BATCH_MAX_SIZE текстов
+BATCH_MAX_SIZE = 16
+BATCH_MAX_WAIT = 0.01
+
+# Метрики переводчика (в воркерах пула - свои, процессные)
+MODEL_LOAD = metrics.histogram('trans.model_load_s')
+GENERATE_TIME = metrics.histogram('trans.generate_s')
+BATCH_SIZE = metrics.histogram('trans.batch_size', metrics.SIZE_BUCKETS)
+SEGMENTS_PER_TEXT = metrics.histogram('trans.segments_per_text', metrics.SIZE_BUCKETS)
+TRANSLATION_LATENCY = metrics.histogram('trans.translation_latency_s')  # от submit до перевода
+BRIDGE_PACKETS = metrics.counter('trans.bridge_packets_in')
+BRIDGE_DECODE_ERRORS = metrics.counter('trans.bridge_decode_errors')
+metrics.gauge('trans.cache', CACHE.stats)
+metrics.gauge('trans.queue', lambda: SCHEDULER.pending_count())
+
+def get_model_name(src_lang, tgt_lang):
+    return f"Helsinki-NLP/opus-mt-{src_lang}-{tgt_lang}"
+
+def get_cache_model_key(src_lang, tgt_lang):
+    """Имя модели для ключа кэша: int8 может переводить чуть иначе, чем fp32"""
+    name = get_model_name(src_lang, tgt_lang)
+    return f"{name}+int8" if QUANTIZE else name
+
+def load_model(src_lang, tgt_lang, quantize=False):
+    """Загрузка токенизатора и модели (без регистрации в MODELS)"""
+    model_name = get_model_name(src_lang, tgt_lang)
+    tokenizer = MarianTokenizer.from_pretrained(model_name)
+    model = MarianMTModel.from_pretrained(model_name)
+    model.eval()
+    if quantize:
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return tokenizer, model
 
 def get_translator(src_lang, tgt_lang):
     key = (src_lang, tgt_lang)
@@ -24,27 +90,292 @@ def get_translator(src_lang, tgt_lang):
         with MODEL_LOCK:
             if key not in MODELS:
                 print(f"Загрузка модели {src_lang} → {tgt_lang}...")
-                model_name = f"Helsinki-NLP/opus-mt-{src_lang}-{tgt_lang}"
-                tokenizer = MarianTokenizer.from_pretrained(model_name)
-                model = MarianMTModel.from_pretrained(model_name)
-                MODELS[key] = (tokenizer, model)
-                print(f"Модель {src_lang} → {tgt_lang} загружена.")
+                started = time.perf_counter()
+                MODELS[key] = load_model(src_lang, tgt_lang, quantize=QUANTIZE)
+                MODEL_LOAD_TIMES[key] = time.perf_counter() - started
+                MODEL_LOAD.observe(MODEL_LOAD_TIMES[key])
+                print(f"Модель {src_lang} → {tgt_lang} загружена за {MODEL_LOAD_TIMES[key]:.1f} с.")
     return MODELS[key]
 
+def generate(tokenizer, model, texts):
+    """Один проход модели по батчу текстов, без кэша"""
+    inputs = tokenizer(texts, return_tensors="pt", padding=True, truncation=True, max_length=512)
+    with GENERATE_TIME.time(), torch.inference_mode():
+        translated = model.generate(**inputs)
+    return tokenizer.batch_decode(translated, skip_special_tokens=True)
+
+def warmup(src_lang, tgt_lang):
+    """Прогрев модели, чтобы первое настоящее сообщение не платило за первый вызов"""
+    tokenizer, model = get_translator(src_lang, tgt_lang)
+    started = time.perf_counter()
+    generate(tokenizer, model, WARMUP_TEXTS[src_lang])
+    print(f"Прогрев {src_lang} → {tgt_lang}: {time.perf_counter() - started:.2f} с.")
+
+def preload_models(pairs=SUPPORTED_PAIRS):
+    """Загрузка и прогрев всех пар при старте"""
+    for src_lang, tgt_lang in sorted(pairs):
+        warmup(src_lang, tgt_lang)
+
+def compare_quantization(pairs=SUPPORTED_PAIRS, runs=5):
+    """Сравнение fp32 и int8: время загрузки и средняя задержка перевода"""
+    for src_lang, tgt_lang in sorted(pairs):
+        texts = WARMUP_TEXTS[src_lang]
+        for quantize in (False, True):
+            started = time.perf_counter()
+            tokenizer, model = load_model(src_lang, tgt_lang, quantize=quantize)
+            load_time = time.perf_counter() - started
+
+            generate(tokenizer, model, texts)  # первый вызов не считаем
+            latencies = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                generate(tokenizer, model, texts)
+                latencies.append(time.perf_counter() - started)
+
+            variant = "int8" if quantize else "fp32"
+            print(f"{src_lang} → {tgt_lang} {variant}: загрузка {load_time:.2f} с, "
+                  f"перевод {statistics.mean(latencies) * 1000:.0f} мс "
+                  f"(медиана {statistics.median(latencies) * 1000:.0f} мс, батч {len(texts)})")
+
+def translate_batch(texts, src, tgt):
+    """Перевод списка текстов одним вызовом generate с паддингом."""
+    if (src, tgt) not in SUPPORTED_PAIRS:
+        raise ValueError(f"Неподдерживаемая языковая пара: {src} → {tgt}")
+
+    model_name = get_cache_model_key(src, tgt)
+    results = [""] * len(texts)
+    # Пустые строки и найденное в кэше модели не отдаём
+    indices = []
+    for i, text in enumerate(texts):
+        if not text.strip():
+            continue
+        cached = CACHE.get(src, tgt, model_name, text)
+        if cached is None:
+            indices.append(i)
+        else:
+            results[i] = cached
+    if not indices:
+        return results
+
+    tokenizer, model = get_translator(src, tgt)
+    for i, result in zip(indices, generate(tokenizer, model, [texts[i] for i in indices])):
+        results[i] = result
+        CACHE.put(src, tgt, model_name, texts[i], result)
+    return results
+
 def translate_text(text, src, tgt):
     """Возвращает переведённый текст или raise Exception."""
-    if not text.strip():
-        return ""
+    return translate_batch([text], src, tgt)[0]
+
+
+class TranslationScheduler:
+    """Очередь перевода с динамическим микробатчингом.
+
+    Приёмный цикл только кладёт тексты через ``submit`` и сразу возвращается
+    к сокету. Рабочий поток собирает тексты, пришедшие за ``max_wait``
+    секунд (но не больше ``max_batch``), и переводит каждую языковую пару
+    одним батчем. Результат приходит через ``concurrent.futures.Future``.
+
+    Длинные тексты режутся на предложения, и сегменты разных запросов
+    берутся в батч по кругу: короткое сообщение не ждёт, пока переведётся
+    весь длинный текст, пришедший раньше.
+
+    Если задан ``pool`` (TranslatorPool), батчи уходят в процессы-воркеры и
+    переводятся параллельно; иначе - прямо в рабочем потоке.
+    """
+
+    def __init__(self, max_batch=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT, pool=None):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pool = pool
+        self._pending = OrderedDict()  # id запроса -> deque((текст, src, tgt, future))
+        self._pending_count = 0
+        self._request_ids = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def submit(self, text, src, tgt):
+        """Постановка текста в очередь; возвращает Future с переводом"""
+        started = time.perf_counter()
+        segments = language.segment_text(text)
+        SEGMENTS_PER_TEXT.observe(len(segments))
+        if len(segments) == 1:
+            future = Future()
+            self._enqueue([(text, src, tgt, future)])
+        else:
+            parts = [Future() for _ in segments]
+            self._enqueue([(segment, src, tgt, part) for (segment, _), part in zip(segments, parts)])
+            future = self._join_segments(segments, parts)
+        future.add_done_callback(lambda _: TRANSLATION_LATENCY.observe(time.perf_counter() - started))
+        return future
+
+    def pending_count(self):
+        with self._condition:
+            return self._pending_count
+
+    def _enqueue(self, items):
+        with self._condition:
+            self._pending[next(self._request_ids)] = deque(items)
+            self._pending_count += len(items)
+            self._condition.notify()
+
+    @staticmethod
+    def _join_segments(segments, parts):
+        """Future, которое завершится склейкой переводов всех сегментов"""
+        future = Future()
+        future.set_running_or_notify_cancel()
+        remaining = [len(parts)]
+        lock = threading.Lock()
+
+        def part_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            for part in parts:
+                if part.exception() is not None:
+                    future.set_exception(part.exception())
+                    return
+            future.set_result("".join(
+                part.result() + separator for part, (_, separator) in zip(parts, segments)))
 
-    supported_pairs = {('ru', 'en'), ('en', 'ru')}
-    if (src, tgt) not in supported_pairs:
+        for part in parts:
+            part.add_done_callback(part_done)
+        return future
+
+    def _collect(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+
+            batch = []
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                if not self._pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                    continue
+                # По одному сегменту от каждого запроса по кругу
+                request_id, items = next(iter(self._pending.items()))
+                batch.append(items.popleft())
+                if items:
+                    self._pending.move_to_end(request_id)
+                else:
+                    del self._pending[request_id]
+            self._pending_count -= len(batch)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+
+            by_pair = {}
+            for text, src, tgt, future in batch:
+                if future.set_running_or_notify_cancel():
+                    by_pair.setdefault((src, tgt), []).append((text, future))
+
+            for (src, tgt), items in by_pair.items():
+                texts = [text for text, _ in items]
+                BATCH_SIZE.observe(len(texts))
+                if self.pool is not None:
+                    # Блокируется, пока все воркеры заняты
+                    batch_future = self.pool.submit_batch(texts, src, tgt)
+                    batch_future.add_done_callback(lambda f, items=items: self._resolve(items, f))
+                    continue
+                try:
+                    results = translate_batch(texts, src, tgt)
+                except Exception as e:
+                    self._fail(items, e)
+                    continue
+                for (_, future), result in zip(items, results):
+                    future.set_result(result)
+
+    def _resolve(self, items, batch_future):
+        try:
+            results = batch_future.result()
+        except Exception as e:
+            self._fail(items, e)
+            return
+        for (_, future), result in zip(items, results):
+            future.set_result(result)
+
+    @staticmethod
+    def _fail(items, error):
+        for _, future in items:
+            future.set_exception(error)
+
+# Общий планировщик: им пользуются и multicast-мост, и HTTP API
+SCHEDULER = TranslationScheduler()
+
+HTTP_REQUEST_TIMEOUT = 120  # секунд ожидания перевода для HTTP-запроса
+HTTP_MAX_BATCH = 256  # текстов в одном запросе /translate/batch
+
+
+def _parse_pair(payload):
+    src = payload.get('src', 'en')
+    tgt = payload.get('tgt', 'ru')
+    if (src, tgt) not in SUPPORTED_PAIRS:
         raise ValueError(f"Неподдерживаемая языковая пара: {src} → {tgt}")
+    return src, tgt
 
-    tokenizer, model = get_translator(src, tgt)
-    inputs = tokenizer(text, return_tensors="pt", padding=True, truncation=True, max_length=512)
-    translated = model.generate(**inputs)
-    result = tokenizer.decode(translated[0], skip_special_tokens=True)
-    return result
+@app.route('/translate', methods=['POST'])
+def http_translate():
+    """Перевод одного текста: {"text", "src", "tgt"} -> {"translation"}"""
+    payload = request.get_json(silent=True) or {}
+    text = payload.get('text')
+    if not isinstance(text, str):
+        return jsonify({'error': "Поле text обязательно"}), 400
+    try:
+        src, tgt = _parse_pair(payload)
+        translation = SCHEDULER.submit(text, src, tgt).result(timeout=HTTP_REQUEST_TIMEOUT)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'translation': translation, 'src': src, 'tgt': tgt})
+
+@app.route('/translate/batch', methods=['POST'])
+def http_translate_batch():
+    """Перевод списка: {"texts", "src", "tgt"} -> {"translations"}.
+
+    Тексты идут в общий планировщик и попадают в те же батчи, что и чат.
+    """
+    payload = request.get_json(silent=True) or {}
+    texts = payload.get('texts')
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return jsonify({'error': "Поле texts должно быть списком строк"}), 400
+    if len(texts) > HTTP_MAX_BATCH:
+        return jsonify({'error': f"Не больше {HTTP_MAX_BATCH} текстов за запрос"}), 400
+    try:
+        src, tgt = _parse_pair(payload)
+        futures = [SCHEDULER.submit(text, src, tgt) for text in texts]
+        deadline = time.monotonic() + HTTP_REQUEST_TIMEOUT
+        translations = [future.result(timeout=max(0, deadline - time.monotonic()))
+                        for future in futures]
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'translations': translations, 'src': src, 'tgt': tgt})
+
+@app.route('/stats', methods=['GET'])
+def http_stats():
+    """Статистика кэша и загруженных моделей"""
+    # Метрики и стеки профилировщика отдаются только локальным сокетом
+    # (--stats-port): HTTP API слушает все интерфейсы
+    return jsonify({
+        'cache': CACHE.stats(),
+        'models': {f"{src}-{tgt}": round(seconds, 2) for (src, tgt), seconds in MODEL_LOAD_TIMES.items()},
+        'queue': SCHEDULER.pending_count(),
+        'pool': SCHEDULER.pool.stats() if SCHEDULER.pool is not None else None,
+    })
 
 # тест
 def setup_sockets():
@@ -58,7 +389,7 @@ def setup_sockets():
             multicast_port = 5007
             # Multicast сокет для группового чата
             multicast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
+            multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
         
           # Таймаут для неблокирующей работы
             
@@ -72,19 +403,80 @@ def send_group_message(message):
     timestamp = datetime.now().strftime("%H:%M:%S")
     data = {
         'type': 'group_message',
-        'username': "переводичик",
+        'username': TRANSLATOR_NAME,
         'message': message,
-        'timestamp': timestamp
+        'timestamp': timestamp,
+        # Метка перевода: такие сообщения никогда не переводятся повторно
+        'translated': True,
+        'translator_id': ELECTION.translator_id
     }
         
-    json_data = json.dumps(data).encode('utf-8')
-    multicast_socket.sendto(json_data, (multicast_group, multicast_port))
+    for datagram in protocol.encode_datagrams(data):
+        multicast_socket.sendto(datagram, (multicast_group, multicast_port))
 
 
-def contains_english_letters(text):
-    return any('a' <= c <= 'z' or 'A' <= c <= 'Z' for c in text)
+class TranslatorElection:
+    """Выбор одного активного переводчика, если их в сети несколько.
 
-def listen_group_messages():
+    Каждый экземпляр раз в ``interval`` секунд объявляет свой id; переводит
+    только экземпляр с наименьшим id среди живых. Id начинается со времени
+    запуска, поэтому лидером остаётся самый старый экземпляр, а новый
+    сначала ``grace`` секунд слушает, кто уже работает.
+    """
+
+    def __init__(self, interval=TRANSLATOR_HEARTBEAT_INTERVAL):
+        self.interval = interval
+        self.grace = interval * 1.5
+        self.translator_id = f"{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:8]}"
+        self.peers = {}  # id -> время последнего объявления
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def observe(self, translator_id):
+        if translator_id and translator_id != self.translator_id:
+            with self._lock:
+                self.peers[translator_id] = time.monotonic()
+
+    def is_leader(self):
+        now = time.monotonic()
+        if now - self.started < self.grace:
+            return False
+        with self._lock:
+            for translator_id, last_seen in list(self.peers.items()):
+                if now - last_seen > self.interval * 3:
+                    del self.peers[translator_id]
+            return all(self.translator_id < translator_id for translator_id in self.peers)
+
+    def announce(self):
+        """Периодическое объявление себя (в отдельном потоке)"""
+        data = {'type': 'translator_online', 'username': TRANSLATOR_NAME,
+                'translator_id': self.translator_id}
+        while True:
+            try:
+                for datagram in protocol.encode_datagrams(data):
+                    multicast_socket.sendto(datagram, (multicast_group, multicast_port))
+            except Exception as e:
+                print(f"Ошибка объявления переводчика: {e}")
+            time.sleep(self.interval)
+
+ELECTION = TranslatorElection()
+
+def send_translation(original, future):
+    """Отправка готового перевода в чат (вызывается из рабочего потока)"""
+    try:
+        translated = future.result()
+    except Exception as e:
+        print(f"Ошибка перевода: {e}")
+        return
+    if translated != original:
+        send_group_message(translated)
+
+# Переводы сообщений одного отправителя уходят в чат в порядке исходных,
+# даже если воркеры пула закончили их в другом порядке; переводы разных
+# отправителей друг друга не ждут
+DELIVERY = OrderedDelivery(send_translation)
+
+def listen_group_messages(scheduler):
         global udp_socket
         """Прослушивание групповых сообщений с улучшенной стабильностью"""
         udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -95,25 +487,111 @@ def listen_group_messages():
         mreq = group + socket.inet_aton('0.0.0.0')
         udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
         udp_socket.settimeout(100.0)
+        reassembler = protocol.FragmentReassembler()
+        # Повторы по NACK приходят и переводчику: одно сообщение переводим один раз
+        receiver = reliable.ReliableReceiver()
 
         while True:
-            data, address = udp_socket.recvfrom(1024)
-            message_data = json.loads(data.decode('utf-8'))
-            print(data)
-            
-            if message_data['type'] == 'group_message':
-                mess = message_data['message']
-                if contains_english_letters(mess):
-                    i = translate_text(mess, "en", 'ru')
-                    if i != mess:
-                        send_group_message(i)
+            try:
+                data, address = udp_socket.recvfrom(65535)
+            except socket.timeout:
+                continue
+            # Один испорченный пакет не должен останавливать мост: Flask
+            # продолжил бы работать, а перевод в чате - нет
+            try:
+                handle_bridge_datagram(data, address, reassembler, receiver, scheduler)
+            except protocol.ProtocolError as e:
+                BRIDGE_DECODE_ERRORS.inc()
+                print(f"Некорректный пакет от {address[0]}: {e}")
+            except Exception as e:
+                BRIDGE_DECODE_ERRORS.inc()
+                print(f"Ошибка обработки пакета от {address[0]}: {e}")
+
+
+def handle_bridge_datagram(data, address, reassembler, receiver, scheduler):
+    """Разбор одной датаграммы общего чата и постановка перевода"""
+    message_data = reassembler.feed(data, address)
+    if message_data is None:
+        return  # ждём остальные фрагменты
+    message_type = message_data.get('type')
+    BRIDGE_PACKETS.labels(protocol.type_label(message_type)).inc()
+
+    if message_type == 'translator_online':
+        ELECTION.observe(message_data.get('translator_id'))
 
+    elif message_type == 'group_message':
+        # Свои и чужие переводы не переводим, иначе боты зациклятся
+        if message_data.get('translated') or message_data.get('username') == TRANSLATOR_NAME:
+            return
+        if 'seq' in message_data and not receiver.accept(
+                message_data.get('username'), message_data.get('epoch'), message_data['seq']):
+            return
+        if not ELECTION.is_leader():
+            return
+        mess = message_data.get('message')
+        if not isinstance(mess, str):
+            return
+        direction = language.translation_direction(mess, TRANSLATE_DIRECTIONS)
+        if direction is not None:
+            # Перевод идёт в фоне, приёмный цикл не ждёт модель
+            future = scheduler.submit(mess, *direction)
+            DELIVERY.track(future, mess, key=message_data.get('username'))
+
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сервер перевода для локального чата")
+    parser.add_argument('--preload', action='store_true',
+                        help="загрузить и прогреть все модели до начала работы")
+    parser.add_argument('--quantize', action='store_true',
+                        help="динамическая int8-квантизация моделей для CPU")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="число потоков torch для инференса")
+    parser.add_argument('--compare', action='store_true',
+                        help="сравнить fp32 и int8 по загрузке и задержке и выйти")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="число процессов-переводчиков (0 - переводить в этом процессе)")
+    parser.add_argument('--directions', default='en-ru',
+                        help="переводы в чате через запятую, например en-ru,ru-en")
+    parser.add_argument('--host', default='0.0.0.0', help="адрес HTTP API")
+    parser.add_argument('--port', type=int, default=5000, help="порт HTTP API")
+    parser.add_argument('--stats-port', type=int, default=None,
+                        help="локальный сокет статистики на 127.0.0.1")
+    parser.add_argument('--profile', action='store_true',
+                        help="включить выборочный профилировщик (результат в сокете --stats-port)")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.compare:
+        compare_quantization()
+        sys.exit(0)
+    QUANTIZE = args.quantize
+    TRANSLATE_DIRECTIONS = [tuple(pair.split('-')) for pair in args.directions.split(',')]
+    for pair in TRANSLATE_DIRECTIONS:
+        if pair not in SUPPORTED_PAIRS:
+            sys.exit(f"Неподдерживаемая языковая пара: {'-'.join(pair)}")
+
+    metrics.configure_from_env(default_port=args.stats_port)
+    if args.profile:
+        metrics.REGISTRY.start_profiler()
     print("Запуск сервера перевода...")
     print("Поддерживаемые пары: ru↔en")
-    print("Сервер будет доступен по адресу: http://<IP>:5000/translate")
-    setup_sockets()     
-    listen_group_messages()
-    app.run(host='192.168.0.49', port=5007, threaded=True)
+    if args.workers:
+        # Воркеры сами загружают и прогревают свои копии моделей
+        print(f"Запуск {args.workers} процессов-переводчиков...")
+        SCHEDULER.pool = TranslatorPool(args.workers, threads_per_worker=args.threads,
+                                        quantize=QUANTIZE).start()
+    elif args.preload:
+        preload_models()
+    print(f"Сервер будет доступен по адресу: http://{args.host}:{args.port}/translate")
+    SCHEDULER.start()
+    setup_sockets()
+    # Multicast-мост в фоне, HTTP API в главном потоке; модели общие
+    bridge_thread = threading.Thread(target=listen_group_messages, args=(SCHEDULER,), daemon=True)
+    bridge_thread.start()
+    threading.Thread(target=ELECTION.announce, daemon=True).start()
+    app.run(host=args.host, port=args.port, threaded=True)
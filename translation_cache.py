@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.localchat', 'translations.sqlite3')
+
+
+def normalize_text(text):
+    """Нормализация текста для ключа кэша: NFC и схлопывание пробелов"""
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+class TranslationCache:
+    """Двухуровневый кэш переводов: LRU в памяти и SQLite на диске.
+
+    Ключ - языковая пара, имя модели и нормализованный текст. Диск переживает
+    перезапуск переводчика; когда записей становится больше ``max_disk_entries``,
+    удаляются давно не использованные. Счётчики попаданий доступны через ``stats``.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, memory_size=4096, max_disk_entries=200000):
+        self.path = path
+        self.memory_size = memory_size
+        self.max_disk_entries = max_disk_entries
+        self.memory = OrderedDict()  # ключ -> перевод
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS translations (
+                src TEXT NOT NULL,
+                tgt TEXT NOT NULL,
+                model TEXT NOT NULL,
+                text TEXT NOT NULL,
+                result TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (src, tgt, model, text)
+            )
+        """)
+        self.db.execute('CREATE INDEX IF NOT EXISTS translations_last_used ON translations (last_used)')
+        self.db.commit()
+        self._disk_entries = self.db.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+
+    def get(self, src, tgt, model, text):
+        """Перевод из кэша или None"""
+        key = (src, tgt, model, normalize_text(text))
+        with self._lock:
+            result = self.memory.get(key)
+            if result is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return result
+
+            row = self.db.execute(
+                'SELECT result FROM translations WHERE src=? AND tgt=? AND model=? AND text=?',
+                key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.disk_hits += 1
+            self.db.execute(
+                'UPDATE translations SET last_used=? WHERE src=? AND tgt=? AND model=? AND text=?',
+                (time.time(),) + key)
+            self.db.commit()
+            self._remember(key, row[0])
+            return row[0]
+
+    def put(self, src, tgt, model, text, result):
+        key = (src, tgt, model, normalize_text(text))
+        with self._lock:
+            self._remember(key, result)
+            now = time.time()
+            cursor = self.db.execute(
+                'INSERT OR IGNORE INTO translations VALUES (?, ?, ?, ?, ?, ?)', key + (result, now))
+            if cursor.rowcount:
+                self._disk_entries += 1
+            else:
+                self.db.execute(
+                    'UPDATE translations SET result=?, last_used=? '
+                    'WHERE src=? AND tgt=? AND model=? AND text=?', (result, now) + key)
+            if self._disk_entries > self.max_disk_entries:
+                self._evict_disk()
+            self.db.commit()
+
+    def _remember(self, key, result):
+        self.memory[key] = result
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        # Удаляем с запасом в 10%, чтобы не чистить диск на каждой вставке
+        target = int(self.max_disk_entries * 0.9)
+        self.db.execute(
+            'DELETE FROM translations WHERE rowid IN '
+            '(SELECT rowid FROM translations ORDER BY last_used LIMIT ?)',
+            (self._disk_entries - target,))
+        self._disk_entries = self.db.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                'memory_entries': len(self.memory),
+                'disk_entries': self._disk_entries,
+            }
+
+    def close(self):
+        with self._lock:
+            self.db.close()
@@ -0,0 +1,263 @@
+import itertools
+import multiprocessing
+from multiprocessing.connection import wait as wait_connections
+import os
+import threading
+from concurrent.futures import Future
+
+try:
+    import psutil
+except ImportError:  # psutil необязателен: без него RSS читается из /proc
+    psutil = None
+
+
+def current_rss():
+    """Резидентная память текущего процесса в байтах или None"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _worker_main(index, threads, quantize, preload, tasks, results):
+    """Процесс-воркер: своя копия моделей и своя доля потоков torch.
+
+    ``results`` - свой канал воркера: если он упадёт посреди записи, это
+    не испортит ответы остальных, как испортило бы общую очередь.
+    """
+    import torch
+    torch.set_num_threads(threads)
+
+    import trans
+    trans.QUANTIZE = quantize
+    if preload:
+        trans.preload_models()
+    results.send(('ready', index, current_rss()))
+
+    while True:
+        job = tasks.get()
+        if job is None:
+            break
+        job_id, texts, src, tgt = job
+        try:
+            translations = trans.translate_batch(texts, src, tgt)
+            results.send(('done', job_id, translations, None, index, current_rss()))
+        except Exception as e:
+            results.send(('done', job_id, None, f"{type(e).__name__}: {e}", index, current_rss()))
+
+
+class TranslatorPool:
+    """Пул процессов-переводчиков.
+
+    Каждый воркер загружает свою копию моделей и получает
+    ``cpu_count // workers`` потоков torch, поэтому батчи переводятся
+    параллельно, без GIL и без борьбы потоков внутри одного процесса.
+    ``submit_batch`` блокируется, пока в работе ``max_in_flight`` батчей:
+    так очередь планировщика копит следующий, более крупный батч.
+
+    У каждого воркера своя очередь заданий, батч уходит наименее занятому.
+    Поэтому известно, какие батчи были у воркера, который упал: они
+    завершаются ошибкой, их места освобождаются, а воркер запускается заново.
+    """
+
+    def __init__(self, workers, threads_per_worker=None, quantize=False, preload=True,
+                 max_in_flight=None, check_interval=1.0):
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        self.quantize = quantize
+        self.preload = preload
+        self.check_interval = check_interval  # секунд между проверками, живы ли воркеры
+        self.memory = {}  # номер воркера -> RSS в байтах
+        self.completed = {}  # номер воркера -> число выполненных батчей
+        self.restarts = 0
+
+        self._context = multiprocessing.get_context('spawn')
+        self._results = {}  # номер воркера -> канал его ответов
+        self._processes = {}  # номер воркера -> процесс
+        self._task_queues = {}  # номер воркера -> его очередь заданий
+        self._outstanding = {}  # номер воркера -> id батчей в работе у него
+        self._futures = {}  # id батча -> (Future, номер воркера)
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight or workers * 2)
+        self._ready = threading.Event()
+        self._ready_count = 0
+        self._stopping = False
+
+    def _spawn(self, index):
+        tasks = self._context.Queue()
+        reader, writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self.threads_per_worker, self.quantize, self.preload, tasks, writer),
+            daemon=True)
+        process.start()
+        writer.close()  # конец для записи остаётся только у воркера
+        self._task_queues[index] = tasks
+        self._results[index] = reader
+        self._processes[index] = process
+        self._outstanding[index] = set()
+
+    def start(self, wait=True):
+        for index in range(self.workers):
+            self._spawn(index)
+        threading.Thread(target=self._collect_results, daemon=True).start()
+        if wait:
+            while not self._ready.wait(0.5):
+                if any(not process.is_alive() for process in self._processes.values()):
+                    self.stop()
+                    raise RuntimeError("Воркер перевода завершился при запуске")
+        return self
+
+    def submit_batch(self, texts, src, tgt):
+        """Отправка батча в пул; возвращает Future со списком переводов"""
+        self._slots.acquire()
+        future = Future()
+        with self._lock:
+            job_id = next(self._job_ids)
+            index = min(self._outstanding, key=lambda i: len(self._outstanding[i]))
+            self._outstanding[index].add(job_id)
+            self._futures[job_id] = (future, index)
+            tasks = self._task_queues[index]
+        tasks.put((job_id, list(texts), src, tgt))
+        return future
+
+    def translate_batch(self, texts, src, tgt):
+        return self.submit_batch(texts, src, tgt).result()
+
+    def _collect_results(self):
+        """Ответы воркеров и их завершение: ждём каналы и sentinel процессов сразу"""
+        while not self._stopping:
+            with self._lock:
+                readers = {reader: index for index, reader in self._results.items()}
+                sentinels = [process.sentinel for process in self._processes.values()]
+            ready = wait_connections(list(readers) + sentinels, timeout=self.check_interval)
+            for connection in ready:
+                if connection in readers:
+                    self._receive(readers[connection])
+            self._check_workers()
+
+    def _receive(self, index):
+        """Все ответы, уже лежащие в канале воркера"""
+        reader = self._results[index]
+        try:
+            while reader.poll():
+                self._handle(reader.recv())
+        except (EOFError, OSError):
+            pass  # воркер закрыл канал; его завершение обработает _check_workers
+
+    def _handle(self, message):
+        if message[0] == 'ready':
+            _, index, rss = message
+            self.memory[index] = rss
+            self._ready_count += 1
+            print(f"Воркер перевода {index} готов, память {_format_bytes(rss)}")
+            if self._ready_count >= self.workers:
+                self._ready.set()
+            return
+
+        _, job_id, translations, error, index, rss = message
+        self.memory[index] = rss
+        self.completed[index] = self.completed.get(index, 0) + 1
+        with self._lock:
+            future, _ = self._futures.pop(job_id, (None, None))
+            self._outstanding[index].discard(job_id)
+        if future is None:
+            return  # батч уже завершён ошибкой при падении воркера
+        self._slots.release()
+        if error is None:
+            future.set_result(translations)
+        else:
+            future.set_exception(RuntimeError(error))
+
+    def _check_workers(self):
+        """Упавший воркер: его батчи - с ошибкой, места - свободны, воркер - заново"""
+        if self._stopping or not self._ready.is_set():
+            return
+        for index, process in list(self._processes.items()):
+            if process.is_alive():
+                continue
+            self._receive(index)  # то, что он успел ответить до падения
+            with self._lock:
+                lost = [self._futures.pop(job_id)[0] for job_id in self._outstanding[index]
+                        if job_id in self._futures]
+                self._results.pop(index).close()
+                # Под блокировкой: новый батч не должен попасть в очередь мёртвого воркера
+                self._spawn(index)
+            print(f"Воркер перевода {index} завершился (код {process.exitcode}), "
+                  f"потеряно батчей: {len(lost)}; перезапуск")
+            self.restarts += 1
+            for future in lost:
+                self._slots.release()
+                future.set_exception(RuntimeError(f"Воркер перевода {index} завершился"))
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'threads_per_worker': self.threads_per_worker,
+            'in_flight': len(self._futures),
+            'restarts': self.restarts,
+            'memory_bytes': dict(self.memory),
+            'completed_batches': dict(self.completed),
+        }
+
+    def stop(self):
+        self._stopping = True
+        for tasks in self._task_queues.values():
+            tasks.put(None)
+        for process in self._processes.values():
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+
+class OrderedDelivery:
+    """Выдача результатов в порядке постановки внутри одного ключа.
+
+    Воркеры могут закончить батчи не по порядку; ``deliver`` всё равно
+    вызывается для результатов с одним ``key`` строго в том порядке, в каком
+    они были зарегистрированы через ``track``. Разные ключи (например,
+    отправители) друг друга не ждут: короткое сообщение одного не стоит за
+    длинной вставкой другого.
+    """
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+        self._sequences = {}  # ключ -> номер следующего зарегистрированного
+        self._next = {}  # ключ -> номер следующего к выдаче
+        self._ready = {}  # (ключ, номер) -> (future, args)
+        self._lock = threading.Lock()
+
+    def track(self, future, *args, key=None):
+        with self._lock:
+            sequence = self._sequences.get(key, 0)
+            self._sequences[key] = sequence + 1
+        future.add_done_callback(lambda f: self._done(key, sequence, f, args))
+
+    def _done(self, key, sequence, future, args):
+        with self._lock:
+            self._ready[(key, sequence)] = (future, args)
+            next_sequence = self._next.get(key, 0)
+            while (key, next_sequence) in self._ready:
+                future, args = self._ready.pop((key, next_sequence))
+                next_sequence += 1
+                try:
+                    self.deliver(*args, future)
+                except Exception as e:
+                    # Иначе очередь этого ключа встала бы навсегда
+                    print(f"Ошибка выдачи результата: {e}")
+            if next_sequence == self._sequences[key]:
+                # Всё выдано - ключ больше не держим
+                del self._sequences[key]
+                self._next.pop(key, None)
+            else:
+                self._next[key] = next_sequence
+
+
+def _format_bytes(value):
+    if value is None:
+        return "неизвестно"
+    return f"{value / (1024 * 1024):.0f} МБ"